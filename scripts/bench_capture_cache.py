@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Measure ResultCache lookups as the manifest grows.
+
+Usage: PYTHONPATH=src/ python scripts/bench_capture_cache.py
+"""
+# pylint: disable=protected-access
+import time
+import hashlib
+
+import litprog.capture_cache as lp_capture_cache
+
+NUM_LOOKUPS = 10_000
+
+
+def _manifest_entries(num_entries: int) -> list[lp_capture_cache.ManifestEntry]:
+    entries = []
+    for i in range(num_entries):
+        # NOTE: every task was built four times, only the latest entry is relevant
+        task_key = hashlib.sha1(str(i // 4).encode("ascii")).hexdigest()
+        digest   = hashlib.sha1(str(i).encode("ascii")).hexdigest()
+        created  = f"2021-03-05T00:00:{i:09d}"
+        entry    = lp_capture_cache.ManifestEntry(created, 10, 100, digest, task_key, "01_test.md", "@ 1")
+        entries.append(entry)
+    return entries
+
+
+def _bench(num_entries: int) -> None:
+    entries       = _manifest_entries(num_entries)
+    manifest_text = lp_capture_cache.dumps_manifest(entries)
+
+    t_start   = time.time()
+    cache     = lp_capture_cache.ResultCache(manifest_text)
+    load_time = time.time() - t_start
+
+    task_keys = [entries[-(i % num_entries) - 1].task_key for i in range(NUM_LOOKUPS)]
+    t_start   = time.time()
+    for task_key in task_keys:
+        assert cache._entries_by_task_key.get(task_key) is not None
+    lookup_time = time.time() - t_start
+
+    t_start      = time.time()
+    dropped      = cache.compact()
+    compact_time = time.time() - t_start
+
+    print(
+        f"entries: {num_entries:>7}  load: {load_time * 1000:8.1f}ms  "
+        f"lookup: {lookup_time / NUM_LOOKUPS * 1e6:6.2f}us  "
+        f"compact: {compact_time * 1000:6.1f}ms (dropped {len(dropped)})"
+    )
+
+
+def main() -> None:
+    for num_entries in [100, 1_000, 10_000, 100_000]:
+        _bench(num_entries)
+
+
+if __name__ == '__main__':
+    main()
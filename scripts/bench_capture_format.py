@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Compare the legacy json capture format with the binary format.
+
+Usage: PYTHONPATH=src/ python scripts/bench_capture_format.py [num_lines]
+"""
+import sys
+import json
+import time
+import typing as typ
+
+import litprog.session as lp_session
+
+
+def _legacy_dumps(capture: lp_session.Capture) -> bytes:
+    line_args = [[line.ts, line.line, line.is_err] for line in capture.lines]
+    return json.dumps([capture.command, capture.exit_status, capture.runtime, line_args]).encode("utf-8")
+
+
+def _timeit(func: typ.Callable[[], typ.Any], repeat: int = 5) -> float:
+    durations = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - t_start)
+    return min(durations)
+
+
+def main(args: list[str]) -> None:
+    num_lines = int(args[0]) if args else 100_000
+
+    t_start = time.time()
+    lines   = [
+        lp_session.CapturedLine(
+            t_start + i * 0.0001,
+            f"{i:>6} | some typical output of a build step\n",
+            i % 50 == 0,
+        )
+        for i in range(num_lines)
+    ]
+    capture = lp_session.Capture("python3", 0, 1.0, lines)
+
+    formats = {
+        'json'  : _legacy_dumps,
+        'binary': lp_session.dumps_capture,
+    }
+    for name, dumps in formats.items():
+        data = dumps(capture)
+        assert lp_session.loads_capture(data).lines[-1].line == lines[-1].line
+
+        dumps_time = _timeit(lambda: dumps(capture))
+        loads_time = _timeit(lambda: lp_session.loads_capture(data))
+        iter_time  = _timeit(lambda: list(lp_session.loads_capture(data).lines))
+        print(
+            f"{name:<6}  lines: {num_lines}  size: {len(data) / 1024:8.1f}KB  "
+            f"dumps: {dumps_time * 1000:7.1f}ms  loads: {loads_time * 1000:7.1f}ms  "
+            f"loads + all lines: {iter_time * 1000:7.1f}ms"
+        )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
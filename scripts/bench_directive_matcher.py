@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Per comment cost of directive matching on the comments of a corpus.
+
+Compares a loop of re.match(name + ":") calls (the previous
+implementation) with the precompiled PRELUDE_DIRECTIVE_RE.
+
+Usage: PYTHONPATH=src/ python scripts/bench_directive_matcher.py [corpus_dir]
+"""
+import re
+import sys
+import time
+import typing as typ
+import pathlib as pl
+
+import litprog.parse as lp_parse
+
+
+def _loop_has_directive(comment_text: str, is_prelude: bool) -> bool:
+    comment_text = comment_text.strip()
+    if is_prelude:
+        if comment_text in lp_parse.VALID_NOARG_DIRECTIVES:
+            return True
+        names = lp_parse.VALID_ARG_DIRECTIVES
+    else:
+        names = lp_parse.VALID_INLINE_DIRECTIVES
+
+    for name in names:
+        if re.match(r"^" + name + r"\s*:", comment_text):
+            return True
+    return False
+
+
+def _iter_comments(corpus_dir: pl.Path) -> typ.Iterable[str]:
+    md_paths  = sorted(corpus_dir.glob("*.md"))
+    parse_ctx = lp_parse.Context(md_paths=md_paths)
+    for block in parse_ctx.iter_blocks():
+        if block.info_string not in lp_parse.LANGUAGE_COMMENT_REGEXES:
+            continue
+        comment_start_re, _ = lp_parse.LANGUAGE_COMMENT_REGEXES[block.info_string]
+        for line in block.content.splitlines():
+            start_match = comment_start_re.search(line)
+            if start_match:
+                yield line[start_match.end() :]
+
+
+def _timeit(func: typ.Callable[[], typ.Any], repeat: int = 5) -> float:
+    durations = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - t_start)
+    return min(durations)
+
+
+def main(args: list[str]) -> None:
+    corpus_dir = pl.Path(args[0] if args else "lit_v3")
+    comments   = list(_iter_comments(corpus_dir))
+
+    def _compiled() -> None:
+        for comment in comments:
+            lp_parse.parse_directive(comment, comment, is_prelude=True)
+
+    def _loop() -> None:
+        for comment in comments:
+            _loop_has_directive(comment, is_prelude=True)
+
+    num_directives = sum(lp_parse.has_directive(comment, is_prelude=True) for comment in comments)
+    print(f"corpus: {corpus_dir}  comments: {len(comments)}  with directive: {num_directives}")
+    for name, func in [('loop', _loop), ('compiled', _compiled)]:
+        duration = _timeit(func)
+        per_comment_us = duration * 1e6 / len(comments)
+        print(f"{name:<8}  total: {duration * 1000:7.2f}ms  per comment: {per_comment_us:6.2f}us")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Expansion of dep/include directives on a synthetic dependency graph.
+
+The graph has a chain of `depth` def blocks, each of which depends
+on the next one and on `width` shared leaf blocks. A number of exec
+blocks depend on the head of the chain and one wide block has a dep
+directive for every leaf.
+
+Compares a recursive str.replace based expansion with per edge cycle
+checks (the previous implementation) with build._iter_expanded_chapters.
+
+Usage: PYTHONPATH=src/ python scripts/bench_expansion.py [depth] [width] [consumers]
+"""
+import re
+import sys
+import time
+import typing as typ
+import fnmatch
+import tempfile
+import pathlib as pl
+
+import litprog.build as lp_build
+import litprog.parse as lp_parse
+
+
+def _gen_markdown(depth: int, width: int, consumers: int) -> str:
+    parts = ["# Expansion Benchmark\n"]
+    for i in range(width):
+        parts.append(f"```python\n# def: leaf_{i}\nLEAF_{i} = {i}\n```\n")
+
+    for i in range(depth):
+        deps = [f"leaf_{j}" for j in range(i % width, width)]
+        if i + 1 < depth:
+            deps.insert(0, f"node_{i + 1}")
+        dep_lines = "".join(f"# dep: {dep}\n" for dep in deps)
+        parts.append(f"```python\n# def: node_{i}\n{dep_lines}def node_{i}():\n    return {i}\n```\n")
+
+    for i in range(consumers):
+        parts.append(f"```python\n# exec\n# dep: node_0\nprint(node_0())\n```\n")
+
+    dep_lines = "".join(f"# dep: leaf_{j}\n" for j in range(width))
+    parts.append(f"```python\n# file: out/wide.py\n{dep_lines}print(LEAF_0)\n```\n")
+    return "\n".join(parts)
+
+
+def _legacy_resolve_dep_sids(raw_dep_sid: str, blocks_by_sid: lp_build.BlockListBySid) -> typ.Iterable[str]:
+    if raw_dep_sid in blocks_by_sid:
+        yield raw_dep_sid
+    elif "*" in raw_dep_sid:
+        dep_sid_re = re.compile(fnmatch.translate(raw_dep_sid))
+        for maybe_dep_sid in blocks_by_sid:
+            if dep_sid_re.match(maybe_dep_sid):
+                yield maybe_dep_sid
+
+
+def _legacy_get_dep_cycle(lp_id: str, dep_map: lp_build.DependencyMap, root_id: str) -> list[str]:
+    if lp_id in dep_map:
+        dep_sids = dep_map[lp_id]
+        if root_id in dep_sids:
+            return [lp_id]
+
+        for _dep_sid in dep_sids:
+            cycle_ids = _legacy_get_dep_cycle(_dep_sid, dep_map, root_id)
+            if cycle_ids:
+                return [lp_id] + cycle_ids
+
+    return []
+
+
+def _legacy_expand_block_content(
+    blocks_by_sid: lp_build.BlockListBySid,
+    block        : typ.Any,
+    added_deps   : set[str],
+    dep_map      : lp_build.DependencyMap,
+    keep_fence   : bool,
+) -> str:
+    def_ = lp_build.get_directive(block, 'def', missing_ok=True, many_ok=False)
+
+    if keep_fence:
+        new_content = block.content
+    else:
+        new_content = block.includable_content + "\n"
+
+    for directive in lp_build.iter_directives(block, 'dep', 'include'):
+        is_dep = directive.name == 'dep'
+
+        dep_contents: list[str] = []
+        for raw_dep_sid in directive.value.split(","):
+            raw_dep_sid = lp_build._namespaced_lp_id(block, raw_dep_sid)
+            for dep_sid in _legacy_resolve_dep_sids(raw_dep_sid, blocks_by_sid):
+                if def_:
+                    def_id = lp_build._namespaced_lp_id(block, def_.value)
+                    assert not _legacy_get_dep_cycle(dep_sid, dep_map, root_id=def_id)
+
+                if is_dep:
+                    if dep_sid in added_deps:
+                        continue
+                    added_deps.add(dep_sid)
+
+                for dep_block in blocks_by_sid[dep_sid]:
+                    dep_content = _legacy_expand_block_content(
+                        blocks_by_sid, dep_block, added_deps, dep_map, keep_fence=False
+                    )
+                    dep_contents.append(lp_build._match_indent(directive.raw_text, dep_content))
+
+        include_content = "".join(dep_contents)
+        dep_text        = directive.raw_text.lstrip("\n")
+        new_content     = lp_build._indented_include(new_content, dep_text, include_content, is_dep=is_dep)
+
+    return new_content
+
+
+def _legacy_expand(chapters: list[lp_parse.Chapter]) -> list[str]:
+    blocks_by_sid = lp_build._get_blocks_by_id(chapters)
+    dep_map       = lp_build._build_dep_map(blocks_by_sid)
+    return [
+        _legacy_expand_block_content(blocks_by_sid, block, set(), dep_map, keep_fence=True)
+        for chapter in chapters
+        for block in chapter.iter_blocks()
+        if lp_build._is_consumed(block)
+    ]
+
+
+def _engine_expand(chapters: list[lp_parse.Chapter]) -> list[str]:
+    return [
+        block.content
+        for chapter in lp_build._iter_expanded_chapters(chapters)
+        for block in chapter.iter_blocks()
+        if lp_build._is_consumed(block)
+    ]
+
+
+def _timeit(func: typ.Callable[[], typ.Any], repeat: int = 3) -> float:
+    durations = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - t_start)
+    return min(durations)
+
+
+def main(args: list[str]) -> None:
+    depth     = int(args[0]) if len(args) > 0 else 200
+    width     = int(args[1]) if len(args) > 1 else 50
+    consumers = int(args[2]) if len(args) > 2 else 20
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        md_path = pl.Path(tmp_dir) / "01_bench.md"
+        md_path.write_text(_gen_markdown(depth, width, consumers))
+        chapters = lp_parse.parse_context([md_path]).chapters
+
+    assert _legacy_expand(chapters) == _engine_expand(chapters)
+
+    print(f"depth: {depth}  width: {width}  consumers: {consumers}")
+    for name, func in [('legacy', _legacy_expand), ('engine', _engine_expand)]:
+        duration = _timeit(lambda: func(chapters))
+        print(f"{name:<8}  total: {duration * 1000:9.2f}ms")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
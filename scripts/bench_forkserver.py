@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Compare a fresh interpreter per block with the forkserver.
+
+Usage: PYTHONPATH=src/ python scripts/bench_forkserver.py [num_blocks] [preload_modules]
+
+Runs many short 'exec: python3' style blocks one after another and
+reports the per block latency. The output of each block is compared
+against the output of a fresh interpreter.
+"""
+import sys
+import time
+
+import litprog.session as lp_session
+import litprog.forkserver as lp_forkserver
+
+BLOCK = r"""
+import json
+import decimal
+import argparse
+
+print(json.dumps({"value": str(decimal.Decimal("1.1") * 3)}))
+print("warn", file=sys.stderr)
+"""
+
+
+def _run_block(spawn=None) -> tuple[int, str, str]:
+    isession    = lp_session.InteractiveSession(["python3"], spawn=spawn)
+    isession.send("import sys\n" + BLOCK)
+    exit_status = isession.wait(timeout=10)
+    return (exit_status, isession.stdout, isession.stderr)
+
+
+def _bench(name: str, num_blocks: int, spawn=None) -> tuple[int, str, str]:
+    t_start = time.time()
+    for _ in range(num_blocks):
+        result = _run_block(spawn)
+    duration = time.time() - t_start
+    per_block_ms = duration / num_blocks * 1000
+    print(f"{name:<11} blocks: {num_blocks:>4}  total: {duration:6.3f}s  per block: {per_block_ms:6.1f}ms")
+    return result
+
+
+def main(args: list[str]) -> None:
+    num_blocks      = int(args[0]) if len(args) > 0 else 50
+    preload_modules = args[1].split(",") if len(args) > 1 else ["json", "decimal", "argparse"]
+
+    expected = _bench("interpreter", num_blocks)
+
+    server = lp_forkserver.ForkServer("python3", preload_modules)
+    try:
+        result = _bench("forkserver", num_blocks, spawn=server.spawn)
+    finally:
+        server.close()
+
+    assert result == expected, (result, expected)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
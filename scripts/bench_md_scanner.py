@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Measure how the Markdown element scanner scales with file size.
+
+The time per MB should stay roughly constant as the size grows.
+
+Usage: PYTHONPATH=src/ python scripts/bench_md_scanner.py [max_mb]
+"""
+import sys
+import time
+
+import litprog.parse as lp_parse
+
+SECTION = """
+## Section {0}
+
+Some text of section {0}, which is long enough
+to be a typical paragraph of a generated file.
+
+```python
+# exec
+print("section {0}")
+```
+
+```python
+# out
+section {0}
+```
+"""
+
+
+def _gen_content(num_bytes: int) -> str:
+    chunks     = ["# Generated\n"]
+    chunks_len = 0
+    while chunks_len < num_bytes:
+        chunk = SECTION.format(len(chunks))
+        chunks.append(chunk)
+        chunks_len += len(chunk)
+    return "".join(chunks)
+
+
+def main(args: list[str]) -> None:
+    max_mb = int(args[0]) if args else 32
+
+    size_mb = 1
+    while size_mb <= max_mb:
+        content = _gen_content(size_mb * 1024 * 1024)
+
+        t_start  = time.perf_counter()
+        elements = list(lp_parse._iter_raw_md_elements(content))
+        duration = time.perf_counter() - t_start
+
+        assert "".join(elem.content for elem in elements) == content
+        print(
+            f"size: {size_mb:>4}MB  elements: {len(elements):>8}  "
+            f"scan: {duration * 1000:8.1f}ms  per MB: {duration * 1000 / size_mb:6.1f}ms"
+        )
+        size_mb *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
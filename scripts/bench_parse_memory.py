@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Peak RSS of parsing a synthetic book, including the blocks of every chapter.
+
+The book is written to a temporary directory and parsed in a
+subprocess, so that only the memory of parsing is measured.
+
+Usage: PYTHONPATH=src/ python scripts/bench_parse_memory.py [book_mb]
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+import pathlib as pl
+
+import litprog.config as lp_config
+import litprog.parse as lp_parse
+
+NUM_CHAPTERS = 50
+
+SECTION = """
+## Section {0}
+
+Some text of section {0}, which is long enough
+to be a typical paragraph of a literate program.
+
+```python
+# def: section_{0}
+# dep: section_{1}
+def section_{0}():
+    # a comment that is not a directive
+    return "section {0}"
+```
+
+```python
+# exec
+# dep: section_{0}
+print(section_{0}())
+```
+
+```shell
+# out
+section {0}
+```
+"""
+
+
+def _write_book(book_dir: pl.Path, book_mb: int) -> None:
+    chapter_bytes = book_mb * 1024 * 1024 // NUM_CHAPTERS
+    for chap_idx in range(NUM_CHAPTERS):
+        chunks     = [f"# Chapter {chap_idx}\n"]
+        chunks_len = 0
+        while chunks_len < chapter_bytes:
+            section_id = f"{chap_idx}_{len(chunks)}"
+            chunk      = SECTION.format(section_id, f"{chap_idx}_{len(chunks) - 1}")
+            chunks.append(chunk)
+            chunks_len += len(chunk)
+        md_path = book_dir / f"{chap_idx + 10:02d}_chapter_{chap_idx}.md"
+        md_path.write_text("".join(chunks), encoding="utf-8")
+
+
+def _measure(book_dir: pl.Path) -> None:
+    lp_config.CACHE_DIR = book_dir / "cache"
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t_start    = time.time()
+    md_paths   = sorted(book_dir.glob("*.md"))
+    parse_ctx  = lp_parse.Context(md_paths=md_paths)
+    num_blocks = sum(len(chapter.block_index().blocks) for chapter in parse_ctx.chapters)
+    duration   = time.time() - t_start
+    rss_after  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    book_mb = sum(md_path.stat().st_size for md_path in md_paths) / (1024 * 1024)
+    peak_mb = (rss_after - rss_before) / 1024
+    print(
+        f"book: {book_mb:.1f}MB  blocks: {num_blocks}  parse: {duration:.1f}s  "
+        f"peak rss: +{peak_mb:.0f}MB ({peak_mb / book_mb:.1f}x book size)"
+    )
+
+
+def main(args: list[str]) -> None:
+    if args and args[0] == "--measure":
+        _measure(pl.Path(args[1]))
+        return
+
+    book_mb  = int(args[0]) if args else 50
+    book_dir = pl.Path(tempfile.mkdtemp(prefix="litprog_bench_"))
+    try:
+        _write_book(book_dir, book_mb)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.run([sys.executable, __file__, "--measure", str(book_dir)], env=env, check=True)
+    finally:
+        shutil.rmtree(book_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
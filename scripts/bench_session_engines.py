@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Compare the session engines of litprog.session.
+
+Usage: PYTHONPATH=src/ python scripts/bench_session_engines.py [num_sessions] [concurrency]
+
+Runs many short python sessions concurrently (as 'lit build -n <concurrency>'
+would) and reports wall time, cpu time of the build process and the peak
+number of threads.
+"""
+import sys
+import time
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import litprog.session as lp_session
+
+BLOCK = r"""
+import sys
+for i in range(200):
+    sys.stdout.write(f"out {i}\n")
+    if i % 10 == 0:
+        sys.stderr.write(f"err {i}\n")
+"""
+
+
+def _run_session(engine: str) -> int:
+    session_class = lp_session.SESSION_ENGINES[engine]
+    isession      = session_class(["python3"])
+    isession.send(BLOCK)
+    exit_status = isession.wait(timeout=10)
+    assert exit_status == 0
+    lines = isession.output_lines()
+    assert len(lines) == 220, len(lines)
+    return len(lines)
+
+
+def _bench(engine: str, num_sessions: int, concurrency: int) -> None:
+    peak_threads = 0
+    is_running   = True
+
+    def _count_threads() -> None:
+        nonlocal peak_threads
+        while is_running:
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(0.001)
+
+    counter = threading.Thread(target=_count_threads)
+    counter.start()
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    t_start     = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(_run_session, [engine] * num_sessions))
+    wall_time = time.time() - t_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    is_running = False
+    counter.join()
+
+    cpu_time = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    print(
+        f"{engine:<9} sessions: {num_sessions:>4}  concurrency: {concurrency:>3}  "
+        f"wall: {wall_time:6.3f}s  cpu (build process): {cpu_time:6.3f}s  "
+        f"peak threads: {peak_threads:>4}"
+    )
+
+
+def main(args: list[str]) -> None:
+    num_sessions = int(args[0]) if len(args) > 0 else 128
+    concurrency  = int(args[1]) if len(args) > 1 else 32
+
+    # warmup
+    _run_session('thread')
+    _run_session('selector')
+
+    for engine in lp_session.SESSION_ENGINES:
+        _bench(engine, num_sessions, concurrency)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
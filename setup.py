@@ -55,7 +55,8 @@ setuptools.setup(
     extras_require={
         'html': read_requirements("html"),
         'pdf': read_requirements("html") + read_requirements("pdf"),
-        'all': read_requirements("html") + read_requirements("pdf"),
+        'zstd': read_requirements("zstd"),
+        'all': read_requirements("html") + read_requirements("pdf") + read_requirements("zstd"),
     },
     python_requires=">=3.7",
     setup_requires=['lib3to6>=202110.1050b0'],
@@ -8,18 +8,29 @@ import re
 import sys
 import json
 import time
+import heapq
+import bisect
+import shutil
 import typing as typ
 import fnmatch
+import hashlib
 import logging
 import tempfile
 import collections
 from pathlib import Path
 from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from concurrent.futures import FIRST_COMPLETED
 
+from . import index
 from . import parse
 from . import session
+from . import __version__
+from . import forkserver
+from . import build_plan
 from . import common_types as ct
+from . import remote_cache
 from . import capture_cache
 
 logger = logging.getLogger(__name__)
@@ -93,9 +104,13 @@ def iter_directives(block: ct.Block, *directive_names) -> typ.Iterable[ct.Direct
             yield directive
 
 
-def _match_indent(directive_text: str, include_val: str) -> str:
+def _directive_indent(directive_text: str) -> str:
     unindented = directive_text.lstrip()
-    indent     = directive_text[: -len(unindented)].strip("\n")
+    return directive_text[: -len(unindented)].strip("\n")
+
+
+def _match_indent(directive_text: str, include_val: str) -> str:
+    indent = _directive_indent(directive_text)
     if indent:
         return "\n".join(indent + line for line in include_val.splitlines())
     else:
@@ -147,28 +162,81 @@ def _iter_directive_sids(block: ct.Block, *directive_names) -> typ.Iterable[Scop
             yield _namespaced_lp_id(block, dep_id)
 
 
-def _resolve_dep_sids(
-    raw_dep_sid: ScopedBlockId, blocks_by_sid: BlockListBySid
-) -> typ.Iterable[ScopedBlockId]:
-    if raw_dep_sid in blocks_by_sid:
-        yield raw_dep_sid
-    elif "*" in raw_dep_sid:
-        dep_sid_re = re.compile(fnmatch.translate(raw_dep_sid))
-        for maybe_dep_sid in blocks_by_sid:
-            if dep_sid_re.match(maybe_dep_sid):
-                yield maybe_dep_sid
+# NOTE: Only ids with a "*" are resolved as glob patterns, any other
+#   glob characters are only special if the id also has a "*".
+GLOB_CHARS_RE = re.compile(r"[\*\?\[]")
+
+
+class BlockIdIndex:
+    """Resolve block ids with wildcards, such as 'utils.*'.
+
+    Ids are kept in sorted order, so the candidates for a pattern are
+    the range of ids that start with its literal prefix (everything
+    before the first glob character). Results are in the order of the
+    ids passed to the constructor and are cached per pattern.
+    """
+
+    _order  : dict[ScopedBlockId, int]
+    _sorted : list[ScopedBlockId]
+    _results: dict[str, tuple[ScopedBlockId, ...]]
+
+    def __init__(self, sids: typ.Iterable[ScopedBlockId]) -> None:
+        self._order   = {sid: i for i, sid in enumerate(sids)}
+        self._sorted  = sorted(self._order)
+        self._results = {}
+
+    def _prefix_range(self, prefix: str) -> list[ScopedBlockId]:
+        lo = bisect.bisect_left(self._sorted, prefix)
+        if prefix:
+            hi = bisect.bisect_left(self._sorted, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+        else:
+            hi = len(self._sorted)
+        return self._sorted[lo:hi]
+
+    def resolve(self, raw_sid: str) -> tuple[ScopedBlockId, ...]:
+        if raw_sid in self._order:
+            return (raw_sid,)
+        elif "*" not in raw_sid:
+            return ()
+        elif raw_sid in self._results:
+            return self._results[raw_sid]
+
+        glob_match = GLOB_CHARS_RE.search(raw_sid)
+        assert glob_match is not None
+        prefix     = raw_sid[: glob_match.start()]
+        candidates = self._prefix_range(prefix)
+
+        if raw_sid[glob_match.start() :] == "*":
+            sids = candidates
+        else:
+            sid_re = re.compile(fnmatch.translate(raw_sid))
+            sids   = [sid for sid in candidates if sid_re.match(sid)]
+
+        result = tuple(sorted(sids, key=self._order.__getitem__))
+        self._results[raw_sid] = result
+        return result
+
 
+def _resolve_dep_sids(raw_dep_sid: ScopedBlockId, sid_index: BlockIdIndex) -> tuple[ScopedBlockId, ...]:
+    return sid_index.resolve(raw_dep_sid)
 
-def _build_dep_map(blocks_by_sid: BlockListBySid) -> DependencyMap:
+
+def _build_dep_map(
+    blocks_by_sid: BlockListBySid, sid_index: typ.Optional[BlockIdIndex] = None
+) -> DependencyMap:
     """Build a mapping of block_ids to the Blocks they depend on.
 
-    The mapped block_ids (keys) are only the direct (non-recursive) dependencies.
+    The mapped block_ids (keys) are only the direct (non-recursive)
+    dependencies, via either dep or include directives.
     """
+    if sid_index is None:
+        sid_index = BlockIdIndex(blocks_by_sid)
+
     dep_map: DependencyMap = {}
     for def_id, blocks in blocks_by_sid.items():
         for block in blocks:
-            for raw_dep_sid in _iter_directive_sids(block, 'dep'):
-                dep_sids = list(_resolve_dep_sids(raw_dep_sid, blocks_by_sid))
+            for raw_dep_sid in _iter_directive_sids(block, 'dep', 'include'):
+                dep_sids = _resolve_dep_sids(raw_dep_sid, sid_index)
                 if not any(dep_sids):
                     # TODO (mb 2021-07-18): pylev for better message:
                     #   "Maybe you meant {closest_sids}"
@@ -189,67 +257,266 @@ def _build_dep_map(blocks_by_sid: BlockListBySid) -> DependencyMap:
     return dep_map
 
 
-def _get_dep_cycle(
-    lp_id  : BlockId,
-    dep_map: DependencyMap,
-    root_id: BlockId,
-    depth  : int = 0,
-) -> list[str]:
-    if lp_id in dep_map:
-        dep_sids = dep_map[lp_id]
-        if root_id in dep_sids:
-            return [lp_id]
+def _iter_dep_cycles(dep_map: DependencyMap) -> typ.Iterable[list[ScopedBlockId]]:
+    """Strongly connected components of dep_map that contain a cycle.
 
-        for _dep_sid in dep_sids:
-            cycle_ids = _get_dep_cycle(_dep_sid, dep_map, root_id, depth + 1)
-            if cycle_ids:
-                return [lp_id] + cycle_ids
+    This is Tarjan's algorithm, with an explicit stack rather than
+    recursion, so that deep dependency chains don't hit the recursion
+    limit.
+    """
+    indexes  : dict[ScopedBlockId, int] = {}
+    lowlinks : dict[ScopedBlockId, int] = {}
+    scc_stack: list[ScopedBlockId] = []
+    on_stack : set[ScopedBlockId] = set()
+
+    def _push(lp_id: ScopedBlockId) -> tuple[ScopedBlockId, typ.Iterator[ScopedBlockId]]:
+        indexes[lp_id] = lowlinks[lp_id] = len(indexes)
+        scc_stack.append(lp_id)
+        on_stack.add(lp_id)
+        return (lp_id, iter(dep_map.get(lp_id, ())))
+
+    for root_id in dep_map:
+        if root_id in indexes:
+            continue
+
+        work_stack = [_push(root_id)]
+        while work_stack:
+            lp_id, dep_sids = work_stack[-1]
+            for dep_sid in dep_sids:
+                if dep_sid not in indexes:
+                    work_stack.append(_push(dep_sid))
+                    break
+                elif dep_sid in on_stack:
+                    lowlinks[lp_id] = min(lowlinks[lp_id], indexes[dep_sid])
+            else:
+                work_stack.pop()
+                if work_stack:
+                    parent_id = work_stack[-1][0]
+                    lowlinks[parent_id] = min(lowlinks[parent_id], lowlinks[lp_id])
+
+                if lowlinks[lp_id] == indexes[lp_id]:
+                    scc: list[ScopedBlockId] = []
+                    while True:
+                        scc_id = scc_stack.pop()
+                        on_stack.discard(scc_id)
+                        scc.append(scc_id)
+                        if scc_id == lp_id:
+                            break
 
-    return []
+                    if len(scc) > 1 or lp_id in dep_map.get(lp_id, ()):
+                        yield scc
 
 
-def _err_on_include_cycle(
-    block        : ct.Block,
-    lp_id        : BlockId,
-    blocks_by_sid: BlockListBySid,
-    dep_map      : DependencyMap,
-    root_id      : BlockId,
-) -> None:
-    cycle_ids = _get_dep_cycle(lp_id, dep_map, root_id=root_id)
-    if not cycle_ids:
-        return
+def _get_cycle_path(scc: list[ScopedBlockId], dep_map: DependencyMap) -> list[ScopedBlockId]:
+    """Shortest path from the first block of an scc back to itself."""
+    scc_ids = set(scc)
+    root_id = next(lp_id for lp_id in dep_map if lp_id in scc_ids)
 
-    cycle_ids = [root_id] + cycle_ids
-    for cycle_id in cycle_ids:
-        cycle_block = blocks_by_sid[cycle_id][0]
-        loc         = parse.location(cycle_block).strip()
-        logger.warning(f"{loc} - {cycle_id} (trace for include cycle)")
+    prev_ids: dict[ScopedBlockId, ScopedBlockId] = {}
+    queue = collections.deque([root_id])
+    while queue:
+        lp_id = queue.popleft()
+        for dep_sid in dep_map.get(lp_id, ()):
+            if dep_sid == root_id:
+                path = [lp_id]
+                while path[-1] != root_id:
+                    path.append(prev_ids[path[-1]])
+                return path[::-1] + [root_id]
+            elif dep_sid in scc_ids and dep_sid not in prev_ids:
+                prev_ids[dep_sid] = lp_id
+                queue.append(dep_sid)
 
-    path   = " -> ".join(f"'{cycle_id}'" for cycle_id in cycle_ids)
-    errmsg = f"dep/include cycle {path}"
-    raise BlockError(errmsg, block)
+    raise KeyError(root_id)
+
+
+def _err_on_dep_cycles(blocks_by_sid: BlockListBySid, dep_map: DependencyMap) -> None:
+    errors: list[BlockError] = []
+    for scc in _iter_dep_cycles(dep_map):
+        cycle_ids = _get_cycle_path(scc, dep_map)
+        for cycle_id in cycle_ids[:-1]:
+            cycle_block = blocks_by_sid[cycle_id][0]
+            loc         = parse.location(cycle_block).strip()
+            logger.warning(f"{loc} - {cycle_id} (trace for include cycle)")
+
+        path   = " -> ".join(f"'{cycle_id}'" for cycle_id in cycle_ids)
+        errmsg = f"dep/include cycle {path}"
+        logger.error(errmsg)
+        errors.append(BlockError(errmsg, blocks_by_sid[cycle_ids[0]][0]))
+
+    if errors:
+        raise errors[0]
+
+
+class _Expansion(typ.NamedTuple):
+    """A memoized expansion of a (non-fenced) def block.
+
+    The expansion of a block depends on which dep ids were already
+    added by the block that includes it. It is only valid for reuse
+    if the same subset of its touched_ids was added beforehand.
+    """
+
+    touched_ids: frozenset[ScopedBlockId]
+    seen_ids   : frozenset[ScopedBlockId]
+    added_ids  : frozenset[ScopedBlockId]
+    content    : str
+    md_paths   : frozenset[Path]
+
+
+ExpansionKey = tuple[Path, int]
+
+
+class ExpansionCache:
+    """Expansions of def blocks, valid for the duration of one build."""
+
+    sid_index : BlockIdIndex
+    expansions: dict[ExpansionKey, list[_Expansion]]
+    indented  : dict[tuple[str, str], str]
+
+    def __init__(self, sid_index: BlockIdIndex) -> None:
+        self.sid_index  = sid_index
+        self.expansions = {}
+        self.indented   = {}
+
+    def match_indent(self, directive_text: str, include_val: str) -> str:
+        indent = _directive_indent(directive_text)
+        if not indent:
+            return include_val
+
+        # NOTE: include_val is usually the content of an _Expansion,
+        #   so its hash is already cached by the str object.
+        key = (indent, include_val)
+        if key not in self.indented:
+            self.indented[key] = _match_indent(directive_text, include_val)
+        return self.indented[key]
+
+
+# A chunk of expanded content and whether it is included content.
+# Directive texts are only searched for in non-included chunks.
+Chunk = tuple[str, bool]
+
+DIRECTIVE_TEXT_RE = re.compile(r"(?:dep|include)\s*:")
+
+
+def _splice_chunks(
+    chunks        : list[Chunk],
+    directive_text: str,
+    include_val   : str,
+    is_dep        : bool,
+) -> list[Chunk]:
+    # NOTE: This is equivalent to _indented_include, except that the
+    #   content is not copied for every directive.
+    if not include_val:
+        return [
+            (text if is_included else text.replace(directive_text, ""), is_included)
+            for text, is_included in chunks
+        ]
+
+    is_first     = True
+    new_chunks: list[Chunk] = []
+    for text, is_included in chunks:
+        if is_included or directive_text not in text:
+            new_chunks.append((text, is_included))
+        elif is_dep:
+            if is_first:
+                # dependencies are only included once (at the first occurance of a dep directive)
+                head, _, tail = text.partition(directive_text)
+                new_chunks.append((head, False))
+                new_chunks.append((include_val, True))
+                new_chunks.append((tail.replace(directive_text, ""), False))
+                is_first = False
+            else:
+                new_chunks.append((text.replace(directive_text, ""), False))
+        else:
+            for i, part in enumerate(text.split(directive_text)):
+                if i > 0:
+                    new_chunks.append((include_val, True))
+                new_chunks.append((part, False))
+    return new_chunks
+
+
+def _has_directive_text(content: str, directive_texts: list[str]) -> bool:
+    if DIRECTIVE_TEXT_RE.search(content) is None:
+        return False
+    return any(directive_text in content for directive_text in set(directive_texts))
+
+
+def _expand_dep_block(
+    blocks_by_sid: BlockListBySid,
+    dep_block    : ct.Block,
+    added_deps   : set[str],
+    cache        : ExpansionCache,
+    touched_ids  : set[str],
+    added_ids    : set[str],
+    lvl          : int,
+) -> tuple[str, frozenset[Path]]:
+    key     = (dep_block.md_path, dep_block.elem_index)
+    entries = cache.expansions.setdefault(key, [])
+    for entry in entries:
+        if added_deps & entry.touched_ids == entry.seen_ids:
+            added_deps.update(entry.added_ids)
+            touched_ids.update(entry.touched_ids)
+            added_ids.update(entry.added_ids)
+            return (entry.content, entry.md_paths)
+
+    sub_touched_ids: set[str] = set()
+    sub_added_ids  : set[str] = set()
+    content, md_paths = _expand_block_content(
+        blocks_by_sid,
+        dep_block,
+        added_deps,
+        keep_fence=False,
+        lvl=lvl,
+        cache=cache,
+        touched_ids=sub_touched_ids,
+        added_ids=sub_added_ids,
+    )
+    # Every added id was touched before it was added, so any touched id
+    # that was not added by this expansion must have been added before.
+    entry = _Expansion(
+        touched_ids=frozenset(sub_touched_ids),
+        seen_ids=frozenset(sub_touched_ids - sub_added_ids),
+        added_ids=frozenset(sub_added_ids),
+        content=content,
+        md_paths=frozenset(md_paths),
+    )
+    entries.append(entry)
+    touched_ids.update(entry.touched_ids)
+    added_ids.update(entry.added_ids)
+    return (entry.content, entry.md_paths)
 
 
 def _expand_block_content(
     blocks_by_sid: BlockListBySid,
     block        : ct.Block,
     added_deps   : set[str],
-    dep_map      : DependencyMap,
     keep_fence   : bool,
     lvl          : int = 1,
+    cache        : typ.Optional[ExpansionCache] = None,
+    touched_ids  : typ.Optional[set[str]] = None,
+    added_ids    : typ.Optional[set[str]] = None,
 ) -> tuple[str, set[Path]]:
     # NOTE (mb 2020-12-20): Depth first expansion of content.
     #   This ensures that the first occurance of an dep
     #   directive is expanded at the earliest possible point
     #   even if it is a recursive dep.
-    def_ = get_directive(block, 'def', missing_ok=True, many_ok=False)
+    # NOTE: There are no cycles to check for here, they have
+    #   already been reported by _err_on_dep_cycles.
+    if cache is None:
+        cache = ExpansionCache(BlockIdIndex(blocks_by_sid))
+    if touched_ids is None:
+        touched_ids = set()
+    if added_ids is None:
+        added_ids = set()
 
     new_md_paths = {block.md_path}
 
     if keep_fence:
-        new_content = block.content
+        orig_content = block.content
     else:
-        new_content = block.includable_content + "\n"
+        orig_content = block.includable_content + "\n"
+
+    chunks  : list[Chunk] = [(orig_content, False)]
+    includes: list[tuple[str, str, bool]] = []
 
     for directive in iter_directives(block, 'dep', 'include'):
         is_dep = directive.name == 'dep'
@@ -258,65 +525,108 @@ def _expand_block_content(
         for raw_dep_sid in directive.value.split(","):
             raw_dep_sid = _namespaced_lp_id(block, raw_dep_sid)
 
-            dep_sids = list(_resolve_dep_sids(raw_dep_sid, blocks_by_sid))
+            dep_sids = _resolve_dep_sids(raw_dep_sid, cache.sid_index)
             if not dep_sids:
                 # TODO (mb 2021-07-18): pylev for better message:
                 #   "Maybe you meant {closest_sids}"
                 raise BlockError(f"Invalid block id: {raw_dep_sid}", block)
 
             for dep_sid in dep_sids:
-                if def_:
-                    def_id = _namespaced_lp_id(block, def_.value)
-                    _err_on_include_cycle(block, dep_sid, blocks_by_sid, dep_map, root_id=def_id)
-
                 if is_dep:
+                    touched_ids.add(dep_sid)
                     if dep_sid in added_deps:
                         # skip already included dependencies
                         continue
                     else:
                         added_deps.add(dep_sid)
+                        added_ids.add(dep_sid)
 
                 for dep_block in blocks_by_sid[dep_sid]:
-                    dep_content, dep_md_paths = _expand_block_content(
+                    dep_content, dep_md_paths = _expand_dep_block(
                         blocks_by_sid,
                         dep_block,
                         added_deps,
-                        dep_map,
-                        keep_fence=False,
+                        cache,
+                        touched_ids,
+                        added_ids,
                         lvl=lvl + 1,
                     )
-                    dep_content = _match_indent(directive.raw_text, dep_content)
+                    dep_content = cache.match_indent(directive.raw_text, dep_content)
                     dep_contents.append(dep_content)
                     new_md_paths.update(dep_md_paths)
 
         include_content = "".join(dep_contents)
         dep_text        = directive.raw_text.lstrip("\n")
-        new_content     = _indented_include(new_content, dep_text, include_content, is_dep=is_dep)
+        chunks          = _splice_chunks(chunks, dep_text, include_content, is_dep=is_dep)
+        includes.append((dep_text, include_content, is_dep))
+
+    new_content = "".join(text for text, _ in chunks)
+
+    # NOTE: Chunks of included content are not searched for directive
+    #   texts. In the unlikely case that included content contains the
+    #   text of a directive, we fall back to plain str.replace, so that
+    #   the output is the same as it always was.
+    if includes and _has_directive_text(new_content, [dep_text for dep_text, _, _ in includes]):
+        new_content = orig_content
+        for dep_text, include_content, is_dep in includes:
+            new_content = _indented_include(new_content, dep_text, include_content, is_dep=is_dep)
 
     return (new_content, new_md_paths)
 
 
-def _expand_directives(blocks_by_sid: BlockListBySid, chapter: parse.Chapter) -> parse.Chapter:
+# Only blocks with these directives are consumed with their expanded
+# content: 'file' blocks are written, exec/run blocks are executed and
+# the headers of 'out' blocks are rendered by the Runner. The html
+# output is generated from the unexpanded chapters.
+CONSUMER_DIRECTIVES = ('file', 'exec', 'run', 'out')
+
+
+def _is_consumed(block: ct.Block) -> bool:
+    return any(directive.name in CONSUMER_DIRECTIVES for directive in block.directives)
+
+
+def _validate_dep_sids(sid_index: BlockIdIndex, block: ct.Block) -> None:
+    for raw_dep_sid in _iter_directive_sids(block, 'dep', 'include'):
+        if not any(_resolve_dep_sids(raw_dep_sid, sid_index)):
+            raise BlockError(f"Invalid block id: {raw_dep_sid}", block)
+
+
+def _expand_directives(
+    blocks_by_sid: BlockListBySid,
+    chapter      : parse.Chapter,
+    cache        : ExpansionCache,
+) -> parse.Chapter:
+    # NOTE: Only consumed blocks are expanded. Blocks which are only
+    #   used via dep/include are expanded on demand, at most once for
+    #   each set of previously added deps (see _expand_dep_block).
     new_chapter = chapter.copy()
-    dep_map     = _build_dep_map(blocks_by_sid)
 
     for block in list(new_chapter.iter_blocks()):
+        if not _is_consumed(block):
+            # NOTE: Invalid ids are reported, even if the block is never
+            #   expanded. The ids of blocks with a def directive were
+            #   already resolved by _build_dep_map, so only the (rare)
+            #   blocks without a def need to be validated here.
+            if get_directive(block, 'def') is None:
+                _validate_dep_sids(cache.sid_index, block)
+            continue
+
         added_deps: set[str] = set()
         new_content, new_md_paths = _expand_block_content(
-            blocks_by_sid, block, added_deps, dep_map, keep_fence=True
+            blocks_by_sid, block, added_deps, keep_fence=True, cache=cache
         )
         if new_content != block.content:
-            elements = new_chapter.elements[block.md_path]
-            elem     = elements[block.elem_index]
-
-            elements[block.elem_index] = parse.MarkdownElement(
-                elem.md_path,
-                elem.first_line,
-                elem.elem_index,
-                elem.md_type,
-                new_content,
-                None,
-                new_md_paths | {elem.md_path},
+            elem = new_chapter.elements[block.md_path][block.elem_index]
+            new_chapter.replace_element(
+                parse.MarkdownElement(
+                    elem.md_path,
+                    elem.first_line,
+                    elem.elem_index,
+                    elem.md_type,
+                    new_content,
+                    None,
+                    new_md_paths | {elem.md_path},
+                )
             )
 
     return new_chapter
@@ -326,9 +636,10 @@ def _get_blocks_by_id(chapters: Chapters) -> BlockListBySid:
     blocks_by_sid: BlockListBySid = {}
 
     for chapter in chapters:
-        for block in chapter.iter_blocks():
-            lp_def = get_directive(block, 'def', missing_ok=True, many_ok=False)
-            if lp_def:
+        for def_blocks in chapter.block_index().blocks_by_def_id.values():
+            for block in def_blocks:
+                lp_def = get_directive(block, 'def', missing_ok=False, many_ok=False)
+                assert lp_def is not None
                 lp_def_id = lp_def.value
                 if "." in lp_def_id and not lp_def_id.startswith(block.namespace + "."):
                     errmsg = f"Invalid block id: {lp_def_id} for namespace {block.namespace}"
@@ -372,9 +683,14 @@ def _iter_expanded_chapters(chapters: Chapters) -> ExpandedChapters:
     # NOTE (mb 2020-05-31): block ids are always absulute/fully qualified
     blocks_by_sid = _get_blocks_by_id(chapters)
 
-    # pass 2. expand dep directives in markdown files
+    sid_index = BlockIdIndex(blocks_by_sid)
+    dep_map   = _build_dep_map(blocks_by_sid, sid_index)
+    _err_on_dep_cycles(blocks_by_sid, dep_map)
+
+    # pass 2. expand dep directives of consumed blocks in markdown files
+    cache = ExpansionCache(sid_index)
     for chapter in chapters:
-        yield _expand_directives(blocks_by_sid, chapter)
+        yield _expand_directives(blocks_by_sid, chapter, cache)
 
 
 def _iter_block_errors(parse_ctx: parse.Context, build_ctx: parse.Context) -> typ.Iterable[str]:
@@ -391,6 +707,9 @@ def _iter_block_errors(parse_ctx: parse.Context, build_ctx: parse.Context) -> ty
             assert len(orig_chapter.elements[md_path]) == len(chapter.elements[md_path])
 
         for block in chapter.iter_blocks():
+            if not _is_consumed(block):
+                continue
+
             orig_elem = orig_chapter.elements[block.md_path][block.elem_index]
             for directive in block.directives:
                 if directive.name in ('dep', 'include'):
@@ -413,43 +732,103 @@ def _iter_block_errors(parse_ctx: parse.Context, build_ctx: parse.Context) -> ty
                     )
 
 
-def _dump_files(build_ctx: parse.Context) -> None:
-    # NOTE (mb 2021-08-27): We use the most recent md_mtime of all
-    #   files, as they might contain a block that is
-    #   dep(ed)/includ(ed) by a 'file' block. This is conservative and
-    #   we could improve this if we would keep track of the input md
-    #   files used to create an output file.
-    md_mtimes = {
-        md_path: md_path.stat().st_mtime for chapter in build_ctx.chapters for md_path in chapter.md_paths
-    }
-    md_mtime = max(md_mtimes.values())
-
+def _iter_file_blocks(build_ctx: parse.Context) -> typ.Iterable[tuple[ct.Block, Path]]:
+    """Blocks with a 'file' directive and their output path."""
     for chapter in build_ctx.chapters:
         for block in chapter.iter_blocks():
             file_directive = get_directive(block, 'file')
-            if file_directive is None:
-                continue
+            if file_directive is not None:
+                yield (block, Path(file_directive.value))
 
-            md_elem  = chapter.elements[block.md_path][block.elem_index]
-            md_mtime = max(md_mtimes[md_path] for md_path in md_elem.src_md_paths)
 
-            file_path = Path(file_directive.value)
+def _dump_file(file_path: Path, content: str, file_index: typ.Optional[index.Index]) -> bool:
+    """Write content to file_path, unless the file already has that content.
 
-            # see if we can skip updating the output file
-            if file_path.exists() and md_mtime <= file_path.stat().st_mtime:
-                continue
+    With a file_index, the output is compared by the digest of the
+    (expanded) content of the block which produced it, so that the file
+    on disk doesn't even have to be read if it is unchanged since it
+    was last written.
+    """
+    new_content_data = content.encode("utf-8")
+    if file_index is None:
+        if file_path.exists():
+            with file_path.open(mode="rb") as fobj:
+                old_content_data = fobj.read()
+
+            if old_content_data == new_content_data:
+                return False
+
+        _write_file_atomic(file_path, new_content_data)
+        return True
+
+    new_digest = index.content_digest(new_content_data)
+    if file_index.digest(file_path) == new_digest:
+        return False
+
+    _write_file_atomic(file_path, new_content_data)
+    file_index.set_digest(file_path, new_digest)
+    return True
 
-            new_content_data = block.includable_content.encode("utf-8")
-            if file_path.exists():
-                with file_path.open(mode="rb") as fobj:
-                    old_content_data = fobj.read()
 
-                if old_content_data == new_content_data:
-                    continue
+def _read_umask() -> int:
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
 
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            with file_path.open(mode="wb") as fobj:
-                fobj.write(new_content_data)
+
+# NOTE: mkstemp creates files with mode 0o600, new outputs get the
+#   same mode as with open(mode="w"). The umask can only be read by
+#   setting it, which is done once, as it is not thread safe.
+NEW_FILE_MODE = 0o666 & ~_read_umask()
+
+
+def _write_file_atomic(file_path: Path, data: bytes) -> None:
+    # NOTE: The file is written to a temporary file first, so that a
+    #   concurrent reader (e.g. a run task of another build or an
+    #   editor) never sees a partially written file. The temporary
+    #   file is unique, as outputs are written by multiple threads.
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fd, tmp_name = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(tmp_fd, mode="wb") as fobj:
+            fobj.write(data)
+        if file_path.exists():
+            shutil.copymode(file_path, tmp_path)
+        else:
+            os.chmod(tmp_path, NEW_FILE_MODE)
+        tmp_path.replace(file_path)
+    except BaseException:
+        tmp_path.unlink()
+        raise
+
+
+def _dump_files(
+    build_ctx : parse.Context,
+    file_index: typ.Optional[index.Index] = None,
+    workers   : int = 1,
+) -> None:
+    # NOTE: If multiple blocks write to the same file, the last one wins.
+    contents_by_path = {
+        file_path: block.includable_content for block, file_path in _iter_file_blocks(build_ctx)
+    }
+
+    max_workers = min(workers, len(contents_by_path))
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_dump_file, file_path, content, file_index)
+                for file_path, content in contents_by_path.items()
+            ]
+            # NOTE: .result() to propagate any error
+            written = [future.result() for future in futures]
+    else:
+        written = [
+            _dump_file(file_path, content, file_index) for file_path, content in contents_by_path.items()
+        ]
+
+    if any(written):
+        logger.info(f"Wrote {sum(written)} of {len(written)} files")
 
 
 def _parse_out_fmt(block: ct.Block, directive_name: str, default_fmt: str) -> str:
@@ -548,6 +927,7 @@ def _parse_session_block_options(block: ct.Block) -> typ.Optional[ct.SessionBloc
 
     _provides = get_directive(block, 'def')
     _requires = get_directive(block, 'requires')
+    _inputs   = get_directive(block, 'inputs')
 
     provides_id : typ.Optional[str] = None
     if _provides:
@@ -559,6 +939,11 @@ def _parse_session_block_options(block: ct.Block) -> typ.Optional[ct.SessionBloc
     else:
         requires_ids = set()
 
+    if _inputs:
+        input_globs = [input_glob.strip() for input_glob in _inputs.value.split(",") if input_glob.strip()]
+    else:
+        input_globs = []
+
     _options = get_directive(block, 'options')
     options  = json.loads(_options.value) if _options else {}
 
@@ -575,6 +960,7 @@ def _parse_session_block_options(block: ct.Block) -> typ.Optional[ct.SessionBloc
         directive=directive,
         provides_id=provides_id,
         requires_ids=requires_ids,
+        input_globs=input_globs,
         timeout=options['timeout'],
         input_delay=options['input_delay'],
         expected_exit_status=options['expect'],
@@ -670,11 +1056,26 @@ Tempfile = typ.Optional[typ.Any]
 Command  = str
 
 
-def _init_isession(opts: ct.SessionBlockOptions, command: Command) -> session.InteractiveSession:
+ForkServers = typ.Optional[forkserver.ForkServerPool]
+
+
+def _init_isession(
+    opts          : ct.SessionBlockOptions,
+    command       : Command,
+    session_engine: str = session.DEFAULT_SESSION_ENGINE,
+    forkservers   : ForkServers = None,
+) -> session.InteractiveSession:
     if opts.is_debug:
         return session.DebugInteractiveSession(command)
-    else:
-        return session.InteractiveSession(command)
+
+    spawn: typ.Optional[session.Spawn] = None
+    if forkservers and opts.directive == 'exec':
+        server = forkservers.get(command)
+        if server:
+            spawn = server.spawn
+
+    session_class = session.SESSION_ENGINES[session_engine]
+    return session_class(command, spawn=spawn)
 
 
 def _init_command(opts: ct.SessionBlockOptions) -> tuple[Tempfile, Command]:
@@ -695,16 +1096,18 @@ def _init_command(opts: ct.SessionBlockOptions) -> tuple[Tempfile, Command]:
 
 
 def _process_isession(
-    block      : ct.Block,
-    opts       : ct.SessionBlockOptions,
-    command    : str,
-    stdin_lines: list[str],
+    block         : ct.Block,
+    opts          : ct.SessionBlockOptions,
+    command       : str,
+    stdin_lines   : list[str],
+    session_engine: str = session.DEFAULT_SESSION_ENGINE,
+    forkservers   : ForkServers = None,
 ) -> session.Capture:
     _cmd   = command if len(command) < 35 else (command[:35] + "...")
     logmsg = f"Line {block.first_line:>5} of {block.md_path} - {opts.directive} {_cmd}"
     logger.info(logmsg)
 
-    isession = _init_isession(opts, command)
+    isession = _init_isession(opts, command, session_engine, forkservers)
 
     for line in stdin_lines:
         isession.send(line, delay=opts.input_delay)
@@ -747,8 +1150,10 @@ def _process_isession(
 
 
 def _process_command_block(
-    block: ct.Block,
-    opts : ct.SessionBlockOptions,
+    block         : ct.Block,
+    opts          : ct.SessionBlockOptions,
+    session_engine: str = session.DEFAULT_SESSION_ENGINE,
+    forkservers   : ForkServers = None,
 ) -> session.Capture:
     tmp, command = _init_command(opts)
 
@@ -767,7 +1172,7 @@ def _process_command_block(
         stdin_lines = []
 
     try:
-        return _process_isession(block, opts, command, stdin_lines)
+        return _process_isession(block, opts, command, stdin_lines, session_engine, forkservers)
     finally:
         if tmp:
             os.unlink(tmp.name)
@@ -800,13 +1205,128 @@ def _iter_block_tasks(chapter: parse.Chapter) -> typ.Iterable[ct.BlockTask]:
 
 ChapNum = str
 
+TaskIndex = int
+
+
+class TaskGraph(typ.NamedTuple):
+    # tasks which are waiting for a task (by index)
+    dependents: list[list[TaskIndex]]
+    # number of providers that a task is waiting for
+    num_requires: list[int]
+
+
+def _build_task_graph(tasks: list[ct.BlockTask]) -> TaskGraph:
+    """Build the graph of requires -> provides relationships between tasks.
+
+    Any task that has a requires directive for which there is no provider,
+    or which is part of a requires cycle, will never become ready. This
+    is detected after all other tasks have been processed.
+    """
+    # NOTE: Since a def id can only be declared once, every
+    #   requires id has at most one provider. Wildcards are
+    #   expanded beforehand by _resolve_requires_ids.
+    providers: dict[str, TaskIndex] = {}
+    for task_idx, task in enumerate(tasks):
+        if task.opts.provides_id:
+            providers[task.opts.provides_id] = task_idx
+
+    dependents  : list[list[TaskIndex]] = [[] for _ in tasks]
+    num_requires: list[int] = [0] * len(tasks)
+
+    for task_idx, task in enumerate(tasks):
+        for require_id in sorted(task.opts.requires_ids):
+            provider_idx = providers.get(require_id)
+            if provider_idx is not None:
+                dependents[provider_idx].append(task_idx)
+            # else: can never be satisfied
+            num_requires[task_idx] += 1
+
+    return TaskGraph(dependents, num_requires)
+
+
+def _resolve_requires_ids(tasks: list[ct.BlockTask]) -> list[ct.BlockTask]:
+    """Expand wildcard requires ids to the ids of the matching providers.
+
+    A wildcard, such as 'utils.*', waits for every task that provides a
+    matching id (excluding the task itself). Ids without any provider
+    are kept, so that they are reported as unsatisfied.
+    """
+    provider_index = BlockIdIndex(task.opts.provides_id for task in tasks if task.opts.provides_id)
+
+    resolved_tasks: list[ct.BlockTask] = []
+    for task in tasks:
+        requires_ids: set[str] = set()
+        for require_id in task.opts.requires_ids:
+            provider_ids = [
+                provider_id
+                for provider_id in provider_index.resolve(require_id)
+                if provider_id != task.opts.provides_id
+            ]
+            requires_ids.update(provider_ids or [require_id])
+
+        if requires_ids != task.opts.requires_ids:
+            task = task._replace(opts=task.opts._replace(requires_ids=requires_ids))
+        resolved_tasks.append(task)
+    return resolved_tasks
+
+
+def _critical_path_ranks(graph: TaskGraph, costs: list[float]) -> list[float]:
+    """Calculate the length of the longest path from each task to the end of the build.
+
+    Tasks with a higher rank are on a longer chain of dependent tasks
+    and should be started first to minimize the total build time.
+    """
+    ranks: list[float] = list(costs)
+
+    # Kahn's algorithm over the reversed graph, so that the
+    # rank of every dependent is final before it is used.
+    num_dependents = [len(dependents) for dependents in graph.dependents]
+    providers_of: list[list[TaskIndex]] = [[] for _ in costs]
+    for provider_idx, dependents in enumerate(graph.dependents):
+        for dependent_idx in dependents:
+            providers_of[dependent_idx].append(provider_idx)
+
+    stack = [task_idx for task_idx, num in enumerate(num_dependents) if num == 0]
+    while stack:
+        task_idx = stack.pop()
+        for provider_idx in providers_of[task_idx]:
+            ranks[provider_idx] = max(ranks[provider_idx], costs[provider_idx] + ranks[task_idx])
+            num_dependents[provider_idx] -= 1
+            if num_dependents[provider_idx] == 0:
+                stack.append(provider_idx)
+
+    return ranks
+
+
+# Costs used for critical path ranks, in milliseconds.
+# NOTE: A session already terminates its subprocess after the timeout
+#   of the task. The grace period is for the collection of its output,
+#   so that only a task which is truly stuck fails the build.
+TASK_TIMEOUT_GRACE = 2 * session.CAPTURE_JOIN_TIMEOUT
+
+MIN_TASK_COST     = 1.0
+DEFAULT_TASK_COST = 100.0
+
+
+class SchedulerStats(typ.NamedTuple):
+
+    num_tasks   : int
+    max_running : int
+    peak_running: int
+    busy_time   : float
+    wall_time   : float
+
 
 class BuildOptions(typ.NamedTuple):
 
-    exitfirst      : bool
-    in_place_update: bool
-    cache_enabled  : bool
-    concurrency    : int
+    exitfirst         : bool
+    in_place_update   : bool
+    cache_enabled     : bool
+    concurrency       : int
+    session_engine    : str = session.DEFAULT_SESSION_ENGINE
+    forkserver        : bool = False
+    forkserver_preload: tuple[str, ...] = ()
+    remote_cache      : typ.Optional[str] = None
 
 
 class Runner:
@@ -822,13 +1342,17 @@ class Runner:
     _task_results   : list[tuple[ct.BlockTask, session.Capture]]
     _cached_tasks   : list[ct.BlockTask]
 
-    _cache: capture_cache.ResultCache
+    _cache      : capture_cache.ResultCache
+    _forkservers: ForkServers
+
+    stats: typ.Optional[SchedulerStats]
 
     def __init__(
         self,
         orig_chapters : Chapters,
         build_chapters: Chapters,
         opts          : BuildOptions,
+        file_index    : typ.Optional[index.Index] = None,
     ) -> None:
         self.orig_chapters  = orig_chapters
         self.build_chapters = build_chapters
@@ -845,16 +1369,25 @@ class Runner:
         self._task_results    = []
         self._cached_tasks    = []
 
-        if self.opts.cache_enabled:
-            self._cache = capture_cache.LocalResultCache(self.orig_chapters)
+        self.stats        = None
+        self._forkservers = None
+
+        if self.opts.cache_enabled and self.opts.remote_cache:
+            self._cache = remote_cache.RemoteResultCache(self.orig_chapters, self.opts.remote_cache)
+        elif self.opts.cache_enabled:
+            self._cache = capture_cache.SQLiteResultCache(self.orig_chapters)
         else:
             self._cache = capture_cache.DummyCache()
 
+        self._cache.file_index = file_index
+
         for chapter in self.build_chapters:
             for md_path in chapter.md_paths:
                 self._chapter_by_path[md_path] = chapter
             self._all_tasks.extend(_iter_block_tasks(chapter))
 
+        self._all_tasks = _resolve_requires_ids(self._all_tasks)
+
     def _run_task(self, task: ct.BlockTask) -> None:
         capture_file = task.opts.capture_file
 
@@ -870,7 +1403,9 @@ class Runner:
             self._cached_tasks.append(task)
             capture = cached_capture
         else:
-            capture = _process_command_block(task.block, task.opts)
+            capture = _process_command_block(
+                task.block, task.opts, self.opts.session_engine, self._forkservers
+            )
             self._cache.update(task, capture)
             if capture_file:
                 if not capture_file.parent.exists():
@@ -920,44 +1455,125 @@ class Runner:
                 md_path: updated_elements.get((chapter.chapnum, md_path), []) for md_path in chapter.md_paths
             }
 
+    def _estimate_costs(self) -> list[float]:
+        """Estimate the runtime of each task (in ms) based on previous builds.
+
+        Tasks with a cached result are assumed to be (almost) free. Tasks
+        for which no estimate is available, are assumed to be typical,
+        i.e. to take the median runtime of the tasks which do have an
+        estimate.
+        """
+        estimates: list[typ.Optional[float]] = []
+        for task in self._all_tasks:
+            runtime_ms = self._cache.estimate_runtime_ms(task)
+            if runtime_ms is None:
+                estimates.append(None)
+            elif self.opts.cache_enabled and not task.opts.requires_ids and self._cache.get_entry(task):
+                estimates.append(MIN_TASK_COST)
+            else:
+                estimates.append(max(MIN_TASK_COST, float(runtime_ms)))
+
+        known_estimates = sorted(est for est in estimates if est is not None)
+        if known_estimates:
+            default_cost = known_estimates[len(known_estimates) // 2]
+        else:
+            default_cost = DEFAULT_TASK_COST
+
+        return [default_cost if est is None else est for est in estimates]
+
     def _start(self, submit_task: typ.Callable[[ct.BlockTask], Future]) -> None:
-        provided_ids        : set[str] = set()
-        remaining_tasks     : list[ct.BlockTask] = list(self._all_tasks)
-        prev_remaining_tasks: list[ct.BlockTask] = []
-        num_completed = 0
+        tasks = self._all_tasks
+        graph = _build_task_graph(tasks)
+
+        is_serial = self.opts.concurrency == 1 or self.opts.exitfirst
+        if is_serial:
+            # NOTE: For serial execution the order makes no
+            #   difference to the total runtime, so we stick to the order
+            #   of declaration, which is what authors usually expect.
+            priorities = [float(-task_idx) for task_idx in range(len(tasks))]
+        else:
+            priorities = _critical_path_ranks(graph, self._estimate_costs())
 
-        while remaining_tasks:
-            if remaining_tasks == prev_remaining_tasks:
-                for task in remaining_tasks:
-                    logger.error(f"Task with unsatisfied requires: {task.opts.requires_ids}")
-                raise RuntimeError("No progress made processing block tasks")
-            else:
-                prev_remaining_tasks = remaining_tasks
+        num_pending = list(graph.num_requires)
+        max_running = 1 if is_serial else max(1, self.opts.concurrency)
 
-            defered_tasks: list[ct.BlockTask] = []
-            futures      : list[tuple[Future, ct.BlockTask]] = []
+        # heap of ready tasks, ordered by priority (highest first) and then
+        # by order of declaration
+        ready: list[tuple[float, TaskIndex]] = [
+            (-priorities[task_idx], task_idx) for task_idx in range(len(tasks)) if num_pending[task_idx] == 0
+        ]
+        heapq.heapify(ready)
 
-            for task in remaining_tasks:
-                if task.opts.requires_ids <= provided_ids:
-                    future = submit_task(task)
-                    futures.append((future, task))
-                else:
-                    defered_tasks.append(task)
+        running: dict[Future, tuple[TaskIndex, float]] = {}
 
-            for future, task in futures:
-                future.result(timeout=task.opts.timeout)
+        busy_time     = 0.0
+        peak_running  = 0
+        num_completed = 0
+        sched_start   = time.time()
+
+        while ready or running:
+            while ready and len(running) < max_running:
+                _, task_idx = heapq.heappop(ready)
+                future      = submit_task(tasks[task_idx])
+                running[future] = (task_idx, time.time())
+                peak_running    = max(peak_running, len(running))
+
+            deadlines = {
+                task_idx: task_start + tasks[task_idx].opts.timeout + TASK_TIMEOUT_GRACE
+                for task_idx, task_start in running.values()
+            }
+            timeout = max(0.0, min(deadlines.values()) - time.time())
+            done, _ = wait_futures(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                task = tasks[min(deadlines, key=deadlines.__getitem__)]
+                raise BlockTimeoutError(f"Task did not complete: {task.md_path}:{task.block.first_line}")
+
+            for future in done:
+                task_idx, task_start = running.pop(future)
+                future.result()
+                busy_time     += time.time() - task_start
                 num_completed += 1
-                if task.opts.provides_id:
-                    provided_ids.add(task.opts.provides_id)
 
-            remaining_tasks = defered_tasks
+                # start dependent tasks as soon as their last provider is done
+                for dependent_idx in graph.dependents[task_idx]:
+                    num_pending[dependent_idx] -= 1
+                    if num_pending[dependent_idx] == 0:
+                        heapq.heappush(ready, (-priorities[dependent_idx], dependent_idx))
+
+        if num_completed < len(tasks):
+            for task_idx, task in enumerate(tasks):
+                if num_pending[task_idx] > 0:
+                    logger.error(f"Task with unsatisfied requires: {task.opts.requires_ids}")
+            raise RuntimeError("No progress made processing block tasks")
+
+        wall_time  = time.time() - sched_start
+        self.stats = SchedulerStats(
+            num_tasks=len(tasks),
+            max_running=max_running,
+            peak_running=peak_running,
+            busy_time=busy_time,
+            wall_time=wall_time,
+        )
 
         total  = len(self._all_tasks)
         cached = len(self._cached_tasks)
         logger.info(f"Completed tasks: {num_completed} of {total} ({cached} cached)")
+        if total > 0 and wall_time > 0:
+            avg_running = busy_time / wall_time
+            utilization = avg_running / max_running
+            logger.info(
+                f"Concurrency: peak {peak_running} of {max_running}, "
+                f"average {avg_running:.2f} ({utilization:.0%} utilization)"
+            )
 
     def start(self) -> None:
+        if self.opts.forkserver:
+            self._forkservers = forkserver.ForkServerPool(self.opts.forkserver_preload)
+
         try:
+            if self.opts.cache_enabled:
+                self._cache.prefetch(self._all_tasks)
+
             if self.opts.concurrency > 1 and self.opts.exitfirst:
                 logger.warning("Incompatible --concurrency > 1 and --exit-first")
                 logger.warning("    Fallback to --concurrency=1")
@@ -972,19 +1588,47 @@ class Runner:
 
                 self._start(submit)
             else:
-                with ThreadPoolExecutor(max_workers=self.opts.concurrency) as executor:
+                executor = ThreadPoolExecutor(max_workers=self.opts.concurrency)
 
-                    def submit(task: ct.BlockTask) -> Future:
-                        return executor.submit(self._run_task, task)
+                def submit(task: ct.BlockTask) -> Future:
+                    return executor.submit(self._run_task, task)
 
+                try:
                     self._start(submit)
+                finally:
+                    # NOTE: Don't wait for the remaining tasks if a task
+                    #   failed or timed out, one of them may never complete.
+                    executor.shutdown(wait=False, cancel_futures=True)
             self._postprocess_captures()
         finally:
             self._cache.flush()
+            if self._forkservers:
+                self._forkservers.close()
 
     def wait(self) -> None:
         pass
 
+    def plan_tasks(self) -> typ.Optional[list[build_plan.PlanTask]]:
+        plan_tasks: list[build_plan.PlanTask] = []
+        for task in self._all_tasks:
+            try:
+                task_key = self._cache.task_key(task)
+            except KeyError:
+                # the provider of a requires was neither run nor cached
+                return None
+
+            capture_file = task.opts.capture_file
+            plan_task    = build_plan.PlanTask(
+                md_path=build_plan.path_key(task.md_path),
+                task_key=task_key,
+                capture_index=task.capture_index,
+                capture_file=build_plan.path_key(capture_file) if capture_file else None,
+                input_states=capture_cache.task_input_states(task, self._cache.file_index),
+                input_globs=capture_cache.task_input_globs(task),
+            )
+            plan_tasks.append(plan_task)
+        return plan_tasks
+
 
 def _run_subprocs(parse_ctx: parse.Context, opts: BuildOptions, runner: Runner) -> parse.Context:
     runner.start()
@@ -992,32 +1636,19 @@ def _run_subprocs(parse_ctx: parse.Context, opts: BuildOptions, runner: Runner)
 
     doc_ctx = parse_ctx.copy()
 
-    for chap_idx, orig_chapter in enumerate(parse_ctx.chapters):
-        updated_elements = runner.elements_by_chapnum[orig_chapter.chapnum]
+    for doc_chapter in doc_ctx.chapters:
+        updated_elements = runner.elements_by_chapnum[doc_chapter.chapnum]
 
         # phase 6. rewrite output blocks
-        new_elems_by_path = {}
-        for md_path in orig_chapter.md_paths:
-            orig_elems = orig_chapter.elements[md_path]
-            if md_path in updated_elements:
-                new_elems = list(orig_elems)  # copy
-                for updated_elem in updated_elements[md_path]:
-                    orig_elem = orig_elems[updated_elem.elem_index]
-                    assert "out" in orig_elem.content or "run" in orig_elem.content
-                    new_elems[updated_elem.elem_index] = updated_elem
-                new_elems_by_path[md_path] = new_elems
-            else:
-                new_elems_by_path[md_path] = orig_elems
+        for md_path in doc_chapter.md_paths:
+            for updated_elem in updated_elements.get(md_path, []):
+                orig_elem = doc_chapter.elements[md_path][updated_elem.elem_index]
+                assert "out" in orig_elem.content or "run" in orig_elem.content
+                doc_chapter.replace_element(updated_elem)
 
-        new_chapter = parse.Chapter(
-            orig_chapter.md_paths,
-            orig_chapter.chapnum,
-            orig_chapter.namespace,
-            new_elems_by_path,
-        )
         if opts.in_place_update:
-            for md_path in new_chapter.md_paths:
-                new_file_content = new_chapter.md_content(md_path)
+            for md_path in sorted(doc_chapter.modified):
+                new_file_content = doc_chapter.md_content(md_path)
 
                 with md_path.open(mode="r", encoding="utf-8") as fobj:
                     old_file_content = fobj.read()
@@ -1028,16 +1659,82 @@ def _run_subprocs(parse_ctx: parse.Context, opts: BuildOptions, runner: Runner)
 
                     logger.info(f"Updated {md_path}")
 
-        doc_ctx.chapters[chap_idx] = new_chapter
-
     if not opts.in_place_update:
         logger.info("Update skipped. Use -i/--in-place-update to update 'out' blocks.")
 
     return doc_ctx
 
 
+def _plan_options(opts: BuildOptions) -> dict[str, typ.Any]:
+    return build_plan.plan_options(in_place_update=opts.in_place_update)
+
+
+def _iter_md_paths(ctx: parse.Context) -> typ.Iterable[Path]:
+    for chapter in ctx.chapters:
+        yield from chapter.md_paths
+
+
+def _built_md_state(md_path: Path, built_content: str) -> typ.Optional[build_plan.FileState]:
+    # NOTE: The state must be that of the content the build was based on,
+    #   not of the file as it is now. If the file was modified during the
+    #   build, the plan would otherwise claim that the modification was
+    #   built.
+    try:
+        stat = md_path.stat()
+        with md_path.open(mode='rb') as fobj:
+            data = fobj.read()
+    except FileNotFoundError:
+        return None
+
+    if parse.decode_md_content(data) == built_content:
+        return build_plan.FileState(stat.st_mtime_ns, stat.st_size, index.content_digest(data))
+    else:
+        logger.info(f"Not writing build plan, {md_path} was modified during the build")
+        return None
+
+
+def _init_build_plan(
+    parse_ctx: parse.Context,
+    build_ctx: parse.Context,
+    doc_ctx  : parse.Context,
+    opts     : BuildOptions,
+    runner   : Runner,
+) -> typ.Optional[build_plan.BuildPlan]:
+    created_ns = time.time_ns()
+    plan_tasks = runner.plan_tasks()
+    if plan_tasks is None:
+        return None
+
+    # with --in-place-update, the md files were rewritten from the doc_ctx
+    built_ctx = doc_ctx if opts.in_place_update else parse_ctx
+
+    md_files: dict[str, build_plan.FileState] = {}
+    for chapter in built_ctx.chapters:
+        for md_path in chapter.md_paths:
+            md_state = _built_md_state(md_path, chapter.md_content(md_path))
+            if md_state is None:
+                return None
+            md_files[build_plan.path_key(md_path)] = md_state
+
+    outputs: dict[str, build_plan.FileState] = {}
+    for _, file_path in _iter_file_blocks(build_ctx):
+        output_state = build_plan.file_state(file_path)
+        if output_state is None:
+            return None
+        outputs[build_plan.path_key(file_path)] = output_state
+
+    cache_db = capture_cache.project_cache_dir(parse_ctx.chapters) / capture_cache.DB_FILENAME
+    return build_plan.BuildPlan(
+        options=_plan_options(opts),
+        created_ns=created_ns,
+        md_files=md_files,
+        outputs=outputs,
+        tasks=plan_tasks,
+        cache_db=str(cache_db),
+    )
+
+
 def build(parse_ctx: parse.Context, opts: BuildOptions) -> parse.Context:
-    build_ctx   = parse_ctx.copy()
     build_start = time.time()
 
     try:
@@ -1046,7 +1743,7 @@ def build(parse_ctx: parse.Context, opts: BuildOptions) -> parse.Context:
         # build_ctx      = _expand_constants(build_ctx)
 
         # phase 2: expand dep directives
-        expanded_chapters = list(_iter_expanded_chapters(build_ctx.chapters))
+        expanded_chapters = list(_iter_expanded_chapters(parse_ctx.chapters))
     except BlockError as err:
         # TODO (mb 2020-06-03): print context of block
         contents = err.include_contents or [err.block.content]
@@ -1066,16 +1763,78 @@ def build(parse_ctx: parse.Context, opts: BuildOptions) -> parse.Context:
     if error_messages:
         raise SystemExit(1)
 
+    md_paths = list(_iter_md_paths(parse_ctx))
+
+    if opts.cache_enabled:
+        file_index = capture_cache.open_file_index(parse_ctx.chapters)
+    else:
+        file_index = None
+
     # phase 4. write files with expanded blocks
     #   This has to happen before sub-processes, as those
     #   may use the newly created files.
-    _dump_files(build_ctx)
+    _dump_files(build_ctx, file_index, workers=opts.concurrency)
 
     # phase 5. run sub-processes and update output blocks
-    runner = Runner(parse_ctx.chapters, build_ctx.chapters, opts)
+    runner = Runner(parse_ctx.chapters, build_ctx.chapters, opts, file_index)
     try:
         doc_ctx = _run_subprocs(parse_ctx, opts, runner)
+        if opts.cache_enabled:
+            plan = _init_build_plan(parse_ctx, build_ctx, doc_ctx, opts, runner)
+            if plan:
+                build_plan.dump_plan(md_paths, plan)
         return doc_ctx
     finally:
+        if file_index:
+            dump_file_index(file_index)
         duration = time.time() - build_start
         logger.info(f"Build finished after {duration:9.3f}sec")
+
+
+def dump_file_index(file_index: index.Index) -> None:
+    try:
+        file_index.dump_index()
+    except index.IndexConflictError as err:
+        # the index is only an optimization, the next build will check more files
+        logger.warning(str(err))
+
+
+def _docs_target(kind: str, out_dir: Path, doc_ctx: parse.Context) -> index.Target:
+    # NOTE: The generated documents don't just depend on the md files,
+    #   but on the captured output of their exec/run blocks (which
+    #   may not have been written back to the md files) and on the
+    #   templates of litprog itself.
+    doc_digest = hashlib.sha1(__version__.encode("ascii"))
+    for chapter in doc_ctx.chapters:
+        for md_path in chapter.md_paths:
+            doc_digest.update(chapter.md_content(md_path).encode("utf-8"))
+    return f"{kind}:{index.entry_key(out_dir)}:{doc_digest.hexdigest()}"
+
+
+def _iter_out_dir_files(out_dir: Path) -> typ.Iterable[Path]:
+    for root, _dirnames, filenames in os.walk(out_dir):
+        for filename in filenames:
+            yield Path(root) / filename
+
+
+def is_docs_target_done(file_index: index.Index, kind: str, out_dir: Path, doc_ctx: parse.Context) -> bool:
+    """Check if the html/pdf output in out_dir is up to date for doc_ctx."""
+    out_files = set(_iter_out_dir_files(out_dir))
+    if not out_files:
+        return False
+
+    file_index.check_paths(out_files)
+    return file_index.is_target_done(_docs_target(kind, out_dir, doc_ctx), out_files)
+
+
+def mark_docs_target_done(file_index: index.Index, kind: str, out_dir: Path, doc_ctx: parse.Context) -> None:
+    target        = _docs_target(kind, out_dir, doc_ctx)
+    target_prefix = target.rsplit(":", 1)[0] + ":"
+    # targets of previous versions of the documents are obsolete
+    for prev_target in list(file_index.targets):
+        if prev_target.startswith(target_prefix):
+            del file_index.targets[prev_target]
+
+    out_files = set(_iter_out_dir_files(out_dir))
+    file_index.check_paths(out_files)
+    file_index.mark_target_done(target, out_files)
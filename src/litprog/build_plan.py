@@ -0,0 +1,254 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Persisted build plan, used to skip builds where nothing changed.
+
+A plan is written after each successful build. It records the digests
+of the input markdown files, the digests of the files written for
+'file' blocks, the task keys of all exec/run blocks and the digests of
+their inputs. If none of these have changed since the previous build,
+the build is a no-op and the markdown files don't even have to be parsed.
+
+If anything did change, the build is done in full (with the capture
+cache and the file index avoiding most of the work).
+
+Digests are the same as those of the file index (see index.content_digest),
+which are also used for the task keys.
+
+This module is imported by the cli before anything else, so it should
+only have cheap imports.
+"""
+import os
+import glob
+import json
+import typing as typ
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import pathlib as pl
+
+from . import index
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+PLAN_VERSION = '3'
+
+PLAN_DIR_NAME = "build_plans"
+
+
+class FileState(typ.NamedTuple):
+    mtime_ns: int
+    size    : int
+    digest  : str
+
+
+class PlanTask(typ.NamedTuple):
+    md_path      : str
+    task_key     : str
+    capture_index: int
+    capture_file : typ.Optional[str]
+    # state of paths that were used for the task_key (None for missing paths)
+    input_states: dict[str, typ.Optional[FileState]]
+    # globs of the 'inputs' directive and the paths they matched
+    input_globs: dict[str, list[str]]
+
+
+class BuildPlan(typ.NamedTuple):
+    options: dict[str, typ.Any]
+    # time.time_ns() before any of the file states were taken
+    created_ns: int
+    md_files  : dict[str, FileState]
+    # files written for 'file' blocks
+    outputs : dict[str, FileState]
+    tasks   : list[PlanTask]
+    cache_db: str
+
+
+# A file can be modified without changing its mtime, if it is modified
+# within the resolution of the mtime of the filesystem (up to 2 seconds).
+MTIME_RESOLUTION_NS = 2 * 10 ** 9
+
+
+def file_state(path: pl.Path) -> typ.Optional[FileState]:
+    """Stat and digest of a file, None if it doesn't exist."""
+    try:
+        # NOTE: The stat is taken first, so that a modification while
+        #   the file is read results in a stale stat, not a stale digest.
+        stat = path.stat()
+        with path.open(mode='rb') as fobj:
+            data = fobj.read()
+    except FileNotFoundError:
+        return None
+
+    return FileState(stat.st_mtime_ns, stat.st_size, index.content_digest(data))
+
+
+def _is_unchanged(path: pl.Path, prev_state: typ.Optional[FileState], created_ns: int) -> bool:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return prev_state is None
+
+    if prev_state is None:
+        return False
+
+    # NOTE: The stat is only trusted if the mtime is older than the plan
+    #   (as in index.Index), otherwise a modification with the same mtime
+    #   and size would not be detected. A file which was only touched is
+    #   unchanged.
+    is_same_stat = prev_state.mtime_ns == stat.st_mtime_ns and prev_state.size == stat.st_size
+    if is_same_stat and prev_state.mtime_ns < created_ns - MTIME_RESOLUTION_NS:
+        return True
+
+    state = file_state(path)
+    return state is not None and state.digest == prev_state.digest
+
+
+def path_key(path: pl.Path) -> str:
+    return str(path.absolute())
+
+
+def _plan_path(md_paths: typ.Sequence[pl.Path]) -> pl.Path:
+    # NOTE: paths of file outputs are relative to the working directory,
+    #   so it is part of the key as well.
+    key_parts = [os.getcwd()] + sorted(path_key(md_path) for md_path in md_paths)
+    plan_key  = hashlib.sha1("\n".join(key_parts).encode("utf-8")).hexdigest()
+    return config.CACHE_DIR / PLAN_DIR_NAME / f"v{PLAN_VERSION}_{plan_key}.json"
+
+
+def load_plan(md_paths: typ.Sequence[pl.Path]) -> typ.Optional[BuildPlan]:
+    plan_path = _plan_path(md_paths)
+    try:
+        with plan_path.open(mode='rb') as fobj:
+            plan_data = json.loads(fobj.read())
+
+        tasks = []
+        for task_data in plan_data['tasks']:
+            task = PlanTask(*task_data)
+            input_states = {
+                path: FileState(*state) if state else None for path, state in task.input_states.items()
+            }
+            tasks.append(task._replace(input_states=input_states))
+
+        return BuildPlan(
+            options=plan_data['options'],
+            created_ns=plan_data['created_ns'],
+            md_files={path: FileState(*state) for path, state in plan_data['md_files'].items()},
+            outputs={path: FileState(*state) for path, state in plan_data['outputs'].items()},
+            tasks=tasks,
+            cache_db=plan_data['cache_db'],
+        )
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logger.warning(f"Ignoring invalid build plan {plan_path}: {err}")
+        return None
+
+
+def dump_plan(md_paths: typ.Sequence[pl.Path], plan: BuildPlan) -> None:
+    plan_path = _plan_path(md_paths)
+    try:
+        plan_path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE: A unique temporary file, since concurrent builds of the
+        #   same project write the same plan.
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=plan_path.parent, prefix=plan_path.name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(tmp_fd, mode="w", encoding="utf-8") as fobj:
+                fobj.write(json.dumps(plan._asdict()))
+            os.replace(tmp_path, plan_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as err:
+        # the plan is only an optimization
+        logger.debug(f"Could not write build plan {plan_path}: {err}")
+
+
+def changed_md_paths(plan: BuildPlan, md_paths: typ.Sequence[pl.Path]) -> set[pl.Path]:
+    """Markdown files which are new or were modified since the plan was written."""
+    return {
+        md_path
+        for md_path in md_paths
+        if not _is_unchanged(md_path, plan.md_files.get(path_key(md_path)), plan.created_ns)
+    }
+
+
+def changed_outputs(plan: BuildPlan) -> set[pl.Path]:
+    """File outputs which were modified (or deleted) since the plan was written."""
+    return {
+        pl.Path(output_path)
+        for output_path, prev_state in plan.outputs.items()
+        if not _is_unchanged(pl.Path(output_path), prev_state, plan.created_ns)
+    }
+
+
+def _missing_task_keys(cache_db: str, task_keys: set[str]) -> set[str]:
+    if not task_keys:
+        return set()
+    if not os.path.exists(cache_db):
+        return task_keys
+
+    try:
+        conn = sqlite3.connect(f"file:{cache_db}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                "SELECT DISTINCT task_key FROM manifest JOIN captures USING (capture_digest)"
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as err:
+        logger.debug(f"Could not read build cache {cache_db}: {err}")
+        return task_keys
+
+    return task_keys - {task_key for (task_key,) in rows}
+
+
+def glob_input_paths(input_glob: str) -> list[str]:
+    """Files matched by a glob of an 'inputs' directive."""
+    return sorted(path for path in glob.glob(input_glob, recursive=True) if os.path.isfile(path))
+
+
+def plan_options(in_place_update: bool) -> dict[str, typ.Any]:
+    """Build options which change the result of a build."""
+    return {'in_place_update': in_place_update}
+
+
+def is_noop(plan: BuildPlan, md_paths: typ.Sequence[pl.Path], options: dict[str, typ.Any]) -> bool:
+    """Check if a build with the plan would not change anything."""
+    if plan.options != options:
+        return False
+
+    if set(plan.md_files) != {path_key(md_path) for md_path in md_paths}:
+        return False
+
+    if changed_md_paths(plan, md_paths):
+        return False
+
+    if changed_outputs(plan):
+        return False
+
+    task_keys: set[str] = set()
+    for task in plan.tasks:
+        for input_path, input_state in task.input_states.items():
+            if not _is_unchanged(pl.Path(input_path), input_state, plan.created_ns):
+                return False
+
+        for input_glob, input_paths in task.input_globs.items():
+            if glob_input_paths(input_glob) != input_paths:
+                return False
+
+        if not (task.capture_file and os.path.exists(task.capture_file)):
+            task_keys.add(task.task_key)
+
+    return not _missing_task_keys(plan.cache_db, task_keys)
+
+
+def is_noop_build(md_paths: typ.Sequence[pl.Path], options: dict[str, typ.Any]) -> bool:
+    """Check if a build would not change anything, without parsing md_paths."""
+    plan = load_plan(md_paths)
+    return plan is not None and is_noop(plan, md_paths, options)
@@ -0,0 +1,170 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Reference server for the http protocol of litprog.remote_cache.
+
+    POST /v1/<cache_id>/lookup    body: task_keys (one per line)
+                                  response: packed records
+    POST /v1/<cache_id>/store     body: packed records
+
+Records are stored as one file per task_key. This is good enough for
+a team or a CI runner, it is not meant to be exposed to the internet.
+"""
+import os
+import re
+import struct
+import typing as typ
+import logging
+import tempfile
+import pathlib as pl
+import http.server
+
+from . import config
+from . import remote_cache
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8722
+
+DEFAULT_DATA_DIR = config.CACHE_DIR / "server"
+
+# Requests with a larger body are rejected, rather than read into
+#   memory. A build uploads all of its new captures with one request,
+#   so this is the same as the default size of a local cache.
+DEFAULT_MAX_BODY_SIZE = 256 * 1024 * 1024
+
+# Only accept names that are safe to use as path components
+CACHE_ID_RE = re.compile(r"^[\w\.\-]+$")
+TASK_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
+PATH_RE = re.compile(r"^/v1/(?P<cache_id>[^/]+)/(?P<action>lookup|store)$")
+
+
+class RecordStore:
+    def __init__(self, data_dir: pl.Path) -> None:
+        self.data_dir = data_dir
+
+    def _record_path(self, cache_id: str, task_key: str) -> pl.Path:
+        return self.data_dir / cache_id / task_key[:2] / task_key
+
+    def lookup(self, cache_id: str, task_keys: list[str]) -> bytes:
+        parts: list[bytes] = []
+        for task_key in task_keys:
+            if not TASK_KEY_RE.match(task_key):
+                continue
+            record_path = self._record_path(cache_id, task_key)
+            if record_path.exists():
+                parts.append(record_path.read_bytes())
+        return b"".join(parts)
+
+    def store(self, cache_id: str, records: typ.Iterable[remote_cache.Record]) -> int:
+        num_records = 0
+        for record in records:
+            task_key = record.entry.task_key
+            if not TASK_KEY_RE.match(task_key):
+                continue
+
+            record_path = self._record_path(cache_id, task_key)
+            record_path.parent.mkdir(parents=True, exist_ok=True)
+
+            # write to a temporary file first, so that a concurrent
+            # lookup never reads a partially written record. Each store
+            # uses its own temporary file, as there may be concurrent
+            # stores of the same task_key.
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=record_path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(tmp_fd, mode="wb") as fobj:
+                    fobj.write(remote_cache.pack_records([record]))
+                os.replace(tmp_name, record_path)
+            except BaseException:
+                os.unlink(tmp_name)
+                raise
+            num_records += 1
+        return num_records
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    # set by init_server
+    record_store : RecordStore
+    max_body_size: int
+
+    def _respond(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header('Content-Type'  , "application/octet-stream")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        # pylint: disable=invalid-name; name required by BaseHTTPRequestHandler
+        match = PATH_RE.match(self.path)
+        if match is None or not CACHE_ID_RE.match(match.group('cache_id')):
+            self._respond(404)
+            return
+
+        try:
+            body_len = int(self.headers.get('Content-Length', "0"))
+        except ValueError:
+            body_len = -1
+
+        if body_len < 0:
+            self._respond(400)
+            return
+        elif body_len > self.max_body_size:
+            logger.warning(f"Rejected request with body of {body_len} bytes, max: {self.max_body_size}")
+            # NOTE: The body is not read, so the connection can't be reused.
+            self.close_connection = True
+            self._respond(413)
+            return
+
+        cache_id = match.group('cache_id')
+        body     = self.rfile.read(body_len)
+
+        try:
+            if match.group('action') == 'lookup':
+                task_keys = body.decode("ascii").splitlines()
+                self._respond(200, self.record_store.lookup(cache_id, task_keys))
+            else:
+                records = remote_cache.unpack_records(body)
+                self.record_store.store(cache_id, records)
+                self._respond(204)
+        except (ValueError, struct.error) as err:
+            logger.warning(f"Invalid request: {err}")
+            self._respond(400)
+
+    def log_message(self, format: str, *args: typ.Any) -> None:
+        # pylint: disable=redefined-builtin; signature of BaseHTTPRequestHandler
+        logger.debug(format % args)
+
+
+def init_server(
+    host         : str     = DEFAULT_HOST,
+    port         : int     = DEFAULT_PORT,
+    data_dir     : pl.Path = DEFAULT_DATA_DIR,
+    max_body_size: int     = DEFAULT_MAX_BODY_SIZE,
+) -> http.server.ThreadingHTTPServer:
+    handler_type = type(
+        "BoundRequestHandler",
+        (RequestHandler,),
+        {'record_store': RecordStore(data_dir), 'max_body_size': max_body_size},
+    )
+    return http.server.ThreadingHTTPServer((host, port), handler_type)
+
+
+def serve(
+    host         : str     = DEFAULT_HOST,
+    port         : int     = DEFAULT_PORT,
+    data_dir     : pl.Path = DEFAULT_DATA_DIR,
+    max_body_size: int     = DEFAULT_MAX_BODY_SIZE,
+) -> None:
+    server = init_server(host, port, data_dir, max_body_size)
+    logger.info(f"Serving remote cache on http://{host}:{port} from {data_dir}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
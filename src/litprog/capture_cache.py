@@ -5,22 +5,32 @@
 # SPDX-License-Identifier: MIT
 import os
 import re
-import uuid
+import zlib
+import time
 import shlex
 import shelve
 import typing as typ
 import hashlib
 import logging
+import sqlite3
 import pathlib as pl
 import datetime as dt
+import functools
+import threading
+import collections
 
+from . import index
 from . import parse
 from . import config
 from . import session
+from . import build_plan
 from . import common_types as ct
 
-# import zlib
-# import zstandard
+try:
+    import zstandard
+except ImportError:
+    # zlib is used as a fallback
+    zstandard = None
 
 
 logger = logging.getLogger(__name__)
@@ -31,24 +41,117 @@ Chapters = typ.Iterable[parse.Chapter]
 SERIAL_VERSION_ID = '1'
 
 
-# TODO (mb 2021-03-05):
+CaptureData = bytes
 
-# dctx = zstandard.ZstdDecompressor()
-# capture_bytes = dctx.decompress(capture_zstd)
+CODEC_RAW  = 'raw'
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
 
-# cctx = zstandard.ZstdCompressor()
-# capture_zstd = cctx.compress(capture_bytes)
+DEFAULT_CODEC = CODEC_ZSTD if zstandard else CODEC_ZLIB
 
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
 
-CaptureData = bytes
+# NOTE: zlib only uses the last 32KB of a dictionary.
+DEFAULT_DICT_SIZE = 32 * 1024
+
+
+class CompressionDict(typ.NamedTuple):
+    dict_id: int
+    codec  : str
+    data   : bytes
+
+
+@functools.lru_cache(maxsize=8)
+def _zstd_dict(dict_data: bytes) -> typ.Any:
+    return zstandard.ZstdCompressionDict(dict_data)
+
+
+def _compress(data: bytes, codec: str = DEFAULT_CODEC, zdict: typ.Optional[CompressionDict] = None) -> bytes:
+    if zdict:
+        assert zdict.codec == codec
+
+    if codec == CODEC_ZSTD:
+        if zdict:
+            cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_zstd_dict(zdict.data))
+        else:
+            cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return typ.cast(bytes, cctx.compress(data))
+    elif codec == CODEC_ZLIB:
+        if zdict:
+            cobj = zlib.compressobj(ZLIB_LEVEL, zdict=zdict.data)
+        else:
+            cobj = zlib.compressobj(ZLIB_LEVEL)
+        return cobj.compress(data) + cobj.flush()
+    else:
+        assert codec == CODEC_RAW
+        return data
+
+
+def _decompress(data: bytes, codec: str = CODEC_RAW, zdict: typ.Optional[CompressionDict] = None) -> bytes:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ImportError("Capture was compressed using zstd, but 'zstandard' is not installed.")
+        if zdict:
+            dctx = zstandard.ZstdDecompressor(dict_data=_zstd_dict(zdict.data))
+        else:
+            dctx = zstandard.ZstdDecompressor()
+        return typ.cast(bytes, dctx.decompress(data))
+    elif codec == CODEC_ZLIB:
+        if zdict:
+            dobj = zlib.decompressobj(zdict=zdict.data)
+        else:
+            dobj = zlib.decompressobj()
+        return dobj.decompress(data) + dobj.flush()
+    else:
+        assert codec == CODEC_RAW
+        return data
+
+
+# Line separators of binary captures and (escaped) of legacy json captures.
+CAPTURE_LINE_SEP_RE = re.compile(rb"\n|\\n")
+
+
+def _train_raw_dict(samples: list[bytes], dict_size: int) -> bytes:
+    # A raw content dictionary made of the captured lines that are most
+    # common across samples. This is used for zlib (which has no
+    # dictionary training) and for zstd if there are too few samples.
+    # More common lines are put at the end, since shorter distances
+    # are encoded more efficiently.
+    counter: collections.Counter[bytes] = collections.Counter()
+    for sample in samples:
+        counter.update(set(CAPTURE_LINE_SEP_RE.split(sample)))
 
+    segments = [segment for segment, count in counter.items() if count > 1]
+    segments.sort(key=lambda segment: counter[segment] * len(segment), reverse=True)
 
-def _compress(data: bytes) -> bytes:
-    return data
+    dict_segments: list[bytes] = []
+    dict_len = 0
+    for segment in segments:
+        if dict_len + len(segment) > dict_size:
+            continue
+        dict_segments.append(segment)
+        dict_len += len(segment)
 
+    return b"".join(reversed(dict_segments))
 
-def _decompress(data: bytes) -> bytes:
-    return data
+
+def train_dict(samples: list[bytes], codec: str = DEFAULT_CODEC, dict_size: int = DEFAULT_DICT_SIZE) -> bytes:
+    """Train a compression dictionary from capture samples."""
+    if codec == CODEC_ZSTD:
+        try:
+            return typ.cast(bytes, zstandard.train_dictionary(dict_size, samples).as_bytes())
+        except zstandard.ZstdError as err:
+            logger.debug(f"Using raw content dictionary, zstd training failed: {err}")
+
+    if codec not in (CODEC_ZSTD, CODEC_ZLIB):
+        raise ValueError(f"Invalid codec for dictionary: {codec}")
+
+    dict_data = _train_raw_dict(samples, dict_size)
+    if dict_data:
+        return dict_data
+    else:
+        raise ValueError("Not enough similar captures to train a dictionary.")
 
 
 class ManifestEntry(typ.NamedTuple):
@@ -61,6 +164,30 @@ class ManifestEntry(typ.NamedTuple):
     task_info     : str
 
 
+def _task_info(block: ct.Block) -> str:
+    task_info = f"@{block.first_line:>6}"
+    if block.info_string:
+        task_info += " - " + block.info_string.ljust(9)
+
+    content_lines = block.inner_content.strip().splitlines()
+    if content_lines:
+        firstline = content_lines[0]
+        task_info += " - " + firstline
+
+    # NOTE: trailing whitespace would not survive a round trip
+    #   through the manifest (see _manifest_lines)
+    return task_info.rstrip()
+
+
+TASK_INFO_LINENO_RE = re.compile(r"^@\s*\d+")
+
+
+def _task_summary(task_info: str) -> str:
+    # task_info without the line number, so that a block can be
+    # recognized even if it was moved.
+    return TASK_INFO_LINENO_RE.sub("", task_info, count=1)
+
+
 def init_manifest_entry(
     task: ct.BlockTask, task_key: str, capture: session.Capture
 ) -> tuple[ManifestEntry, CaptureData]:
@@ -72,15 +199,7 @@ def init_manifest_entry(
     capture_size   = len(capture_data)
     capture_digest = hashlib.sha1(capture_data).hexdigest()
 
-    blk       = task.block
-    task_info = f"@{blk.first_line:>6}"
-    if blk.info_string:
-        task_info += " - " + blk.info_string.ljust(9)
-
-    content_lines = blk.inner_content.strip().splitlines()
-    if content_lines:
-        firstline = content_lines[0]
-        task_info += " - " + firstline
+    task_info = _task_info(task.block)
 
     entry = ManifestEntry(
         created,
@@ -143,6 +262,9 @@ def parse_manifest(manifest_text: str) -> typ.Iterable[ManifestEntry]:
 
 
 def _path_parser(task: ct.BlockTask) -> typ.Iterable[str]:
+    # NOTE: This is only a heuristic for 'run' blocks without
+    #   an 'inputs' directive. It misses any file that isn't
+    #   mentioned in the command (imported modules, data files).
     for maybe_path in shlex.split(task.command):
         yield maybe_path
 
@@ -153,6 +275,48 @@ def _path_parser(task: ct.BlockTask) -> typ.Iterable[str]:
         yield "src/" + maybe_path
 
 
+def task_input_globs(task: ct.BlockTask) -> dict[str, list[str]]:
+    """Files matched by each glob of the 'inputs' directive of a task."""
+    return {input_glob: build_plan.glob_input_paths(input_glob) for input_glob in task.opts.input_globs}
+
+
+def _iter_maybe_input_paths(task: ct.BlockTask) -> typ.Iterable[str]:
+    if task.opts.input_globs:
+        for input_paths in task_input_globs(task).values():
+            yield from input_paths
+    elif task.opts.directive == 'run':
+        yield from _path_parser(task)
+
+
+def _input_state(path: pl.Path, file_index: typ.Optional[index.Index]) -> typ.Optional[build_plan.FileState]:
+    if file_index is None:
+        return build_plan.file_state(path)
+
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+
+    # NOTE: The same (memoized) digest as for ResultCache.task_key.
+    digest = file_index.digest(path)
+    if digest is None:
+        return None
+    return build_plan.FileState(stat.st_mtime_ns, stat.st_size, digest)
+
+
+def task_input_states(
+    task: ct.BlockTask, file_index: typ.Optional[index.Index]
+) -> dict[str, typ.Optional[build_plan.FileState]]:
+    """Paths which may be inputs of a task and their states (see ResultCache.task_key)."""
+    return {
+        maybe_path: _input_state(pl.Path(maybe_path), file_index)
+        for maybe_path in _iter_maybe_input_paths(task)
+    }
+
+
+RuntimeKey = tuple[str, str]
+
+
 class ResultCache:
 
     task_keys_by_provide_id: dict[str, str]
@@ -161,14 +325,72 @@ class ResultCache:
     requires_by_provide_id: dict[str, list[str]]
     manifest              : list[ManifestEntry]
 
+    # latest entry for each task_key, used for lookups
+    _entries_by_task_key: dict[str, ManifestEntry]
+
+    # historical runtimes, used to estimate the runtime of tasks
+    _runtimes_by_task_key: dict[str, int]
+    _runtimes_by_info    : dict[RuntimeKey, int]
+    _runtimes_by_summary : dict[RuntimeKey, int]
+
+    # If set, input files of tasks are identified by their digest
+    # rather than their mtime (see task_key).
+    file_index: typ.Optional[index.Index]
+
     def __init__(self, manifest_text: str) -> None:
         self.task_keys_by_provide_id = {}
         self.requires_by_provide_id  = {}
+        self.file_index              = None
+
+        self.manifest = []
 
-        self.manifest = list(parse_manifest(manifest_text))
+        self._entries_by_task_key  = {}
+        self._runtimes_by_task_key = {}
+        self._runtimes_by_info     = {}
+        self._runtimes_by_summary  = {}
 
-        for entry in self.manifest:
+        for entry in parse_manifest(manifest_text):
             self.task_keys_by_provide_id[entry.task_key] = entry.task_key
+            self._add_entry(entry)
+
+    def _add_entry(self, entry: ManifestEntry) -> None:
+        self.manifest.append(entry)
+
+        prev_entry = self._entries_by_task_key.get(entry.task_key)
+        if prev_entry is None or prev_entry.created <= entry.created:
+            self._entries_by_task_key[entry.task_key] = entry
+            self._add_runtime(entry)
+
+    def _add_runtime(self, entry: ManifestEntry) -> None:
+        self._runtimes_by_task_key[entry.task_key] = entry.runtime_ms
+        self._runtimes_by_info[entry.md_path, entry.task_info] = entry.runtime_ms
+        self._runtimes_by_summary[entry.md_path, _task_summary(entry.task_info)] = entry.runtime_ms
+
+    def estimate_runtime_ms(self, task: ct.BlockTask) -> typ.Optional[int]:
+        """Estimate the runtime of a task based on previous runs.
+
+        If the task itself was never run (because it was changed or
+        is new), the runtime of a similar block is used instead. Similar
+        blocks are those from the same file, either at the same line or
+        starting with the same line of code.
+        """
+        if not task.opts.requires_ids:
+            # NOTE: The task_key of a task with requires depends on the
+            #   providers, which may not have been completed yet.
+            runtime_ms = self._runtimes_by_task_key.get(self.task_key(task))
+            if runtime_ms is not None:
+                return runtime_ms
+
+        md_path   = str(task.md_path)
+        task_info = _task_info(task.block)
+
+        runtime_ms = self._runtimes_by_info.get((md_path, task_info))
+        if runtime_ms is None:
+            summary = _task_summary(task_info)
+            if summary:
+                runtime_ms = self._runtimes_by_summary.get((md_path, summary))
+
+        return runtime_ms
 
     def task_key(self, task: ct.BlockTask) -> str:
         requires_parts: list[str] = []
@@ -176,13 +398,22 @@ class ResultCache:
         requires_parts.append(task.block.namespace)
         if task.opts.directive == 'run':
             requires_parts.append(task.command)
-            for maybe_path in _path_parser(task):
-                if os.path.exists(maybe_path):
-                    mtime = os.stat(maybe_path).st_mtime
-                    requires_parts.append(str(mtime))
         else:
             requires_parts.append(task.block.content)
 
+        if task.opts.input_globs:
+            # NOTE: The globs and the matched paths are part of the key,
+            #   so that adding/removing a matching file is a change.
+            for input_glob, input_paths in task_input_globs(task).items():
+                requires_parts.append(input_glob)
+                for input_path in input_paths:
+                    requires_parts.append(input_path)
+                    requires_parts.append(self._input_key_part(input_path))
+        elif task.opts.directive == 'run':
+            for maybe_path in _path_parser(task):
+                if os.path.exists(maybe_path):
+                    requires_parts.append(self._input_key_part(maybe_path))
+
         for require_id in sorted(task.opts.requires_ids):
             requires_parts.append(require_id)
             # For any require, there MUST have previously have been a
@@ -195,6 +426,15 @@ class ResultCache:
         requires_digest = hashlib.sha1("".join(requires_parts).encode("utf-8"))
         return requires_digest.hexdigest()
 
+    def _input_key_part(self, path: str) -> str:
+        if self.file_index is None:
+            return str(os.stat(path).st_mtime)
+
+        # NOTE: The file_index memoizes digests for the duration of the
+        #   build, as long as the stat of a file doesn't change.
+        digest = self.file_index.digest(pl.Path(path))
+        return digest or ""
+
     def invalidate_requires(self, provides_id: str) -> None:
         self.task_keys_by_provide_id.pop(provides_id, None)
 
@@ -219,6 +459,7 @@ class ResultCache:
         task_key = self.task_key(task)
         entry, capture_data = init_manifest_entry(task, task_key, capture)
         self.write_capture(entry, capture_data)
+        self._add_entry(entry)
         self._reset_task_keys(task, entry)
 
     def write_capture(self, entry: ManifestEntry, capture_data: CaptureData) -> None:
@@ -228,13 +469,10 @@ class ResultCache:
         raise NotImplementedError("MUST be implemented by subclass.")
 
     def get_entry(self, task: ct.BlockTask) -> typ.Optional[ManifestEntry]:
-        task_key = self.task_key(task)
-
-        for entry in reversed(self.manifest):
-            if entry.task_key == task_key:
-                return entry
+        return self._entries_by_task_key.get(self.task_key(task))
 
-        return None
+    def prefetch(self, tasks: typ.Sequence[ct.BlockTask]) -> None:
+        """Hook for caches which can look up many tasks at once."""
 
     def get_capture(self, task: ct.BlockTask) -> typ.Optional[session.Capture]:
         entry = self.get_entry(task)
@@ -248,6 +486,19 @@ class ResultCache:
         self._reset_task_keys(task, entry)
         return session.loads_capture(capture_data)
 
+    def compact(self) -> list[ManifestEntry]:
+        """Drop entries which were superseded by a later entry with the same task_key.
+
+        Returns the entries that were dropped.
+        """
+        latest_entries  = self._entries_by_task_key
+        dropped_entries = [
+            entry for entry in self.manifest if latest_entries[entry.task_key] is not entry
+        ]
+        if dropped_entries:
+            self.manifest = sorted(latest_entries.values())
+        return dropped_entries
+
     def flush(self) -> None:
         raise NotImplementedError("MUST be implemented by subclass.")
 
@@ -293,62 +544,527 @@ def parse_cache_id(chapters: Chapters) -> str:
     return prefix + "_" + project_id_hash
 
 
-class LocalResultCache(ResultCache):
+MANIFEST_COLUMNS = ", ".join(ManifestEntry._fields)
+
+SQLITE_SCHEMA_VERSION = 3
+
+SQLITE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS manifest (
+    created         TEXT    NOT NULL,
+    runtime_ms      INTEGER NOT NULL,
+    capture_size    INTEGER NOT NULL,
+    capture_digest  TEXT    NOT NULL,
+    task_key        TEXT    NOT NULL,
+    md_path         TEXT    NOT NULL,
+    task_info       TEXT    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS manifest_task_key ON manifest (task_key);
+CREATE TABLE IF NOT EXISTS captures (
+    capture_digest  TEXT    PRIMARY KEY,
+    capture_data    BLOB    NOT NULL,
+    codec           TEXT    NOT NULL DEFAULT 'raw',
+    dict_id         INTEGER
+);
+CREATE TABLE IF NOT EXISTS dictionaries (
+    dict_id         INTEGER PRIMARY KEY,
+    codec           TEXT    NOT NULL,
+    dict_data       BLOB    NOT NULL,
+    created         TEXT    NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    task_key        TEXT    PRIMARY KEY,
+    last_hit        TEXT    NOT NULL,
+    num_hits        INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name            TEXT    PRIMARY KEY,
+    value           INTEGER NOT NULL
+);
+PRAGMA user_version = {SQLITE_SCHEMA_VERSION};
+"""
+
+# NOTE: Entries are superseded by a later entry
+#   with the same task_key. Since the database may be shared by
+#   concurrent builds, compaction is done in the database rather
+#   than based on the in memory manifest.
+SQLITE_COMPACT = """
+DELETE FROM manifest WHERE EXISTS (
+    SELECT 1 FROM manifest AS newer
+    WHERE newer.task_key = manifest.task_key
+      AND newer.created  > manifest.created
+);
+DELETE FROM captures WHERE capture_digest NOT IN (
+    SELECT capture_digest FROM manifest
+);
+DELETE FROM usage WHERE task_key NOT IN (
+    SELECT task_key FROM manifest
+);
+"""
+
+# An entry was last used either when it was created or when it was last hit.
+SQLITE_LAST_USED = """
+SELECT manifest.rowid, manifest.capture_digest, length(captures.capture_data),
+       max(manifest.created, coalesce(usage.last_hit, '')) AS last_used
+FROM manifest
+LEFT JOIN captures USING (capture_digest)
+LEFT JOIN usage    USING (task_key)
+ORDER BY last_used DESC
+"""
+
+SQLITE_RECORD_HIT = """
+INSERT INTO usage (task_key, last_hit, num_hits) VALUES (?, ?, ?)
+ON CONFLICT (task_key) DO UPDATE SET
+    last_hit = max(last_hit, excluded.last_hit),
+    num_hits = num_hits + excluded.num_hits
+"""
+
+SQLITE_INCREMENT_COUNTER = """
+INSERT INTO counters (name, value) VALUES (?, ?)
+ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+"""
+
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_CACHE_AGE   = dt.timedelta(days=90)
+
+DB_FILENAME = "build_cache.sqlite3"
+
+INDEX_FILENAME = "file_index.json"
+
+# Number of captures written before they are committed.
+SQLITE_COMMIT_BATCH_SIZE = 32
+
+
+def project_cache_dir(chapters: Chapters) -> pl.Path:
+    return config.CACHE_DIR / parse_cache_id(chapters)
+
+
+def _cache_dir(chapters: Chapters) -> pl.Path:
+    cache_dir = project_cache_dir(chapters)
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def open_file_index(chapters: Chapters) -> index.Index:
+    """Index of the files (inputs and outputs) of the project."""
+    return index.Index(_cache_dir(chapters) / INDEX_FILENAME)
+
+
+def _iter_legacy_captures(cache_dir: pl.Path) -> typ.Iterable[tuple[ManifestEntry, CaptureData]]:
+    """Read entries of the shelve based cache used before SQLiteResultCache."""
+    manifest_file = cache_dir / f"build_cache.manifest_v{SERIAL_VERSION_ID}"
+    data_file     = cache_dir / "build_cache.db"
+
+    if not manifest_file.exists():
+        return
+
+    with manifest_file.open(encoding="utf-8") as fobj:
+        manifest_text = fobj.read()
+
+    try:
+        legacy_db = shelve.open(str(data_file), flag='r')
+    except Exception as ex:
+        logger.warning(f"Could not open legacy cache {data_file}: {ex}")
+        return
+
+    with legacy_db:
+        for entry in parse_manifest(manifest_text):
+            raw_capture_data = legacy_db.get(entry.capture_digest)
+            if raw_capture_data:
+                yield entry, raw_capture_data
+
+
+class SQLiteResultCache(ResultCache):
+    """ResultCache backed by a single SQLite database in WAL mode.
+
+    The database holds both the manifest and the captures, so that a
+    capture can never be written without its manifest entry. Multiple
+    threads of one build share a connection (guarded by a lock),
+    concurrent builds of the same project use separate connections.
+    """
+
+    _db_file      : pl.Path
+    _conn         : sqlite3.Connection
+    _lock         : threading.RLock
+    _pending_count: int
+
+    # task_key -> (last_hit, num_hits), written to the usage table on flush
+    _hits      : dict[str, tuple[str, int]]
+    _num_misses: int
+
+    max_bytes: int
+    max_age  : dt.timedelta
 
-    _manifest_file: pl.Path
-    _data_file    : pl.Path
-    _entry_buffer : list[ManifestEntry]
+    # dictionaries are looked up by dict_id when reading, new
+    # captures are compressed using the most recent dictionary.
+    _codec : str
+    _zdict : typ.Optional[CompressionDict]
+    _zdicts: dict[int, CompressionDict]
 
     def __init__(
         self,
         orig_files: Chapters,
+        max_bytes : int          = DEFAULT_MAX_CACHE_BYTES,
+        max_age   : dt.timedelta = DEFAULT_MAX_CACHE_AGE,
     ) -> None:
-        cache_subdir = parse_cache_id(orig_files)
-        cache_dir    = config.CACHE_DIR / cache_subdir
+        cache_dir = _cache_dir(orig_files)
 
-        if not cache_dir.exists():
-            cache_dir.mkdir(parents=True)
+        self._db_file       = cache_dir / DB_FILENAME
+        self._lock          = threading.RLock()
+        self._pending_count = 0
+        self._hits          = {}
+        self._num_misses    = 0
+        self.max_bytes      = max_bytes
+        self.max_age        = max_age
 
-        self._manifest_file = cache_dir / f"build_cache.manifest_v{SERIAL_VERSION_ID}"
-        self._data_file     = cache_dir / "build_cache.db"
+        is_new_db  = not self._db_file.exists()
+        self._conn = _connect(self._db_file)
 
-        self._db = shelve.open(str(self._data_file))
+        self._codec  = DEFAULT_CODEC
+        self._zdicts = _load_dicts(self._conn)
+        self._zdict  = _latest_dict(self._conn, self._codec)
 
-        if self._manifest_file.exists():
-            with self._manifest_file.open() as fobj:
-                manifest_text = fobj.read()
-        else:
-            manifest_text = ""
+        super().__init__(manifest_text="")
+
+        if is_new_db:
+            self._migrate_legacy_cache(cache_dir)
+
+        cursor = self._conn.execute(f"SELECT {MANIFEST_COLUMNS} FROM manifest ORDER BY created")
+        for row in cursor:
+            entry = ManifestEntry(*row)
+            self.task_keys_by_provide_id[entry.task_key] = entry.task_key
+            self._add_entry(entry)
+
+    def _migrate_legacy_cache(self, cache_dir: pl.Path) -> None:
+        num_entries = 0
+        with self._conn:
+            for entry, capture_data in _iter_legacy_captures(cache_dir):
+                self._insert(entry, capture_data)
+                num_entries += 1
+
+        if num_entries:
+            logger.info(f"Migrated {num_entries} entries from legacy cache in {cache_dir}")
+
+    def _insert(self, entry: ManifestEntry, capture_data: CaptureData) -> None:
+        dict_id = self._zdict.dict_id if self._zdict else None
+        self._conn.execute(
+            "INSERT OR IGNORE INTO captures (capture_digest, capture_data, codec, dict_id)"
+            " VALUES (?, ?, ?, ?)",
+            (entry.capture_digest, _compress(capture_data, self._codec, self._zdict), self._codec, dict_id),
+        )
+        self._conn.execute(f"INSERT INTO manifest ({MANIFEST_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", entry)
+
+    def update(self, task: ct.BlockTask, capture: session.Capture) -> None:
+        with self._lock:
+            super().update(task, capture)
+            self._num_misses += 1
 
-        super().__init__(manifest_text)
+    def get_capture(self, task: ct.BlockTask) -> typ.Optional[session.Capture]:
+        with self._lock:
+            capture = super().get_capture(task)
+            if capture is not None:
+                task_key = self.task_key(task)
+                _, num_hits = self._hits.get(task_key, ("", 0))
+                self._hits[task_key] = (dt.datetime.utcnow().isoformat(), num_hits + 1)
+            return capture
 
     def write_capture(self, entry: ManifestEntry, capture_data: CaptureData) -> None:
-        self.manifest.append(entry)
-        self._db[entry.capture_digest] = _compress(capture_data)
+        with self._lock:
+            self._insert(entry, capture_data)
+            self._pending_count += 1
+            if self._pending_count >= SQLITE_COMMIT_BATCH_SIZE:
+                self._commit()
 
     def read_capture(self, entry: ManifestEntry) -> typ.Optional[CaptureData]:
-        raw_capture_data = self._db.get(entry.capture_digest)
-        if raw_capture_data:
-            assert isinstance(raw_capture_data, bytes)
-            return _decompress(raw_capture_data)
-        else:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT capture_data, codec, dict_id FROM captures WHERE capture_digest = ?",
+                (entry.capture_digest,),
+            ).fetchone()
+
+        if row is None:
             return None
 
+        raw_capture_data, codec, dict_id = row
+        if dict_id and dict_id not in self._zdicts:
+            # dictionary was trained after this cache was opened
+            with self._lock:
+                self._zdicts = _load_dicts(self._conn)
+
+        zdict = self._zdicts[dict_id] if dict_id else None
+        return _decompress(raw_capture_data, codec, zdict)
+
+    def _commit(self) -> None:
+        self._conn.commit()
+        self._pending_count = 0
+
     def flush(self) -> None:
-        self.manifest.sort()
-        manifest_text = dumps_manifest(self.manifest)
+        with self._lock:
+            self._commit()
+
+            dropped_entries = self.compact()
+            if dropped_entries:
+                logger.info(f"Dropped {len(dropped_entries)} superseded cache entries")
+
+            with self._conn:
+                self._conn.executemany(
+                    SQLITE_RECORD_HIT,
+                    [(task_key, last_hit, num_hits) for task_key, (last_hit, num_hits) in self._hits.items()],
+                )
+                num_hits = sum(n for _, n in self._hits.values())
+                self._conn.execute(SQLITE_INCREMENT_COUNTER, ('hits'  , num_hits))
+                self._conn.execute(SQLITE_INCREMENT_COUNTER, ('misses', self._num_misses))
+                self._conn.executescript(SQLITE_COMPACT)
+
+            evicted = evict(self._conn, self.max_bytes, self.max_age)
+            if evicted.num_entries:
+                logger.info(f"Evicted {evicted.num_entries} cache entries ({evicted.num_bytes} bytes)")
+
+            self._conn.close()
+
+
+def _connect(db_file: pl.Path) -> sqlite3.Connection:
+    # NOTE: The timeout is for concurrent builds,
+    #   which may hold the write lock while committing a batch.
+    conn = sqlite3.connect(str(db_file), timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SQLITE_SCHEMA)
+
+    capture_columns = {row[1] for row in conn.execute("PRAGMA table_info(captures)")}
+    if 'codec' not in capture_columns:
+        # migrate from schema version 2, previous captures are uncompressed
+        with conn:
+            conn.execute("ALTER TABLE captures ADD COLUMN codec TEXT NOT NULL DEFAULT 'raw'")
+            conn.execute("ALTER TABLE captures ADD COLUMN dict_id INTEGER")
+    return conn
+
+
+def _latest_dict(conn: sqlite3.Connection, codec: str) -> typ.Optional[CompressionDict]:
+    row = conn.execute(
+        "SELECT dict_id, codec, dict_data FROM dictionaries WHERE codec = ? ORDER BY dict_id DESC LIMIT 1",
+        (codec,),
+    ).fetchone()
+    return CompressionDict(*row) if row else None
+
+
+def _load_dicts(conn: sqlite3.Connection) -> dict[int, CompressionDict]:
+    rows = conn.execute("SELECT dict_id, codec, dict_data FROM dictionaries")
+    return {row[0]: CompressionDict(*row) for row in rows}
+
+
+def _iter_captures(conn: sqlite3.Connection) -> typ.Iterable[tuple[str, CaptureData]]:
+    zdicts = _load_dicts(conn)
+    rows   = conn.execute("SELECT capture_digest, capture_data, codec, dict_id FROM captures").fetchall()
+    for capture_digest, raw_capture_data, codec, dict_id in rows:
+        zdict = zdicts[dict_id] if dict_id else None
+        yield capture_digest, _decompress(raw_capture_data, codec, zdict)
+
+
+class TrainResult(typ.NamedTuple):
+    dict_id     : int
+    dict_size   : int
+    num_captures: int
+    bytes_before: int
+    bytes_after : int
+
+
+def train(
+    conn     : sqlite3.Connection,
+    codec    : str = DEFAULT_CODEC,
+    dict_size: int = DEFAULT_DICT_SIZE,
+) -> TrainResult:
+    """Train a dictionary from the existing captures and recompress them with it."""
+    captures = dict(_iter_captures(conn))
+    if not captures:
+        raise ValueError("No captures to train a dictionary with.")
+
+    (bytes_before,) = conn.execute("SELECT coalesce(sum(length(capture_data)), 0) FROM captures").fetchone()
+
+    dict_data = train_dict(list(captures.values()), codec, dict_size)
+    created   = dt.datetime.utcnow().isoformat()
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO dictionaries (codec, dict_data, created) VALUES (?, ?, ?)",
+            (codec, dict_data, created),
+        )
+        dict_id = typ.cast(int, cursor.lastrowid)
+        zdict   = CompressionDict(dict_id, codec, dict_data)
+        conn.executemany(
+            "UPDATE captures SET capture_data = ?, codec = ?, dict_id = ? WHERE capture_digest = ?",
+            [
+                (_compress(capture_data, codec, zdict), codec, dict_id, capture_digest)
+                for capture_digest, capture_data in captures.items()
+            ],
+        )
+        conn.execute(
+            "DELETE FROM dictionaries WHERE dict_id NOT IN ("
+            "    SELECT dict_id FROM captures WHERE dict_id IS NOT NULL"
+            ") AND dict_id != ?",
+            (dict_id,),
+        )
+
+    (bytes_after,) = conn.execute("SELECT coalesce(sum(length(capture_data)), 0) FROM captures").fetchone()
+    return TrainResult(dict_id, len(dict_data), len(captures), bytes_before, bytes_after)
+
+
+class EvictionResult(typ.NamedTuple):
+    num_entries: int
+    num_bytes  : int
+
+
+def evict(
+    conn     : sqlite3.Connection,
+    max_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+    max_age  : dt.timedelta = DEFAULT_MAX_CACHE_AGE,
+    now      : typ.Optional[dt.datetime] = None,
+) -> EvictionResult:
+    """Evict least recently used entries.
+
+    Entries which were not used within max_age are evicted, as well as
+    the least recently used entries until the stored captures take up
+    no more than max_bytes.
+    """
+    min_last_used = ((now or dt.datetime.utcnow()) - max_age).isoformat()
+
+    evicted_rowids: list[int] = []
+    evicted_bytes = 0
+
+    retained_bytes   = 0
+    retained_digests = set()
+
+    for rowid, capture_digest, stored_size, last_used in conn.execute(SQLITE_LAST_USED):
+        if capture_digest in retained_digests:
+            # capture is retained by a more recently used entry
+            is_retained = last_used >= min_last_used
+        else:
+            is_retained = last_used >= min_last_used and retained_bytes + (stored_size or 0) <= max_bytes
+
+        if is_retained:
+            if capture_digest not in retained_digests:
+                retained_digests.add(capture_digest)
+                retained_bytes += stored_size or 0
+        else:
+            evicted_rowids.append(rowid)
+            evicted_bytes += stored_size or 0
+
+    if evicted_rowids:
+        with conn:
+            conn.executemany("DELETE FROM manifest WHERE rowid = ?", [(rowid,) for rowid in evicted_rowids])
+            conn.executescript(SQLITE_COMPACT)
+
+    return EvictionResult(len(evicted_rowids), evicted_bytes)
+
+
+def gc(conn: sqlite3.Connection) -> None:
+    """Drop superseded entries, unreferenced captures and reclaim disk space."""
+    with conn:
+        conn.executescript(SQLITE_COMPACT)
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+class CacheStats(typ.NamedTuple):
+    num_entries    : int
+    num_captures   : int
+    capture_bytes  : int
+    stored_bytes   : int
+    hits           : int
+    misses         : int
+    largest        : list[ManifestEntry]
+    slowest        : list[ManifestEntry]
+    codecs         : dict[str, int]
+    compress_mbps  : float
+    decompress_mbps: float
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.capture_bytes / self.stored_bytes if self.stored_bytes else 0.0
+
+
+def _measure_throughput(conn: sqlite3.Connection, max_samples: int) -> tuple[float, float]:
+    zdicts = _load_dicts(conn)
+    zdict  = _latest_dict(conn, DEFAULT_CODEC)
+
+    query = "SELECT capture_data, codec, dict_id FROM captures LIMIT ?"
+    rows  = conn.execute(query, (max_samples,)).fetchall()
+    if not rows:
+        return (0.0, 0.0)
+
+    t_start  = time.perf_counter()
+    captures = [
+        _decompress(data, codec, zdicts[dict_id] if dict_id else None) for data, codec, dict_id in rows
+    ]
+    decompress_time = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for capture_data in captures:
+        _compress(capture_data, DEFAULT_CODEC, zdict)
+    compress_time = time.perf_counter() - t_start
+
+    num_mbytes = sum(map(len, captures)) / 1_000_000
+    return (num_mbytes / max(compress_time, 1e-9), num_mbytes / max(decompress_time, 1e-9))
+
+
+def read_stats(conn: sqlite3.Connection, num_top_entries: int = 5) -> CacheStats:
+    (num_entries,) = conn.execute("SELECT count(*) FROM manifest").fetchone()
+    (capture_bytes,) = conn.execute(
+        "SELECT coalesce(sum(capture_size), 0) FROM ("
+        "    SELECT max(capture_size) AS capture_size FROM manifest GROUP BY capture_digest"
+        ")"
+    ).fetchone()
+    num_captures, stored_bytes = conn.execute(
+        "SELECT count(*), coalesce(sum(length(capture_data)), 0) FROM captures"
+    ).fetchone()
+
+    counters = dict(conn.execute("SELECT name, value FROM counters"))
+    codecs   = {
+        codec + (f"+dict{dict_id}" if dict_id else ""): count
+        for codec, dict_id, count in conn.execute(
+            "SELECT codec, dict_id, count(*) FROM captures GROUP BY codec, dict_id"
+        )
+    }
+    compress_mbps, decompress_mbps = _measure_throughput(conn, max_samples=100)
+
+    def _top_entries(order_by: str) -> list[ManifestEntry]:
+        query = f"SELECT {MANIFEST_COLUMNS} FROM manifest ORDER BY {order_by} DESC LIMIT ?"
+        return [ManifestEntry(*row) for row in conn.execute(query, (num_top_entries,))]
+
+    return CacheStats(
+        num_entries,
+        num_captures,
+        capture_bytes,
+        stored_bytes,
+        counters.get('hits'  , 0),
+        counters.get('misses', 0),
+        _top_entries('capture_size'),
+        _top_entries('runtime_ms'),
+        codecs,
+        compress_mbps,
+        decompress_mbps,
+    )
+
+
+def iter_project_cache_dirs() -> typ.Iterable[pl.Path]:
+    if config.CACHE_DIR.exists():
+        for db_file in sorted(config.CACHE_DIR.glob(f"*/{DB_FILENAME}")):
+            yield db_file.parent
 
-        # verify round trip
-        manifest = list(parse_manifest(manifest_text))
-        assert manifest == self.manifest
 
-        tmp_file = str(self._manifest_file) + ".tmp_" + uuid.uuid4().hex
-        with open(tmp_file, mode="w", encoding="utf-8") as fobj:
-            fobj.write(manifest_text)
+def open_project_db(cache_dir: pl.Path) -> sqlite3.Connection:
+    return _connect(cache_dir / DB_FILENAME)
 
-        os.rename(tmp_file, self._manifest_file)
 
-        self._db.close()
+def clear(cache_dir: pl.Path) -> None:
+    """Remove the cache files of a project (including those of the legacy cache)."""
+    for pattern in [DB_FILENAME + "*", "build_cache.db*", "build_cache.manifest_v*"]:
+        for fpath in cache_dir.glob(pattern):
+            fpath.unlink()
 
 
 # class RedisResultCache(ResultCache):
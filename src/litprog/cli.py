@@ -24,6 +24,10 @@ except ImportError:
     pass  # no need to fail because of missing dev dependency
 
 
+if typ.TYPE_CHECKING:
+    # pylint: disable=unused-import; lazy import of litprog.build to speed up cli
+    import litprog.build as lp_build
+
 InputPaths = typ.Sequence[str]
 
 click.disable_unicode_literals_warning = True  # type: ignore[attr-defined]
@@ -119,28 +123,22 @@ def _num_cpus() -> int:
 DEFAULT_CONCURRENCY = max(2, _num_cpus())
 
 
+def _parse_module_names(module_names: str) -> tuple[str, ...]:
+    return tuple(name.strip() for name in module_names.split(",") if name.strip())
+
+
 def _build(
-    input_paths    : InputPaths,
-    html           : typ.Optional[str],
-    pdf            : typ.Optional[str],
-    exitfirst      : bool = False,
-    in_place_update: bool = False,
-    cache_enabled  : bool = True,
-    concurrency    : int  = DEFAULT_CONCURRENCY,
+    input_paths: InputPaths,
+    html       : typ.Optional[str],
+    pdf        : typ.Optional[str],
+    build_opts : 'lp_build.BuildOptions',
 ) -> None:
     import litprog.build as lp_build
     import litprog.parse as lp_parse
 
-    build_opts = lp_build.BuildOptions(
-        exitfirst=exitfirst,
-        in_place_update=in_place_update,
-        cache_enabled=cache_enabled,
-        concurrency=concurrency,
-    )
-
     md_paths = _get_md_paths(input_paths)
 
-    parse_ctx = lp_parse.parse_context(md_paths)
+    parse_ctx = lp_parse.parse_context(md_paths, workers=build_opts.concurrency)
     doc_ctx   = lp_build.build(parse_ctx, build_opts)
 
     logger.info("build completed")
@@ -164,12 +162,37 @@ def _build(
     #   if we were to eagerly import this, then it would slow down every cli invokation,
     #   even those which don't generate --html or --pdf output.
     import litprog.gen_docs as lp_gen_docs
+    import litprog.capture_cache as lp_capture_cache
+
+    if build_opts.cache_enabled:
+        file_index = lp_capture_cache.open_file_index(parse_ctx.chapters)
+    else:
+        file_index = None
+
+    def _is_done(kind: str, out_dir: pl.Path) -> bool:
+        return bool(file_index and lp_build.is_docs_target_done(file_index, kind, out_dir, doc_ctx))
 
-    lp_gen_docs.gen_html(doc_ctx, html_dir)
+    pdf_dir     = pl.Path(pdf) if pdf else None
+    is_pdf_done = pdf_dir is not None and _is_done('pdf', pdf_dir)
 
-    if pdf:
-        pdf_dir = pl.Path(pdf)
+    if is_pdf_done and is_html_tmp_dir:
+        pass  # the html is only needed to generate the pdf
+    elif not is_html_tmp_dir and _is_done('html', html_dir):
+        logger.info(f"Skipping html, '{html_dir}' is up to date")
+    else:
+        lp_gen_docs.gen_html(doc_ctx, html_dir)
+        if file_index and not is_html_tmp_dir:
+            lp_build.mark_docs_target_done(file_index, 'html', html_dir, doc_ctx)
+
+    if pdf_dir and is_pdf_done:
+        logger.info(f"Skipping pdf, '{pdf_dir}' is up to date")
+    elif pdf_dir:
         lp_gen_docs.gen_pdf(doc_ctx, html_dir, pdf_dir)
+        if file_index:
+            lp_build.mark_docs_target_done(file_index, 'pdf', pdf_dir, doc_ctx)
+
+    if file_index:
+        lp_build.dump_file_index(file_index)
 
     if is_html_tmp_dir:
         shutil.rmtree(html_dir)
@@ -212,6 +235,67 @@ _opt_cache_enabled = click.option(
     help="Enable/disable block result cache. Default: enabled",
 )
 
+
+def _validate_session_engine(
+    ctx  : click.Context,
+    param: click.Parameter,
+    value: typ.Optional[str],
+) -> typ.Optional[str]:
+    # NOTE: The choices and the default are defined by litprog.session,
+    #   which is only imported if the option is used, so that it doesn't
+    #   slow down every cli invokation. If the option is not used, the
+    #   default is filled in when the BuildOptions are created.
+    if value is None:
+        return None
+
+    # pylint: disable=import-outside-toplevel ; lazy import
+    import litprog.session as lp_session
+
+    if value in lp_session.SESSION_ENGINES:
+        return value
+    else:
+        choices = ", ".join(lp_session.SESSION_ENGINES)
+        raise click.BadParameter(f"'{value}' is not one of {choices}")
+
+
+_opt_session_engine = click.option(
+    "--session-engine",
+    default=None,
+    callback=_validate_session_engine,
+    help=(
+        "How output of sub-processes is captured. 'thread' (default): two "
+        "reader threads per process. 'selector': a single event loop for "
+        "all processes."
+    ),
+)
+
+_opt_forkserver = click.option(
+    "--forkserver/--no-forkserver",
+    is_flag=True,
+    default=False,
+    help=(
+        "Execute 'exec: python3' blocks in processes forked from a warm "
+        "interpreter, rather than starting a new interpreter for each block. "
+        "Default: disabled"
+    ),
+)
+
+_opt_forkserver_preload = click.option(
+    "--forkserver-preload",
+    default="",
+    help="Comma separated list of modules for the forkserver to import before forking.",
+)
+
+_opt_remote_cache = click.option(
+    "--remote-cache",
+    default=None,
+    envvar="LITPROG_REMOTE_CACHE",
+    help=(
+        "Share block results with other machines via a remote cache, "
+        "eg. http://localhost:8722 (see 'lit cache-server') or redis://localhost:6379/0"
+    ),
+)
+
 _opt_verbose = click.option('-v', '--verbose', count=True, help="Control log level. -vv for debug level.")
 
 
@@ -231,23 +315,52 @@ def cli(verbose: int = 0) -> None:
 @_opt_in_place
 @_opt_concurrency
 @_opt_cache_enabled
+@_opt_session_engine
+@_opt_forkserver
+@_opt_forkserver_preload
+@_opt_remote_cache
 @_opt_verbose
 def build(
-    input_paths    : InputPaths,
-    html           : typ.Optional[str],
-    pdf            : typ.Optional[str],
-    exitfirst      : bool = False,
-    in_place_update: bool = False,
-    concurrency    : int  = DEFAULT_CONCURRENCY,
-    cache_enabled  : bool = True,
-    verbose        : int  = 0,
+    input_paths       : InputPaths,
+    html              : typ.Optional[str],
+    pdf               : typ.Optional[str],
+    exitfirst         : bool = False,
+    in_place_update   : bool = False,
+    concurrency       : int  = DEFAULT_CONCURRENCY,
+    cache_enabled     : bool = True,
+    session_engine    : typ.Optional[str] = None,
+    forkserver        : bool = False,
+    forkserver_preload: str  = "",
+    remote_cache      : typ.Optional[str] = None,
+    verbose           : int  = 0,
 ) -> None:
     _configure_logging(verbose)
 
+    if cache_enabled and html is None and pdf is None:
+        # NOTE: litprog.build is not imported for a no-op build, as
+        #   the import alone takes longer than the check.
+        import litprog.build_plan as lp_build_plan
+
+        plan_options = lp_build_plan.plan_options(in_place_update=in_place_update)
+        if lp_build_plan.is_noop_build(_get_md_paths(input_paths), plan_options):
+            logger.info("build completed (nothing changed)")
+            return
+
     import litprog.build as lp_build
 
+    build_opts = lp_build.BuildOptions(
+        exitfirst=exitfirst,
+        in_place_update=in_place_update,
+        cache_enabled=cache_enabled,
+        concurrency=concurrency,
+        session_engine=session_engine or lp_build.session.DEFAULT_SESSION_ENGINE,
+        forkserver=forkserver,
+        forkserver_preload=_parse_module_names(forkserver_preload),
+        remote_cache=remote_cache,
+    )
+
     try:
-        _build(input_paths, html, pdf, exitfirst, in_place_update, cache_enabled, concurrency)
+        _build(input_paths, html, pdf, build_opts)
     except (lp_build.BlockExecutionError, lp_build.BlockError) as err:
         print(err)
         sys.exit(1)
@@ -261,16 +374,24 @@ def build(
 @_opt_in_place
 @_opt_concurrency
 @_opt_cache_enabled
+@_opt_session_engine
+@_opt_forkserver
+@_opt_forkserver_preload
+@_opt_remote_cache
 @_opt_verbose
 def watch(
-    input_paths    : InputPaths,
-    html           : typ.Optional[str],
-    pdf            : typ.Optional[str],
-    exitfirst      : bool = False,
-    in_place_update: bool = False,
-    concurrency    : int  = DEFAULT_CONCURRENCY,
-    cache_enabled  : bool = True,
-    verbose        : int  = 0,
+    input_paths       : InputPaths,
+    html              : typ.Optional[str],
+    pdf               : typ.Optional[str],
+    exitfirst         : bool = False,
+    in_place_update   : bool = False,
+    concurrency       : int  = DEFAULT_CONCURRENCY,
+    cache_enabled     : bool = True,
+    session_engine    : typ.Optional[str] = None,
+    forkserver        : bool = False,
+    forkserver_preload: str  = "",
+    remote_cache      : typ.Optional[str] = None,
+    verbose           : int  = 0,
 ) -> None:
     _configure_logging(verbose)
 
@@ -281,9 +402,20 @@ def watch(
     import litprog.build as lp_build
     import litprog.watch as lp_watch
 
+    build_opts = lp_build.BuildOptions(
+        exitfirst=exitfirst,
+        in_place_update=in_place_update,
+        cache_enabled=cache_enabled,
+        concurrency=concurrency,
+        session_engine=session_engine or lp_build.session.DEFAULT_SESSION_ENGINE,
+        forkserver=forkserver,
+        forkserver_preload=_parse_module_names(forkserver_preload),
+        remote_cache=remote_cache,
+    )
+
     # initial build
     try:
-        _build(input_paths, html, pdf, exitfirst, in_place_update, cache_enabled, concurrency)
+        _build(input_paths, html, pdf, build_opts)
     except (lp_build.BlockExecutionError, lp_build.BlockError) as err:
         print(err)
 
@@ -291,7 +423,7 @@ def watch(
 
     def _build_cb(changes) -> None:
         try:
-            _build(input_paths, html, pdf, exitfirst, in_place_update, cache_enabled, concurrency)
+            _build(input_paths, html, pdf, build_opts)
         except (lp_build.BlockExecutionError, lp_build.BlockError) as err:
             print(err)
         # refresh mtimes after build, as they may have changed in the meantime
@@ -300,6 +432,235 @@ def watch(
     watcher.watch(callback=_build_cb)
 
 
+@cli.group()
+def cache() -> None:
+    """Inspect and maintain the build result cache."""
+
+
+def _project_cache_dirs(input_paths: InputPaths) -> typ.List[pl.Path]:
+    import litprog.parse as lp_parse
+    import litprog.capture_cache as lp_capture_cache
+
+    if input_paths:
+        md_paths   = _get_md_paths(input_paths)
+        parse_ctx  = lp_parse.parse_context(md_paths)
+        cache_dir  = lp_capture_cache.project_cache_dir(parse_ctx.chapters)
+        cache_dirs = [cache_dir] if (cache_dir / lp_capture_cache.DB_FILENAME).exists() else []
+    else:
+        cache_dirs = list(lp_capture_cache.iter_project_cache_dirs())
+
+    if not cache_dirs:
+        click.secho("No build cache found.", fg='yellow')
+    return cache_dirs
+
+
+def _fmt_bytes(num_bytes: float) -> str:
+    for unit in ["B", "KB", "MB"]:
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f}{unit}" if unit == "B" else f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f}GB"
+
+
+@cache.command()
+@_arg_input_paths
+@_opt_verbose
+def stats(input_paths: InputPaths, verbose: int = 0) -> None:
+    """Show hit rate, size and the largest/slowest entries."""
+    _configure_logging(verbose)
+    import litprog.capture_cache as lp_capture_cache
+
+    for cache_dir in _project_cache_dirs(input_paths):
+        conn = lp_capture_cache.open_project_db(cache_dir)
+        try:
+            cache_stats = lp_capture_cache.read_stats(conn)
+        finally:
+            conn.close()
+
+        click.secho(cache_dir.name, bold=True)
+        click.echo(f"    entries : {cache_stats.num_entries} ({cache_stats.num_captures} captures)")
+        hits_info = f"{cache_stats.hits} hits, {cache_stats.misses} misses"
+        click.echo(f"    hit rate: {cache_stats.hit_rate:.1%} ({hits_info})")
+        click.echo(
+            f"    stored  : {_fmt_bytes(cache_stats.stored_bytes)} "
+            f"(captures: {_fmt_bytes(cache_stats.capture_bytes)}, "
+            f"ratio: {cache_stats.compression_ratio:.2f})"
+        )
+        codecs = ", ".join(f"{codec}: {count}" for codec, count in sorted(cache_stats.codecs.items()))
+        click.echo(f"    codecs  : {codecs}")
+        click.echo(
+            f"    speed   : compress {cache_stats.compress_mbps:.1f}MB/s, "
+            f"decompress {cache_stats.decompress_mbps:.1f}MB/s"
+        )
+        click.echo("    largest:")
+        for entry in cache_stats.largest:
+            click.echo(f"        {_fmt_bytes(entry.capture_size):>8}  {entry.md_path}  {entry.task_info}")
+        click.echo("    slowest:")
+        for entry in cache_stats.slowest:
+            click.echo(f"        {entry.runtime_ms:>6}ms  {entry.md_path}  {entry.task_info}")
+
+
+@cache.command()
+@_arg_input_paths
+@click.option(
+    "--max-bytes",
+    type=int,
+    default=None,
+    help="Evict least recently used entries until the cache is at most this size (per project).",
+)
+@click.option(
+    "--max-age-days",
+    type=int,
+    default=None,
+    help="Evict entries which were not used within this number of days.",
+)
+@_opt_verbose
+def prune(
+    input_paths : InputPaths,
+    max_bytes   : typ.Optional[int],
+    max_age_days: typ.Optional[int],
+    verbose     : int = 0,
+) -> None:
+    """Apply the eviction policy to the build cache."""
+    _configure_logging(verbose)
+    import datetime as dt
+
+    import litprog.capture_cache as lp_capture_cache
+
+    # NOTE: The defaults are defined by litprog.capture_cache, which is
+    #   only imported here, so that it doesn't slow down every cli invokation.
+    if max_bytes is None:
+        max_bytes = lp_capture_cache.DEFAULT_MAX_CACHE_BYTES
+    if max_age_days is None:
+        max_age = lp_capture_cache.DEFAULT_MAX_CACHE_AGE
+    else:
+        max_age = dt.timedelta(days=max_age_days)
+
+    for cache_dir in _project_cache_dirs(input_paths):
+        conn = lp_capture_cache.open_project_db(cache_dir)
+        try:
+            evicted = lp_capture_cache.evict(conn, max_bytes, max_age)
+        finally:
+            conn.close()
+        evicted_size = _fmt_bytes(evicted.num_bytes)
+        click.echo(f"{cache_dir.name}: evicted {evicted.num_entries} entries ({evicted_size})")
+
+
+@cache.command()
+@_arg_input_paths
+@_opt_verbose
+def gc(input_paths: InputPaths, verbose: int = 0) -> None:
+    """Remove superseded entries and unreferenced captures, reclaim disk space.
+
+    Entries of the parse cache which were not used within the last
+    90 days are removed as well.
+    """
+    _configure_logging(verbose)
+    import litprog.parse as lp_parse
+    import litprog.capture_cache as lp_capture_cache
+
+    for cache_dir in _project_cache_dirs(input_paths):
+        db_file     = cache_dir / lp_capture_cache.DB_FILENAME
+        size_before = db_file.stat().st_size
+        conn        = lp_capture_cache.open_project_db(cache_dir)
+        try:
+            lp_capture_cache.gc(conn)
+        finally:
+            conn.close()
+        size_after = db_file.stat().st_size
+        click.echo(f"{cache_dir.name}: {_fmt_bytes(size_before)} -> {_fmt_bytes(size_after)}")
+
+    num_evicted = lp_parse.evict_parse_cache(lp_capture_cache.DEFAULT_MAX_CACHE_AGE)
+    click.echo(f"parse cache: evicted {num_evicted} entries")
+
+
+@cache.command()
+@_arg_input_paths
+@click.option(
+    "--dict-size",
+    type=int,
+    default=None,
+    help="Size of the compression dictionary in bytes.",
+)
+@_opt_verbose
+def train(input_paths: InputPaths, dict_size: typ.Optional[int], verbose: int = 0) -> None:
+    """Train a compression dictionary from the cached captures."""
+    _configure_logging(verbose)
+    import litprog.capture_cache as lp_capture_cache
+
+    if dict_size is None:
+        dict_size = lp_capture_cache.DEFAULT_DICT_SIZE
+
+    for cache_dir in _project_cache_dirs(input_paths):
+        conn = lp_capture_cache.open_project_db(cache_dir)
+        try:
+            result = lp_capture_cache.train(conn, dict_size=dict_size)
+        except ValueError as err:
+            click.secho(f"{cache_dir.name}: {err}", fg='yellow')
+            continue
+        finally:
+            conn.close()
+
+        click.echo(
+            f"{cache_dir.name}: dictionary {result.dict_id} ({_fmt_bytes(result.dict_size)}) "
+            f"for {result.num_captures} captures, "
+            f"{_fmt_bytes(result.bytes_before)} -> {_fmt_bytes(result.bytes_after)}"
+        )
+
+
+@cache.command()
+@_arg_input_paths
+@_opt_verbose
+def clear(input_paths: InputPaths, verbose: int = 0) -> None:
+    """Remove all entries of the build cache and the parse cache."""
+    _configure_logging(verbose)
+    import litprog.parse as lp_parse
+    import litprog.capture_cache as lp_capture_cache
+
+    for cache_dir in _project_cache_dirs(input_paths):
+        lp_capture_cache.clear(cache_dir)
+        click.echo(f"{cache_dir.name}: cleared")
+
+    md_paths    = _get_md_paths(input_paths) if input_paths else None
+    num_cleared = lp_parse.clear_parse_cache(md_paths)
+    click.echo(f"parse cache: cleared {num_cleared} entries")
+
+
+@cli.command(name="cache-server")
+@click.option("--host", default="127.0.0.1", help="Interface to listen on.")
+@click.option("--port", default=8722, help="Port to listen on.")
+@click.option(
+    "--data-dir",
+    type=click.Path(file_okay=False, writable=True),
+    default=None,
+    help="Directory for stored captures. Default: ~/.cache/litprog/server",
+)
+@click.option(
+    "--max-body-size",
+    type=int,
+    default=None,
+    help="Reject requests with a larger body (in bytes). Default: 256MiB",
+)
+@_opt_verbose
+def cache_server(
+    host         : str,
+    port         : int,
+    data_dir     : typ.Optional[str],
+    max_body_size: typ.Optional[int],
+    verbose      : int = 0,
+) -> None:
+    """Serve a shared build result cache (see build --remote-cache)."""
+    _configure_logging(max(1, verbose))
+    import litprog.cache_server as lp_cache_server
+
+    lp_cache_server.serve(
+        host,
+        port,
+        pl.Path(data_dir) if data_dir else lp_cache_server.DEFAULT_DATA_DIR,
+        lp_cache_server.DEFAULT_MAX_BODY_SIZE if max_body_size is None else max_body_size,
+    )
+
+
 MARKDOWN_FILE_EXTENSIONS = {
     "markdown",
     "mdown",
@@ -31,6 +31,7 @@ class SessionBlockOptions(typ.NamedTuple):
 
     provides_id         : typ.Optional[str]
     requires_ids        : set[str]
+    input_globs         : list[str]
     timeout             : float
     input_delay         : float
     expected_exit_status: int
@@ -72,17 +73,103 @@ class Directive(typ.NamedTuple):
     raw_text: str
 
 
-class Block(typ.NamedTuple):
+# (start, end) offsets into Block.content
+Span = tuple[int, int]
 
-    md_path           : Path
-    namespace         : str
-    first_line        : int
-    elem_index        : int
-    info_string       : InfoString
-    directives        : list[Directive]
-    content           : str
-    inner_content     : str
-    includable_content: str
+# Spans flattened to (start_0, end_0, start_1, end_1, ...), which
+# is about half the size of a tuple of Span tuples.
+FlatSpans = tuple[int, ...]
+
+
+def _join_spans(content: str, spans: FlatSpans) -> str:
+    if len(spans) == 2:
+        return content[spans[0] : spans[1]]
+    else:
+        return "".join(content[spans[idx] : spans[idx + 1]] for idx in range(0, len(spans), 2))
+
+
+class Block:
+    """A fenced block of a MarkdownElement.
+
+    The inner_content (without fences) and the includable_content
+    (without directives) are stored as spans of the content, they
+    are only materialized when they are accessed.
+    """
+
+    __slots__ = (
+        'md_path',
+        'namespace',
+        'first_line',
+        'elem_index',
+        'info_string',
+        'directives',
+        'content',
+        '_inner_spans',
+        '_includable_spans',
+    )
+
+    md_path    : Path
+    namespace  : str
+    first_line : int
+    elem_index : int
+    info_string: InfoString
+    directives : list[Directive]
+    content    : str
+
+    _inner_spans     : FlatSpans
+    _includable_spans: FlatSpans
+
+    def __init__(
+        self,
+        md_path         : Path,
+        namespace       : str,
+        first_line      : int,
+        elem_index      : int,
+        info_string     : InfoString,
+        directives      : list[Directive],
+        content         : str,
+        inner_spans     : FlatSpans,
+        includable_spans: FlatSpans,
+    ) -> None:
+        self.md_path           = md_path
+        self.namespace         = namespace
+        self.first_line        = first_line
+        self.elem_index        = elem_index
+        self.info_string       = info_string
+        self.directives        = directives
+        self.content           = content
+        self._inner_spans      = inner_spans
+        self._includable_spans = includable_spans
+
+    @property
+    def inner_content(self) -> str:
+        return _join_spans(self.content, self._inner_spans)
+
+    @property
+    def includable_content(self) -> str:
+        return _join_spans(self.content, self._includable_spans)
+
+    def _key(self) -> tuple[typ.Any, ...]:
+        return (
+            self.md_path,
+            self.namespace,
+            self.first_line,
+            self.elem_index,
+            self.info_string,
+            self.directives,
+            self.content,
+            self._inner_spans,
+            self._includable_spans,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Block) and self._key() == other._key()
+
+    # mutable like the NamedTuple it replaced (which had a list field)
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"Block('{self.md_path}', {self.first_line}, {self.elem_index}, '{self.info_string}', ...)"
 
 
 class TaskBlockOpts(typ.NamedTuple):
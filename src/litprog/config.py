@@ -19,3 +19,6 @@ DATA_HOME   = pl.Path(os.getenv('XDG_DATA_HOME'  , FALLBACK_DATA_HOME  ))
 CONFIG_DIR  = CONFIG_HOME / "litprog"
 CACHE_DIR   = CACHE_HOME  / "litprog"
 ENVDIR_BASE = DATA_HOME   / "litprog"
+
+# Enables (expensive) consistency checks
+DEBUG = os.getenv('LITPROG_DEBUG', "0") not in ("", "0")
@@ -0,0 +1,498 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Warm interpreter for 'exec: python3' blocks.
+
+Starting a fresh interpreter and importing the same modules for every
+block is usually much more expensive than executing the block itself.
+A ForkServer starts the interpreter once, imports a list of modules and
+then forks a child process for each block. The child reads the block
+from stdin and executes it just as 'python3' would if the block was
+written to its stdin.
+
+NOTE: The source of this module is passed to the interpreter via '-c'
+  and the server may run on a different version of python than litprog
+  itself. It must therefore only use the standard library and not use
+  any syntax/typing features that require a recent version of python.
+"""
+
+import io
+import os
+import sys
+import json
+import array
+import shlex
+import shutil
+import signal
+import socket
+import typing as typ
+import logging
+import tempfile
+import selectors
+import threading
+import subprocess as sp
+
+logger = logging.getLogger("litprog.forkserver")
+
+
+# Commands for which a ForkServer can be used. The child process behaves
+# the same as if the command was invoked with the block written to stdin.
+FORKSERVER_COMMANDS = {"python3"}
+
+READY_MESSAGE = b"ready\n"
+
+MAX_FDS = 3
+
+
+class ForkServerError(Exception):
+    pass
+
+
+def _exit_code(status: int) -> int:
+    # same as os.waitstatus_to_exitcode (which requires python >= 3.9)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+
+def _send_fds(conn: socket.socket, msg: bytes, fds: typ.List[int]) -> None:
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    conn.sendmsg([msg], ancdata)
+
+
+def _recv_fds(conn: socket.socket) -> typ.Tuple[bytes, typ.List[int]]:
+    fds     = array.array("i")
+    cmsglen = socket.CMSG_LEN(MAX_FDS * fds.itemsize)
+    msg, ancdata, _flags, _addr = conn.recvmsg(1024, cmsglen)
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            usable_len = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
+            fds.frombytes(cmsg_data[:usable_len])
+    return msg, list(fds)
+
+
+def _recv_request(conn: socket.socket) -> typ.Tuple[typ.Optional[typ.Dict[str, str]], typ.List[int]]:
+    # A request is the line "fork <payload_len>" followed by the
+    # environment of the child as json (null for the server environment).
+    data, fds = _recv_fds(conn)
+    try:
+        while b"\n" not in data:
+            chunk = conn.recv(1024)
+            if not chunk:
+                raise ValueError("Incomplete request")
+            data += chunk
+
+        header, payload = data.split(b"\n", 1)
+        cmd, payload_len = header.split(b" ")
+        if cmd != b"fork":
+            raise ValueError(f"Invalid request: {header!r}")
+
+        while len(payload) < int(payload_len):
+            chunk = conn.recv(int(payload_len) - len(payload))
+            if not chunk:
+                raise ValueError("Incomplete request")
+            payload += chunk
+
+        return json.loads(payload.decode("utf-8")), fds
+    except (OSError, ValueError):
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+# -- Server (runs in the warm interpreter) --
+
+
+def _reopen_stdio() -> None:
+    # NOTE: The objects for sys.stdout etc. of the server were created
+    #   for the file descriptors of the server. They are replaced with
+    #   new objects using the same settings as python would use on startup.
+    def _reopen(fd: int, mode: str, orig: typ.Any) -> typ.Any:
+        line_buffering = getattr(orig, 'line_buffering', False)
+        write_through  = getattr(orig, 'write_through' , False)
+        if mode == "w" and write_through:
+            buffer = open(fd, "wb", buffering=0, closefd=False)  # pylint: disable=consider-using-with
+        else:
+            buffer = open(fd, mode + "b", closefd=False)  # pylint: disable=consider-using-with
+
+        return io.TextIOWrapper(
+            buffer,
+            encoding=orig.encoding,
+            errors=orig.errors,
+            line_buffering=line_buffering,
+            write_through=write_through,
+        )
+
+    sys.stdin  = sys.__stdin__  = _reopen(0, "r", sys.__stdin__ or sys.stdin)
+    sys.stdout = sys.__stdout__ = _reopen(1, "w", sys.__stdout__ or sys.stdout)
+    sys.stderr = sys.__stderr__ = _reopen(2, "w", sys.__stderr__ or sys.stderr)
+
+
+def _system_exit_code(ex: SystemExit) -> int:
+    # same handling as for an uncaught SystemExit by the interpreter
+    code = ex.code
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    else:
+        sys.stderr.write(str(code) + "\n")
+        return 1
+
+
+def _run_child(fds: typ.List[int], env: typ.Optional[typ.Dict[str, str]]) -> None:
+    # pylint: disable=broad-except; the child must never return into the server
+    import types
+    import atexit
+
+    exit_code = 1
+    try:
+        in_fd, out_fd, err_fd = fds
+        os.dup2(in_fd , 0)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        for fd in fds:
+            os.close(fd)
+
+        _reopen_stdio()
+
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+
+        if 'random' in sys.modules:
+            # don't share the random state between children
+            sys.modules['random'].seed()
+
+        sys.argv = [""]
+        if not sys.path or sys.path[0] != "":
+            sys.path.insert(0, "")
+
+        main_module = types.ModuleType("__main__")
+        main_module.__dict__['__builtins__'] = __builtins__
+        sys.modules['__main__'] = main_module
+
+        source = sys.stdin.buffer.read()
+        try:
+            code = compile(source, "<stdin>", "exec")
+            exec(code, main_module.__dict__)  # pylint: disable=exec-used
+            exit_code = 0
+        except SystemExit as ex:
+            exit_code = _system_exit_code(ex)
+        except BaseException:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            # skip the frame of _run_child
+            tb = exc_tb.tb_next if exc_tb and exc_tb.tb_next else exc_tb
+            sys.excepthook(exc_type, exc_value, tb)  # type: ignore[arg-type]
+            exit_code = 1
+
+        # same order as on interpreter shutdown: first wait for non-daemon
+        # threads, then run atexit handlers.
+        try:
+            threading._shutdown()  # type: ignore[attr-defined]  # pylint: disable=protected-access
+        except BaseException:
+            pass
+
+        try:
+            atexit._run_exitfuncs()  # pylint: disable=protected-access
+        except SystemExit as ex:
+            exit_code = _system_exit_code(ex)
+        except BaseException:
+            pass
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def _serve(sock_path: str, preload_modules: typ.List[str]) -> None:
+    import importlib
+
+    for module_name in preload_modules:
+        try:
+            importlib.import_module(module_name)
+        except Exception as ex:  # pylint: disable=broad-except
+            sys.stderr.write(f"litprog.forkserver: Error importing {module_name}: {ex}\n")
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(64)
+
+    # SIGCHLD is delivered via a pipe, so that the server can wait
+    # for new requests and the exit of children at the same time.
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(server  , selectors.EVENT_READ, 'accept')
+    selector.register(wakeup_r, selectors.EVENT_READ, 'sigchld')
+
+    conns_by_pid: typ.Dict[int, socket.socket] = {}
+
+    sys.stdout.buffer.write(READY_MESSAGE)
+    sys.stdout.flush()
+
+    while True:
+        for key, _events in selector.select():
+            if key.data == 'accept':
+                conn, _ = server.accept()
+                try:
+                    env, fds = _recv_request(conn)
+                except (OSError, ValueError) as ex:
+                    sys.stderr.write(f"litprog.forkserver: Invalid request: {ex}\n")
+                    conn.close()
+                    continue
+
+                if len(fds) != 3:
+                    for fd in fds:
+                        os.close(fd)
+                    conn.close()
+                    continue
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    signal.set_wakeup_fd(-1)
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    selector.close()
+                    for _conn in list(conns_by_pid.values()) + [conn, server]:
+                        _conn.close()
+                    os.close(wakeup_r)
+                    os.close(wakeup_w)
+                    _run_child(fds, env)
+
+                for fd in fds:
+                    os.close(fd)
+                conn.sendall(f"{pid}\n".encode("ascii"))
+                conns_by_pid[pid] = conn
+            else:
+                try:
+                    os.read(wakeup_r, 1024)
+                except BlockingIOError:
+                    pass
+
+                while conns_by_pid:
+                    try:
+                        pid, status = os.waitpid(-1, os.WNOHANG)
+                    except ChildProcessError:
+                        break
+                    if pid == 0:
+                        break
+
+                    conn = conns_by_pid.pop(pid, None)
+                    if conn:
+                        try:
+                            conn.sendall(f"{_exit_code(status)}\n".encode("ascii"))
+                        except OSError:
+                            pass  # client is gone
+                        conn.close()
+
+
+# -- Client (runs in the litprog build process) --
+
+
+class ForkedProcess:
+    """Stand in for subprocess.Popen for a child of a ForkServer."""
+
+    pid       : int
+    returncode: typ.Optional[int]
+    stdin     : typ.IO[bytes]
+    stdout    : typ.IO[bytes]
+    stderr    : typ.IO[bytes]
+
+    _conn: socket.socket
+    _buf : bytes
+
+    def __init__(
+        self,
+        conn  : socket.socket,
+        stdin : typ.IO[bytes],
+        stdout: typ.IO[bytes],
+        stderr: typ.IO[bytes],
+    ) -> None:
+        self._conn      = conn
+        self._buf       = b""
+        self.returncode = None
+        self.stdin      = stdin
+        self.stdout     = stdout
+        self.stderr     = stderr
+
+        pid_line = self._recv_line(timeout=None)
+        if pid_line is None:
+            raise ForkServerError("No response from forkserver")
+        self.pid = int(pid_line)
+
+    def _recv_line(self, timeout: typ.Optional[float]) -> typ.Optional[bytes]:
+        self._conn.settimeout(timeout)
+        while b"\n" not in self._buf:
+            try:
+                data = self._conn.recv(64)
+            except (BlockingIOError, socket.timeout):
+                return None
+
+            if not data:
+                raise ForkServerError("Connection to forkserver closed")
+            self._buf += data
+
+        line, self._buf = self._buf.split(b"\n", 1)
+        return line
+
+    def poll(self) -> typ.Optional[int]:
+        if self.returncode is None:
+            line = self._recv_line(timeout=0)
+            if line is not None:
+                self.returncode = int(line)
+                self._conn.close()
+        return self.returncode
+
+    def wait(self, timeout: typ.Optional[float] = None) -> int:
+        if self.returncode is None:
+            line = self._recv_line(timeout=timeout)
+            if line is None:
+                raise sp.TimeoutExpired(f"forked process {self.pid}", typ.cast(float, timeout))
+            self.returncode = int(line)
+            self._conn.close()
+        return self.returncode
+
+    def send_signal(self, signum: int) -> None:
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+
+def _server_source() -> str:
+    with open(__file__, mode="r", encoding="utf-8") as fobj:
+        return fobj.read()
+
+
+class ForkServer:
+
+    command        : str
+    preload_modules: typ.List[str]
+    is_broken      : bool
+
+    _tmp_dir  : str
+    _sock_path: str
+    _proc     : sp.Popen
+
+    def __init__(self, command: str, preload_modules: typ.Sequence[str] = ()) -> None:
+        self.command         = command
+        self.preload_modules = list(preload_modules)
+        self.is_broken       = False
+
+        self._tmp_dir   = tempfile.mkdtemp(prefix="litprog_forkserver_")
+        self._sock_path = os.path.join(self._tmp_dir, "server.sock")
+
+        cmd_parts = shlex.split(command) + ["-c", _server_source(), self._sock_path] + self.preload_modules
+        self._proc = sp.Popen(cmd_parts, stdin=sp.DEVNULL, stdout=sp.PIPE)
+
+        assert self._proc.stdout is not None
+        ready = self._proc.stdout.readline()
+        if ready != READY_MESSAGE:
+            self.close()
+            raise ForkServerError(f"Failed to start forkserver for '{command}'")
+
+        logger.info(f"Started forkserver for '{command}' with pid {self._proc.pid}")
+
+    def spawn(self, cmd_parts: typ.List[str], env: typ.Optional[typ.Mapping[str, str]] = None) -> typ.Any:
+        """Start a child process, or fall back to a normal subprocess.
+
+        NOTE: The env is applied in the child after the fork, so modules
+          preloaded by the ForkServer were imported with the environment
+          of the build when the server was started.
+        """
+        if not self.is_broken:
+            try:
+                return self._fork(env)
+            except (OSError, ForkServerError) as ex:
+                logger.warning(f"Forkserver for '{self.command}' failed, using subprocess instead: {ex}")
+                self.is_broken = True
+
+        return sp.Popen(cmd_parts, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, env=env)
+
+    def _fork(self, env: typ.Optional[typ.Mapping[str, str]]) -> ForkedProcess:
+        payload = json.dumps(None if env is None else dict(env)).encode("utf-8")
+        header  = f"fork {len(payload)}\n".encode("ascii")
+
+        in_r , in_w  = os.pipe()
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self._sock_path)
+            _send_fds(conn, header, [in_r, out_w, err_w])
+            conn.sendall(payload)
+        except OSError:
+            conn.close()
+            for fd in (in_r, in_w, out_r, out_w, err_r, err_w):
+                os.close(fd)
+            raise
+
+        for fd in (in_r, out_w, err_w):
+            os.close(fd)
+
+        stdin  = os.fdopen(in_w , mode="wb")
+        stdout = os.fdopen(out_r, mode="rb")
+        stderr = os.fdopen(err_r, mode="rb")
+        return ForkedProcess(conn, stdin, stdout, stderr)
+
+    def close(self) -> None:
+        if self._proc.poll() is None:
+            self._proc.terminate()
+            self._proc.wait()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+class ForkServerPool:
+    """Lazily started ForkServer instances, one per command."""
+
+    preload_modules: typ.List[str]
+
+    _servers: typ.Dict[str, typ.Optional[ForkServer]]
+    _lock   : threading.Lock
+
+    def __init__(self, preload_modules: typ.Sequence[str] = ()) -> None:
+        self.preload_modules = list(preload_modules)
+        self._servers        = {}
+        self._lock           = threading.Lock()
+
+    def get(self, command: str) -> typ.Optional[ForkServer]:
+        if command not in FORKSERVER_COMMANDS:
+            return None
+
+        with self._lock:
+            if command not in self._servers:
+                try:
+                    self._servers[command] = ForkServer(command, self.preload_modules)
+                except (OSError, ForkServerError) as ex:
+                    logger.warning(f"Could not start forkserver for '{command}': {ex}")
+                    self._servers[command] = None
+            return self._servers[command]
+
+    def close(self) -> None:
+        with self._lock:
+            for server in self._servers.values():
+                if server:
+                    server.close()
+            self._servers.clear()
+
+
+if __name__ == '__main__':
+    _serve(sys.argv[1], sys.argv[2:])
@@ -37,7 +37,9 @@ import socket
 import typing as typ
 import hashlib
 import logging
+import threading
 import pathlib as pl
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -65,7 +67,7 @@ def _machine_id() -> str:
     return f"{node}_{host}"
 
 
-IS_BLAKE2_AVAILABLE = False
+IS_BLAKE2_AVAILABLE = True
 
 try:
     hashlib.new('blake2b')
@@ -74,16 +76,31 @@ except ValueError as ex:
     IS_BLAKE2_AVAILABLE = False
 
 
+# Number of threads used to calculate digests. Hashing releases the GIL,
+# so this helps even for a single process.
+DEFAULT_DIGEST_WORKERS = min(8, os.cpu_count() or 1)
+
+
 HexDigest = str
 
 
-def _file_digest(path: pl.Path) -> HexDigest:
+def _new_digest() -> typ.Any:
     # https://blake2.net/
     if IS_BLAKE2_AVAILABLE:
-        id_sum = hashlib.new('blake2b')
+        return hashlib.new('blake2b')
     else:
-        id_sum = hashlib.new('sha1')
+        return hashlib.new('sha1')
+
+
+def content_digest(data: bytes) -> HexDigest:
+    """Digest of data, equal to the digest of a file with the same content."""
+    id_sum = _new_digest()
+    id_sum.update(data)
+    return id_sum.hexdigest()
 
+
+def _file_digest(path: pl.Path) -> HexDigest:
+    id_sum = _new_digest()
     with path.open(mode="rb") as fobj:
         while True:
             chunk = fobj.read(65536)
@@ -151,6 +168,23 @@ def mk_stat(path: pl.Path) -> Stat:
     )
 
 
+def _maybe_stat(path: pl.Path) -> typ.Optional[Stat]:
+    try:
+        return mk_stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _is_same_stat(stat_a: Stat, stat_b: Stat) -> bool:
+    # NOTE: The atime changes whenever a file is read (depending
+    #   on mount options), which doesn't make it dirty.
+    return stat_a._replace(atime=0.0) == stat_b._replace(atime=0.0)
+
+
+class IndexConflictError(Exception):
+    pass
+
+
 class IndexEntry(typ.NamedTuple):
 
     path  : pl.Path
@@ -184,11 +218,19 @@ class Index:
     entries: EntryByKey
     targets: EntryKeysByTarget
 
+    # Results of check_path during the lifetime of the Index (i.e. one
+    # build), so that the digest of a file is calculated at most once
+    # (unless the file is modified during the build).
+    _checks: typ.Dict[EntryKey, typ.Tuple[typ.Optional[Stat], CheckResult]]
+    _lock  : threading.RLock
+
     def __init__(self, index_file: pl.Path) -> None:
         self.index_file = index_file
         self.machine_id = _machine_id()
         self.entries    = {}
         self.targets    = {}
+        self._checks    = {}
+        self._lock      = threading.RLock()
 
         try:
             if self.index_file.exists():
@@ -255,50 +297,97 @@ class Index:
         if self.has_index_changed():
             tmp_file.unlink()
             err_msg = "WARNING: Concurrent update of index detected. This may result in a corrupted build."
-            raise Exception(err_msg)
+            raise IndexConflictError(err_msg)
         else:
             tmp_file.rename(self.index_file)
 
     def has_index_changed(self) -> bool:
         if not self.index_file.exists():
             return True
-        elif self.index_stat != mk_stat(self.index_file):
+        elif not _is_same_stat(self.index_stat, mk_stat(self.index_file)):
             return True
         else:
             return False
 
     def add_files(self, paths: typ.Iterable[pl.Path]) -> None:
+        paths = list(paths)
+        self.check_paths(paths)
         for path in paths:
             self.add_file(path)
 
     def add_file(self, path: pl.Path) -> None:
-        check = self.check_path(path)
-        if check.ok:
+        check      = self.check_path(path)
+        key        = entry_key(path)
+        prev_entry = self.entries.get(key)
+        if check.ok and prev_entry and _is_same_stat(prev_entry.stat, mk_stat(path)):
             return
 
+        # NOTE: If the file was only touched, the entry is updated
+        #   with the new stat, so the digest isn't calculated again.
         entry = make_entry(path, check)
-        self.entries[entry_key(path)] = entry
+        with self._lock:
+            self.entries[key] = entry
+            if entry:
+                self._checks[key] = (entry.stat, CheckResult(True, entry.digest))
+            else:
+                self._checks.pop(key, None)
+
+    def set_digest(self, path: pl.Path, digest: HexDigest) -> None:
+        """Update the entry of a file that was just written with content of a known digest."""
+        entry = IndexEntry(path=path, stat=mk_stat(path), digest=digest)
+        with self._lock:
+            self.entries[entry_key(path)] = entry
+            self._checks[entry_key(path)] = (entry.stat, CheckResult(True, digest))
+
+    def digest(self, path: pl.Path) -> typ.Optional[HexDigest]:
+        """Digest of the current content of path, None if it doesn't exist."""
+        self.add_file(path)
+        entry = self.entries.get(entry_key(path))
+        return entry.digest if entry else None
+
+    def check_paths(self, paths: typ.Iterable[pl.Path], max_workers: int = DEFAULT_DIGEST_WORKERS) -> None:
+        """Check many paths at once, digests are calculated in parallel."""
+        unchecked = {entry_key(path): path for path in paths}
+        if len(unchecked) > 1 and max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for _ in executor.map(self.check_path, unchecked.values()):
+                    pass
+        else:
+            for path in unchecked.values():
+                self.check_path(path)
 
     def check_path(self, path: pl.Path) -> CheckResult:
+        key  = entry_key(path)
+        stat = _maybe_stat(path)
+        if key in self._checks:
+            prev_stat, prev_check = self._checks[key]
+            if stat is None and prev_stat is None:
+                return prev_check
+            elif stat and prev_stat and _is_same_stat(stat, prev_stat):
+                return prev_check
+
+        check = self._check_path(path)
+        with self._lock:
+            self._checks[key] = (stat, check)
+        return check
+
+    def _check_path(self, path: pl.Path) -> CheckResult:
         # NOTE: There could be different levels of
         #   dirtyness.
         #   strict: hash and mtime must be unchanged
         #   hash: hash must be unchanged
-        if entry_key(path) not in self.entries:
-            return CheckResult(False, "")
-
-        entry = self.entries[entry_key(path)]
+        entry = self.entries.get(entry_key(path))
         if entry is None:
-            return CheckResult(False, "")
+            # NOTE: The digest is calculated here (rather than in
+            #   make_entry), so that it is done in parallel by check_paths.
+            return CheckResult(False, _file_digest(path) if path.exists() else "")
         elif not entry.path.exists():
             return CheckResult(False, "")
-        elif entry.stat != mk_stat(path):
-            return CheckResult(False, "")
-        elif entry.stat.mtime <= self.index_stat.mtime - 2:
+        elif _is_same_stat(entry.stat, mk_stat(path)) and entry.stat.mtime <= self.index_stat.mtime - 2:
             # If mtime is very new, then it can't be trusted.
             return CheckResult(True, entry.digest)
         else:
-            # fallback to digest check
+            # fallback to digest check, a file that was only touched is unchanged
             new_digest = _file_digest(path)
             check_ok   = new_digest == entry.digest
             return CheckResult(check_ok, new_digest)
@@ -349,7 +438,15 @@ def selftest() -> ExitStatus:
     for dep in deps:
         dep.touch()
     print("done?", idx.is_target_done('moep', deps))
-    assert not idx.is_target_done('moep', deps)
+    # a file that was only touched is unchanged
+    assert idx.is_target_done('moep', deps)
+
+    tmp_dep = pl.Path(".litprog.index.selftest")
+    tmp_dep.write_text("a")
+    idx.mark_target_done('moep', deps | {tmp_dep})
+    tmp_dep.write_text("b")
+    assert not idx.is_target_done('moep', deps | {tmp_dep})
+    tmp_dep.unlink()
     idx.mark_target_done('moep', deps)
 
     idx.add_files(filepaths)
@@ -3,12 +3,21 @@
 #
 # Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
 # SPDX-License-Identifier: MIT
+import os
 import re
+import json
+import time
+import bisect
 import typing as typ
+import hashlib
 import logging
+import tempfile
 import collections
+import datetime as dt
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
+from . import config
 from . import common_types as ct
 
 logger = logging.getLogger(__name__)
@@ -225,6 +234,8 @@ BLOCK_END_RE = {
     "~~~": _re(r"(\r\n|\r|\n)~~~", flags=re.VERBOSE | re.MULTILINE),
 }
 
+NEWLINE_RE = re.compile(r"\n")
+
 IMAGE_URL_RE = _re(IMAGE_URL_PATTERN, flags=re.VERBOSE | re.MULTILINE)
 
 
@@ -250,6 +261,16 @@ Successor = typ.Optional['MarkdownElement']
 
 class MarkdownElement:
 
+    __slots__ = (
+        'md_path',
+        'first_line',
+        'elem_index',
+        'md_type',
+        'content',
+        '_successor',
+        'src_md_paths',
+    )
+
     md_path     : Path
     first_line  : int
     elem_index  : int
@@ -345,6 +366,7 @@ VALID_DIRECTIVES = {
     'file',
     # build system
     'requires',  # comma separated globs for ids to invalidate block
+    'inputs',  # comma separated globs for files read by an exec/run block
     # 'cache'   # yes|once|never
     # 'stateful',
     # 'pure',
@@ -364,54 +386,82 @@ assert VALID_INLINE_DIRECTIVES < VALID_ARG_DIRECTIVES
 assert VALID_NOARG_DIRECTIVES  < VALID_DIRECTIVES
 
 
-def has_directive(comment_text: str, is_prelude: bool, language: typ.Optional[str] = None) -> bool:
-    if language is not None:
-        comment_start_re, comment_end_re = LANGUAGE_COMMENT_REGEXES[language]
-        start_match = comment_start_re.search(comment_text)
-        if start_match is None:
-            return False
+DIRECTIVE_NAMES = {name: name for name in VALID_DIRECTIVES}
 
-        comment_text = comment_text[start_match.end() :]
-        end_match    = comment_end_re.search(comment_text)
-        if end_match is None:
-            return False
 
-    comment_text = comment_text.strip()
-    if is_prelude:
-        if comment_text in VALID_NOARG_DIRECTIVES:
-            return True
+def _directive_names_pattern(names: set[str]) -> str:
+    return "|".join(re.escape(name) for name in sorted(names))
 
-        for name in VALID_ARG_DIRECTIVES:
-            if re.match(r"^" + name + r"\s*:", comment_text):
-                return True
-    else:
-        for name in VALID_INLINE_DIRECTIVES:
-            if re.match(r"^" + name + r"\s*:", comment_text):
-                return True
 
-    return False
+PRELUDE_DIRECTIVE_RE = re.compile(
+    r"^(?:"
+    + r"(?P<noarg_name>" + _directive_names_pattern(VALID_NOARG_DIRECTIVES) + r")$"
+    + r"|(?P<name>" + _directive_names_pattern(VALID_ARG_DIRECTIVES) + r")\s*:(?P<value>.*)"
+    + r")",
+    flags=re.DOTALL,
+)
 
+INLINE_DIRECTIVE_RE = re.compile(
+    r"^(?P<name>" + _directive_names_pattern(VALID_INLINE_DIRECTIVES) + r")\s*:(?P<value>.*)",
+    flags=re.DOTALL,
+)
 
-def _parse_directives(comment_text: str, raw_text: str) -> typ.Iterable[ct.Directive]:
+
+def _strip_comment(comment_text: str, language: str) -> typ.Optional[str]:
+    comment_start_re, comment_end_re = LANGUAGE_COMMENT_REGEXES[language]
+    start_match = comment_start_re.search(comment_text)
+    if start_match is None:
+        return None
+
+    comment_text = comment_text[start_match.end() :]
+    end_match    = comment_end_re.search(comment_text)
+    if end_match is None:
+        return None
+
+    return comment_text
+
+
+def parse_directive(
+    comment_text: str,
+    raw_text    : str,
+    is_prelude  : bool,
+    language    : typ.Optional[str] = None,
+) -> typ.Optional[ct.Directive]:
+    """Parse the directive of a comment, if it has one.
+
+    Directives with an argument ('name: value') can be in the prelude of
+    a block, or anywhere in the block if they are VALID_INLINE_DIRECTIVES.
+    Directives without an argument are only valid in the prelude.
+    """
     # TODO (mb 2021-08-19): Is there a way we can support
     #   multiple directives on the same line?
-    rest = comment_text
-    while rest:
-        # match = re.match(r"^" + name + r"\s*:", rest)
-        if ":" in rest:
-            name, value = rest.split(":", 1)
-            name  = name.strip()
-            value = value.strip()
-        else:
-            name  = rest.strip()
-            value = ""
+    if language is not None:
+        maybe_comment_text = _strip_comment(comment_text, language)
+        if maybe_comment_text is None:
+            return None
+        comment_text = maybe_comment_text
 
-        if name in VALID_DIRECTIVES:
-            yield ct.Directive(name, value, raw_text)
-            return
-        else:
-            errmsg = f"Invalid directive '{name}'"
-            raise Exception(errmsg)
+    comment_text = comment_text.strip()
+    if is_prelude:
+        match = PRELUDE_DIRECTIVE_RE.match(comment_text)
+    else:
+        match = INLINE_DIRECTIVE_RE.match(comment_text)
+
+    if match is None:
+        return None
+
+    # NOTE: DIRECTIVE_NAMES is used so that there is only one
+    #   instance of each name string.
+    noarg_name = match.groupdict().get('noarg_name')
+    if noarg_name:
+        return ct.Directive(DIRECTIVE_NAMES[noarg_name], "", raw_text)
+    else:
+        name = DIRECTIVE_NAMES[match.group('name')]
+        return ct.Directive(name, match.group('value').strip(), raw_text)
+
+
+def has_directive(comment_text: str, is_prelude: bool, language: typ.Optional[str] = None) -> bool:
+    return parse_directive(comment_text, comment_text, is_prelude, language) is not None
 
 
 # NOTE (mb 2020-05-22): Since we do multiple passes over the file, we
@@ -438,7 +488,49 @@ def make_parse_error(message: str, elem: AnyElem, level: int = logging.ERROR) ->
     return ParseError(location(elem), level, message)
 
 
+def _add_span(spans: list[ct.Span], start: int, end: int) -> None:
+    if start == end:
+        return
+
+    if spans and spans[-1][1] == start:
+        # merge adjacent spans
+        spans[-1] = (spans[-1][0], end)
+    else:
+        spans.append((start, end))
+
+
+def _trim_last_line(content: str, spans: list[ct.Span]) -> ct.FlatSpans:
+    # equivalent to "".join(content[start:end] ...).rsplit("\n", 1)[0]
+    trimmed_spans = spans
+    for span_idx in range(len(spans) - 1, -1, -1):
+        start, end = spans[span_idx]
+        nl_pos     = content.rfind("\n", start, end)
+        if nl_pos >= 0:
+            trimmed_spans = spans[:span_idx]
+            _add_span(trimmed_spans, start, nl_pos)
+            break
+
+    return tuple(offset for span in trimmed_spans for offset in span)
+
+
+class BlockIndex(typ.NamedTuple):
+
+    # Chapter._version when the index was built, used to detect if
+    # elements were replaced since then.
+    version: int
+
+    blocks          : list[ct.Block]
+    blocks_by_elem  : dict[Path, dict[int, ct.Block]]
+    blocks_by_def_id: dict[str, list[ct.Block]]
+
+
 class Chapter:
+    """The Markdown elements of one or more files with the same chapnum.
+
+    The element lists are shared between a chapter and its copies
+    (copy on write). Elements MUST be replaced with replace_element,
+    rather than by assigning to a list of Chapter.elements.
+    """
 
     md_paths : list[Path]
     chapnum  : str
@@ -446,6 +538,16 @@ class Chapter:
     elements : ElementsByPath
     errors   : set[ParseError]
 
+    # elem_index of elements which were replaced since the chapter was
+    # parsed or copied.
+    modified: dict[Path, set[int]]
+
+    # element lists which may be referenced by another Chapter
+    _shared_paths: set[Path]
+    _block_index : typ.Optional[BlockIndex]
+    # incremented by replace_element
+    _version: int
+
     def __init__(
         self,
         md_paths : list[Path],
@@ -462,9 +564,30 @@ class Chapter:
         else:
             self.elements = elements
 
+        self.modified      = {}
+        self._shared_paths = set()
+        self._block_index  = None
+        self._version      = 0
+
     def copy(self) -> 'Chapter':
-        new_elements = {path: list(elems) for path, elems in self.elements.items()}
-        return Chapter(self.md_paths, self.chapnum, self.namespace, new_elements)
+        new_chapter = Chapter(self.md_paths, self.chapnum, self.namespace, dict(self.elements))
+        self._shared_paths        = set(self.elements)
+        new_chapter._shared_paths = set(self.elements)
+        # the copy has the same elements, so blocks need not be parsed again
+        new_chapter._block_index = self._block_index
+        new_chapter._version     = self._version
+        new_chapter.errors       = set(self.errors)
+        return new_chapter
+
+    def replace_element(self, new_elem: MarkdownElement) -> None:
+        md_path = new_elem.md_path
+        if md_path in self._shared_paths:
+            self.elements[md_path] = list(self.elements[md_path])
+            self._shared_paths.discard(md_path)
+
+        self.elements[md_path][new_elem.elem_index] = new_elem
+        self.modified.setdefault(md_path, set()).add(new_elem.elem_index)
+        self._version += 1
 
     def headlines(self) -> typ.Iterable[ct.Headline]:
         elem_index = 0
@@ -499,11 +622,22 @@ class Chapter:
                     yield ImageTag(*image_match.groups())
 
     def _init_plain_block(self, elem: MarkdownElement, info_string: str) -> ct.Block:
-        inner_content = elem.content
-        inner_content = inner_content.split("\n", 1)[-1]
-        # trim off final fence
-        inner_content = inner_content.rsplit("\n", 1)[0]
+        content = elem.content
+        start   = content.find("\n") + 1
+        end     = content.rfind("\n", start)
+        if end < 0:
+            end = len(content)
+
+        # TODO (mb 2020-06-02): Why do we .strip() here ?
+        inner_content = content[start:end]
+        stripped      = inner_content.strip()
+        if stripped:
+            start += len(inner_content) - len(inner_content.lstrip())
+            end   -= len(inner_content) - len(inner_content.rstrip())
+        else:
+            end = start
 
+        spans = (start, end)
         return ct.Block(
             elem.md_path,
             self.namespace,
@@ -511,10 +645,9 @@ class Chapter:
             elem.elem_index,
             info_string,
             [],
-            elem.content,
-            # TODO (mb 2020-06-02): Why do we .strip() here ?
-            inner_content.strip(),
-            inner_content.strip(),
+            content,
+            spans,
+            spans,
         )
 
     def _init_code_block(self, elem: MarkdownElement, info_string: str, rest_content: str) -> ct.Block:
@@ -523,26 +656,31 @@ class Chapter:
 
         directives = [ct.Directive('language', language, language)]
 
-        inner_chunks      = []
-        includable_chunks = []
+        inner_spans     : list[ct.Span] = []
+        includable_spans: list[ct.Span] = []
 
         is_prelude = True
         rest       = rest_content
+        # offset of rest in elem.content
+        offset = len(elem.content) - len(rest_content)
 
         while rest:
             start_match = comment_start_re.search(rest)
 
             if start_match is None:
-                inner_chunks.append(rest)
-                includable_chunks.append(rest)
+                _add_span(inner_spans     , offset, offset + len(rest))
+                _add_span(includable_spans, offset, offset + len(rest))
                 break
 
             prefix_chunk = rest[: start_match.start()]
-            if prefix_chunk:
-                inner_chunks.append(prefix_chunk)
-                includable_chunks.append(prefix_chunk)
+            _add_span(inner_spans     , offset, offset + start_match.start())
+            _add_span(includable_spans, offset, offset + start_match.start())
+
+            raw_spans: list[ct.Span] = []
+            raw_start = offset + start_match.start()
 
-            rest = rest[start_match.end() :]
+            rest    = rest[start_match.end() :]
+            offset += start_match.end()
 
             if prefix_chunk.strip() and is_prelude:
                 # prelude ends if there is non-whitespace before a comment
@@ -553,9 +691,13 @@ class Chapter:
             if end_match is None:
                 comment_text = rest
                 rest         = ""
+                _add_span(raw_spans, raw_start, offset + len(comment_text))
+                offset += len(comment_text)
             else:
                 comment_text = rest[: end_match.start()]
                 rest         = rest[end_match.end() :]
+                _add_span(raw_spans, raw_start, offset + end_match.start())
+                offset += end_match.end()
 
             if is_prelude:
                 # TODO (mb 2021-08-27): hacky, isn't there a better
@@ -563,32 +705,32 @@ class Chapter:
                 if rest.startswith("\n") or rest.startswith("\r"):
                     comment_text = comment_text + rest[:1]
                     rest         = rest[1:]
+                    _add_span(raw_spans, offset, offset + 1)
+                    offset += 1
                 elif rest.startswith("\r\n"):
                     comment_text = comment_text + rest[:2]
                     rest         = rest[2:]
+                    _add_span(raw_spans, offset, offset + 2)
+                    offset += 2
 
             raw_text = start_match.group(0) + comment_text
 
             assert raw_text in elem.content
-            inner_chunks.append(raw_text)
-
-            if has_directive(comment_text, is_prelude=is_prelude):
-                for directive in _parse_directives(comment_text, raw_text):
-                    directives.append(directive)
-                    if directive.name in ('dep', 'include'):
-                        # prelude ends with any include/dep directives
-                        is_prelude = False
-                        # NOTE (mb 2020-06-03): needed for recursive include
-                        includable_chunks.append(raw_text)
+            for span in raw_spans:
+                _add_span(inner_spans, *span)
+
+            directive = parse_directive(comment_text, raw_text, is_prelude=is_prelude)
+            if directive:
+                directives.append(directive)
+                if directive.name in ('dep', 'include'):
+                    # prelude ends with any include/dep directives
+                    is_prelude = False
+                    # NOTE (mb 2020-06-03): needed for recursive include
+                    for span in raw_spans:
+                        _add_span(includable_spans, *span)
             else:
-                includable_chunks.append(raw_text)
-
-        inner_content      = "".join(inner_chunks)
-        includable_content = "".join(includable_chunks)
-
-        # trim off final fence
-        inner_content      = inner_content.rsplit("\n", 1)[0]
-        includable_content = includable_content.rsplit("\n", 1)[0]
+                for span in raw_spans:
+                    _add_span(includable_spans, *span)
 
         return ct.Block(
             elem.md_path,
@@ -598,8 +740,9 @@ class Chapter:
             info_string,
             directives,
             elem.content,
-            inner_content,
-            includable_content,
+            # trim off final fence
+            _trim_last_line(elem.content, inner_spans),
+            _trim_last_line(elem.content, includable_spans),
         )
 
     def _iter_block_elements(self) -> typ.Iterable[tuple[MarkdownElement, str, str]]:
@@ -615,18 +758,52 @@ class Chapter:
                     content           = elem.content[content_start:]
                     yield (elem, info_string, content)
 
-    def iter_blocks(self) -> typ.Iterable[ct.Block]:
+    def _init_block(self, elem: MarkdownElement, info_string: str, content: str) -> ct.Block:
+        is_known_info_string = info_string in KNOWN_INFO_STRINGS
+        if info_string.strip() and not is_known_info_string:
+            err = make_parse_error(f"Unknown language '{info_string}'", elem, logging.WARNING)
+            self.errors.add(err)
+
+        is_valid_language = info_string in LANGUAGE_COMMENT_REGEXES
+        if is_valid_language:
+            return self._init_code_block(elem, info_string, rest_content=content)
+        else:
+            return self._init_plain_block(elem, info_string)
+
+    def block_index(self) -> BlockIndex:
+        """Blocks of the chapter, parsed only once for the same elements.
+
+        Elements may be replaced (see replace_element), in which case
+        the index is rebuilt on the next access.
+        """
+        if self._block_index and self._block_index.version == self._version:
+            return self._block_index
+
+        blocks          : list[ct.Block] = []
+        blocks_by_elem  : dict[Path, dict[int, ct.Block]] = {md_path: {} for md_path in self.md_paths}
+        blocks_by_def_id: dict[str, list[ct.Block]] = {}
+
         for elem, info_string, content in self._iter_block_elements():
-            is_known_info_string = info_string in KNOWN_INFO_STRINGS
-            if info_string.strip() and not is_known_info_string:
-                err = make_parse_error(f"Unknown language '{info_string}'", elem, logging.WARNING)
-                self.errors.add(err)
-
-            is_valid_language = info_string in LANGUAGE_COMMENT_REGEXES
-            if is_valid_language:
-                yield self._init_code_block(elem, info_string, rest_content=content)
-            else:
-                yield self._init_plain_block(elem, info_string)
+            block = self._init_block(elem, info_string, content)
+            blocks.append(block)
+            blocks_by_elem[block.md_path][block.elem_index] = block
+            for directive in block.directives:
+                if directive.name == 'def':
+                    blocks_by_def_id.setdefault(directive.value, []).append(block)
+
+        self._block_index = BlockIndex(
+            self._version,
+            blocks,
+            blocks_by_elem,
+            blocks_by_def_id,
+        )
+        return self._block_index
+
+    def iter_blocks(self) -> typ.Iterable[ct.Block]:
+        return iter(self.block_index().blocks)
+
+    def get_block(self, md_path: Path, elem_index: int) -> typ.Optional[ct.Block]:
+        return self.block_index().blocks_by_elem.get(md_path, {}).get(elem_index)
 
     def iter_block_linenos(self) -> typ.Iterable[ct.BlockLineInfo]:
         for elem, info_string, content in self._iter_block_elements():
@@ -692,79 +869,264 @@ class Chapter:
         return hash(self.chapnum) ^ hash(self.namespace)
 
 
+class _Match(typ.NamedTuple):
+    start : int
+    end   : int
+    groups: dict[str, typ.Optional[str]]
+
+
+def _line_end(content: str, pos: int, num_lines: int = 1) -> int:
+    end = pos
+    for _ in range(num_lines):
+        nl_pos = content.find("\n", end)
+        if nl_pos < 0:
+            return len(content)
+        end = nl_pos + 1
+    return end
+
+
+def _match_at(pattern: typ.Pattern, content: str, pos: int, max_lines: int) -> typ.Optional[_Match]:
+    # NOTE: The scanner used to reslice the content
+    #   after every element, so a '^' also matched at the start of
+    #   each slice, even in the middle of a line (for example
+    #   directly after a headline). With pattern.search(content, pos)
+    #   a '^' only matches after a newline, so a match at the
+    #   position where an element ends is checked on a slice. None
+    #   of the patterns can match more than max_lines lines.
+    if pos == 0 or content[pos - 1] == "\n":
+        match = pattern.match(content, pos)
+        offset = 0
+    else:
+        match  = pattern.match(content[pos : _line_end(content, pos, max_lines)])
+        offset = pos
+
+    if match is None:
+        return None
+    else:
+        return _Match(offset + match.start(), offset + match.end(), match.groupdict())
+
+
+def _search(pattern: typ.Pattern, content: str, pos: int, max_lines: int) -> typ.Optional[_Match]:
+    match_at_pos = _match_at(pattern, content, pos, max_lines)
+    if match_at_pos:
+        return match_at_pos
+
+    match = pattern.search(content, pos)
+    if match is None:
+        return None
+    else:
+        return _Match(match.start(), match.end(), match.groupdict())
+
+
 def _iter_raw_md_elements(content: str) -> typ.Iterable[_RawMarkdownElement]:
-    line_no = 1
-    while content:
-        if line_no == 1:
-            start_match = FRONT_MATTER_RE.match(content)
-            if start_match and start_match.start() == 0:
-                end_match = FRONT_MATTER_RE.search(content, pos=start_match.end())
+    newline_offsets = [nl_match.start() for nl_match in NEWLINE_RE.finditer(content)]
+
+    def _line_no(offset: int) -> int:
+        return bisect.bisect_left(newline_offsets, offset) + 1
+
+    pos     = 0
+    end_pos = len(content)
+    while pos < end_pos:
+        if _line_no(pos) == 1:
+            start_match = _match_at(FRONT_MATTER_RE, content, pos, max_lines=1)
+            if start_match:
+                end_match = FRONT_MATTER_RE.search(content, pos=start_match.end)
                 if end_match:
-                    front_matter_end     = end_match.end()
-                    front_matter_content = content[:front_matter_end]
-                    yield _RawMarkdownElement(MD_FRONT_MATTER, line_no, front_matter_content)
-                    line_no += front_matter_content.count("\n")
-                    content = content[front_matter_end:]
+                    yield _RawMarkdownElement(MD_FRONT_MATTER, 1, content[pos : end_match.end()])
+                    pos = end_match.end()
 
-        match = ELEMENT_RE.search(content)
+        match = _search(ELEMENT_RE, content, pos, max_lines=2)
         if match is None:
             break
 
         # yield preceding paragraph
-        para_content = content[: match.start()]
-        if para_content:
-            yield _RawMarkdownElement(MD_PARAGRAPH, line_no, para_content)
-
-        line_no += para_content.count("\n")
+        if pos < match.start:
+            yield _RawMarkdownElement(MD_PARAGRAPH, _line_no(pos), content[pos : match.start])
 
         # parse match as special element
-        groups         = match.groupdict()
+        groups         = match.groups
         is_headline    = bool(groups['headline_marker_a'] or groups['headline_marker_b'])
         is_block_fence = groups['block_fence']
-        match_content  = content[match.start() : match.end()]
-        rest_content   = content[match.end() :]
+        match_end      = match.end
 
         if is_headline:
             md_type = MD_HEADLINE
         elif is_block_fence:
             md_type      = MD_BLOCK
-            block_fence  = groups['block_fence']
+            block_fence  = typ.cast(str, groups['block_fence'])
             block_end_re = BLOCK_END_RE[block_fence]
-            end_match    = block_end_re.search(rest_content)
+            end_match    = block_end_re.search(content, match_end)
             if end_match is None:
-                match_content += rest_content
-                rest_content = ""
+                match_end = end_pos
             else:
-                end_pos = end_match.end()
-                match_content += rest_content[:end_pos]
-                rest_content = rest_content[end_pos:]
+                match_end = end_match.end()
 
-        yield _RawMarkdownElement(md_type, line_no, match_content)
+        yield _RawMarkdownElement(md_type, _line_no(match.start), content[match.start : match_end])
+        pos = match_end
 
-        line_no += match_content.count("\n")
-        content = rest_content
+    if pos < end_pos:
+        yield _RawMarkdownElement(MD_PARAGRAPH, _line_no(pos), content[pos:])
 
-    if content:
-        yield _RawMarkdownElement(MD_PARAGRAPH, line_no, content)
 
+# Increment if the output of _iter_raw_md_elements changes, so
+# that entries of the parse cache are no longer used.
+PARSE_CACHE_VERSION = '1'
 
-def _parse_md_elements(md_path: Path) -> list[MarkdownElement]:
+PARSE_CACHE_DIR_NAME = "parse_cache"
+
+# (md_type, first_line, content length)
+ElementSpan = tuple[MarkdownElementType, int, int]
+
+
+def _parse_cache_path(content_digest: str) -> Path:
+    filename = f"v{PARSE_CACHE_VERSION}_{content_digest}.json"
+    return config.CACHE_DIR / PARSE_CACHE_DIR_NAME / filename
+
+
+def _load_cached_spans(cache_path: Path) -> typ.Optional[list[ElementSpan]]:
+    try:
+        with cache_path.open(mode='rb') as fobj:
+            spans = [tuple(span) for span in json.loads(fobj.read())]
+        # NOTE: The mtime of an entry is its last use (see evict_parse_cache).
+        os.utime(cache_path)
+        return spans  # type: ignore[return-value]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        logger.warning(f"Ignoring invalid parse cache entry {cache_path}: {err}")
+        return None
+
+
+def _dump_cached_spans(cache_path: Path, spans: list[ElementSpan]) -> None:
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE: A unique temporary file, since the same entry may be written
+        #   by concurrent builds or by the workers of a parallel parse.
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=cache_path.parent, prefix=cache_path.name + ".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(tmp_fd, mode="w", encoding="utf-8") as fobj:
+                fobj.write(json.dumps(spans, separators=(",", ":")))
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as err:
+        # the cache is only an optimization
+        logger.debug(f"Could not write parse cache entry {cache_path}: {err}")
+
+
+def _iter_parse_cache_paths() -> typ.Iterable[Path]:
+    cache_dir = config.CACHE_DIR / PARSE_CACHE_DIR_NAME
+    if cache_dir.exists():
+        yield from cache_dir.iterdir()
+
+
+def evict_parse_cache(max_age: dt.timedelta) -> int:
+    """Remove entries of the parse cache which were not used within max_age.
+
+    Entries of a previous PARSE_CACHE_VERSION are removed as well.
+    Returns the number of removed entries.
+    """
+    min_mtime   = time.time() - max_age.total_seconds()
+    num_evicted = 0
+    for cache_path in _iter_parse_cache_paths():
+        is_current = cache_path.name.startswith(f"v{PARSE_CACHE_VERSION}_")
+        try:
+            if not is_current or cache_path.stat().st_mtime < min_mtime:
+                cache_path.unlink()
+                num_evicted += 1
+        except FileNotFoundError:
+            pass  # removed concurrently
+    return num_evicted
+
+
+def clear_parse_cache(md_paths: typ.Optional[FilePaths] = None) -> int:
+    """Remove the entries of md_paths from the parse cache (all entries if None)."""
+    if md_paths is None:
+        cache_paths = list(_iter_parse_cache_paths())
+    else:
+        cache_paths = [_parse_cache_path(read_md_content(md_path)[1]) for md_path in md_paths]
+
+    num_cleared = 0
+    for cache_path in cache_paths:
+        try:
+            cache_path.unlink()
+            num_cleared += 1
+        except FileNotFoundError:
+            pass
+    return num_cleared
+
+
+def read_md_content(md_path: Path) -> tuple[str, str]:
     # TODO: encoding from config
-    with md_path.open(mode='r', encoding="utf-8") as fobj:
-        content = fobj.read()
+    with md_path.open(mode='rb') as fobj:
+        data = fobj.read()
+
+    content_digest = hashlib.sha1(data).hexdigest()
+    return decode_md_content(data), content_digest
+
+
+def decode_md_content(data: bytes) -> str:
+    content = data.decode("utf-8")
+    if "\r" in content:
+        # same newline translation as open(mode='r')
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    return content
+
+
+def _parse_element_spans(content: str) -> list[ElementSpan]:
+    return [
+        (raw_elem.md_type, raw_elem.first_line, len(raw_elem.content))
+        for raw_elem in _iter_raw_md_elements(content)
+    ]
+
+
+def _lookup_cached_spans(content: str, content_digest: str) -> typ.Optional[list[ElementSpan]]:
+    # NOTE: The parse cache only stores the type,
+    #   line number and length of each element, the content is
+    #   sliced from the file, so a cache entry can never produce
+    #   content that differs from the file.
+    cache_path = _parse_cache_path(content_digest)
+    spans      = _load_cached_spans(cache_path)
+    if spans and sum(content_len for _, _, content_len in spans) != len(content):
+        logger.warning(f"Ignoring invalid parse cache entry {cache_path}")
+        return None
+    return spans
+
+
+def _parse_and_cache_spans(content: str, content_digest: str) -> list[ElementSpan]:
+    spans = _parse_element_spans(content)
+    _dump_cached_spans(_parse_cache_path(content_digest), spans)
+    return spans
+
+
+def _parse_md_spans(md_path: Path) -> tuple[str, list[ElementSpan]]:
+    # NOTE: Runs in a worker process (see _parse_md_elements_parallel),
+    #   the spans are much smaller than the elements.
+    content, content_digest = read_md_content(md_path)
+    return content_digest, _parse_and_cache_spans(content, content_digest)
+
+
+def _init_md_elements(md_path: Path, content: str, spans: list[ElementSpan]) -> list[MarkdownElement]:
+    # NOTE: src_md_paths is never modified, so it can be shared
+    src_md_paths = {md_path}
 
     elements = []
-    for elem_index, raw_elem in enumerate(_iter_raw_md_elements(content)):
+    offset   = 0
+    for elem_index, (md_type, first_line, content_len) in enumerate(spans):
         elem = MarkdownElement(
             md_path,
-            raw_elem.first_line,
+            first_line,
             elem_index,
-            raw_elem.md_type,
-            raw_elem.content,
+            md_type,
+            content[offset : offset + content_len],
             None,
-            {md_path},
+            src_md_paths,
         )
         elements.append(elem)
+        offset += content_len
 
     # An important criteria for the context is that it has the
     # complete text of the original literate program and is able to
@@ -776,6 +1138,54 @@ def _parse_md_elements(md_path: Path) -> list[MarkdownElement]:
     return elements
 
 
+def _parse_md_elements(md_path: Path) -> list[MarkdownElement]:
+    content, content_digest = read_md_content(md_path)
+
+    spans = _lookup_cached_spans(content, content_digest)
+    if spans is None:
+        spans = _parse_and_cache_spans(content, content_digest)
+
+    return _init_md_elements(md_path, content, spans)
+
+
+# Starting a process pool takes longer than parsing a few small files.
+PARALLEL_PARSE_MIN_CHARS = 512 * 1024
+
+PARALLEL_PARSE_MAX_WORKERS = os.cpu_count() or 1
+
+
+def _parse_md_elements_parallel(md_paths: list[Path], workers: int) -> ElementsByPath:
+    contents = {md_path: read_md_content(md_path) for md_path in md_paths}
+
+    spans_by_path = {
+        md_path: _lookup_cached_spans(content, content_digest)
+        for md_path, (content, content_digest) in contents.items()
+    }
+
+    uncached_paths = [md_path for md_path, spans in spans_by_path.items() if spans is None]
+    uncached_chars = sum(len(contents[md_path][0]) for md_path in uncached_paths)
+    # NOTE: --concurrency may be larger than the number of cpus, since
+    #   it is also used for blocks that mostly wait on io.
+    max_workers = min(workers, len(uncached_paths), PARALLEL_PARSE_MAX_WORKERS)
+    if max_workers > 1 and uncached_chars >= PARALLEL_PARSE_MIN_CHARS:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parse_results = executor.map(_parse_md_spans, uncached_paths)
+            for md_path, (content_digest, spans) in zip(uncached_paths, parse_results):
+                # the file may have changed since it was read
+                if content_digest == contents[md_path][1]:
+                    spans_by_path[md_path] = spans
+
+    elements_by_path = {}
+    for md_path, (content, content_digest) in contents.items():
+        maybe_spans = spans_by_path[md_path]
+        if maybe_spans is None:
+            spans = _parse_and_cache_spans(content, content_digest)
+        else:
+            spans = maybe_spans
+        elements_by_path[md_path] = _init_md_elements(md_path, content, spans)
+    return elements_by_path
+
+
 # Input files for LitProg must match this pattern.
 # The 'namespace' group is used to reference blocks
 # in different files in a way that doesn't break if
@@ -813,12 +1223,19 @@ class Context:
 
     chapters: list[Chapter]
 
-    def __init__(self, *, md_paths: FilePaths = None, chapters: list[Chapter] = None) -> None:
+    def __init__(
+        self,
+        *,
+        md_paths: FilePaths = None,
+        chapters: list[Chapter] = None,
+        workers : int = 1,
+    ) -> None:
         if chapters:
             assert md_paths is None
             self.chapters = chapters
         elif md_paths:
             assert chapters is None
+            md_paths = list(md_paths)
             namespaces: dict[str, str] = {}
             paths_by_chapnum = collections.defaultdict(list)
 
@@ -831,10 +1248,22 @@ class Context:
 
                 paths_by_chapnum[chapnum, namespace].append(md_path)
 
-            self.chapters = [
-                Chapter(chapter_md_paths, chapnum, namespace)
-                for (chapnum, namespace), chapter_md_paths in sorted(paths_by_chapnum.items())
-            ]
+            if workers > 1:
+                elements = _parse_md_elements_parallel(md_paths, workers)
+                self.chapters = [
+                    Chapter(
+                        chapter_md_paths,
+                        chapnum,
+                        namespace,
+                        {md_path: elements[md_path] for md_path in chapter_md_paths},
+                    )
+                    for (chapnum, namespace), chapter_md_paths in sorted(paths_by_chapnum.items())
+                ]
+            else:
+                self.chapters = [
+                    Chapter(chapter_md_paths, chapnum, namespace)
+                    for (chapnum, namespace), chapter_md_paths in sorted(paths_by_chapnum.items())
+                ]
             self.chapters.sort()
         else:
             raise ValueError("Missing argument 'md_paths' for Context.")
@@ -856,11 +1285,18 @@ class Context:
         return isinstance(other, Context) and self.chapters == other.chapters
 
 
-def parse_context(md_paths: FilePaths) -> Context:
-    parse_ctx = Context(md_paths=md_paths)
+def parse_context(md_paths: FilePaths, workers: int = 1) -> Context:
+    """Parse the chapters of md_paths.
+
+    With workers > 1, files which are not in the parse cache are
+    parsed in a process pool.
+    """
+    parse_ctx = Context(md_paths=md_paths, workers=workers)
+
+    if config.DEBUG:
+        assert parse_ctx.copy() == parse_ctx
 
     # provoke parse errors early on
-    assert parse_ctx.copy() == parse_ctx
     list(parse_ctx.headlines())
     list(parse_ctx.iter_blocks())
 
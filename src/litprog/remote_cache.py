@@ -0,0 +1,272 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Share block results between machines.
+
+A RemoteResultCache reads through to a remote store for any capture
+that is not in the local cache and writes new captures back to the
+remote store when the build is flushed. Remote stores are content
+addressed by the task_key of a block, which is machine independent.
+
+Supported stores:
+
+    http://host:port        see litprog.cache_server (lit cache-server)
+    redis://host:port/db    requires the 'redis' package
+"""
+import json
+import struct
+import typing as typ
+import logging
+import urllib.parse
+import http.client
+import urllib.error
+import urllib.request
+
+from . import common_types as ct
+from . import capture_cache
+
+logger = logging.getLogger(__name__)
+
+
+Chapters = capture_cache.Chapters
+
+
+class Record(typ.NamedTuple):
+    entry       : capture_cache.ManifestEntry
+    capture_data: capture_cache.CaptureData
+
+
+RECORD_LEN = struct.Struct("<II")
+
+
+def pack_records(records: typ.Iterable[Record]) -> bytes:
+    parts: list[bytes] = []
+    for entry, capture_data in records:
+        entry_data = json.dumps(list(entry)).encode("utf-8")
+        parts.append(RECORD_LEN.pack(len(entry_data), len(capture_data)))
+        parts.append(entry_data)
+        parts.append(capture_data)
+    return b"".join(parts)
+
+
+def unpack_records(data: bytes) -> typ.Iterable[Record]:
+    offset = 0
+    while offset < len(data):
+        entry_len, capture_len = RECORD_LEN.unpack_from(data, offset)
+        offset += RECORD_LEN.size
+
+        entry_data    = data[offset : offset + entry_len]
+        offset       += entry_len
+        capture_data  = data[offset : offset + capture_len]
+        offset       += capture_len
+
+        entry = capture_cache.ManifestEntry(*json.loads(entry_data))
+        yield Record(entry, capture_data)
+
+
+# Errors which mean that a remote store is unavailable or returned
+# invalid data (struct.error is raised by unpack_records).
+RemoteErrors: tuple[type[Exception], ...] = (
+    OSError,
+    urllib.error.URLError,
+    http.client.HTTPException,
+    struct.error,
+    ValueError,
+)
+
+
+class RemoteStore:
+    """Protocol for a remote store of records, keyed by task_key."""
+
+    # errors of the store which are handled by disabling the remote cache
+    errors: tuple[type[Exception], ...] = RemoteErrors
+
+    def lookup(self, task_keys: list[str]) -> list[Record]:
+        raise NotImplementedError("MUST be implemented by subclass.")
+
+    def store(self, records: list[Record]) -> None:
+        raise NotImplementedError("MUST be implemented by subclass.")
+
+
+# NOTE: A remote cache is an optimization, so a slow
+#   or unavailable remote should never hold up a build for long.
+REMOTE_TIMEOUT = 5.0
+
+
+class HTTPRemoteStore(RemoteStore):
+    def __init__(self, url: str, cache_id: str, timeout: float = REMOTE_TIMEOUT) -> None:
+        self._base_url = url.rstrip("/") + "/v1/" + urllib.parse.quote(cache_id)
+        self._timeout  = timeout
+
+    def _post(self, path: str, body: bytes) -> bytes:
+        req = urllib.request.Request(
+            self._base_url + path,
+            data=body,
+            method="POST",
+            headers={'Content-Type': "application/octet-stream"},
+        )
+        with urllib.request.urlopen(req, timeout=self._timeout) as resp:
+            return typ.cast(bytes, resp.read())
+
+    def lookup(self, task_keys: list[str]) -> list[Record]:
+        body = "\n".join(task_keys).encode("ascii")
+        return list(unpack_records(self._post("/lookup", body)))
+
+    def store(self, records: list[Record]) -> None:
+        self._post("/store", pack_records(records))
+
+
+# Remote entries are dropped if they were not updated for this long.
+REDIS_TTL_SECONDS = 30 * 24 * 60 * 60
+
+
+class RedisRemoteStore(RemoteStore):
+    def __init__(self, url: str, cache_id: str, timeout: float = REMOTE_TIMEOUT) -> None:
+        try:
+            # pylint: disable=import-outside-toplevel; optional dependency
+            import redis
+        except ImportError as err:
+            raise ImportError("The 'redis' package is required for a redis:// remote cache.") from err
+
+        # NOTE: ConnectionError and TimeoutError of redis are
+        #   subclasses of RedisError, not of OSError.
+        self.errors  = RemoteErrors + (redis.exceptions.RedisError,)
+        self._redis  = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._prefix = f"litprog:{cache_id}:"
+
+    def lookup(self, task_keys: list[str]) -> list[Record]:
+        if not task_keys:
+            return []
+
+        values = self._redis.mget([self._prefix + task_key for task_key in task_keys])
+        return [record for value in values if value for record in unpack_records(value)]
+
+    def store(self, records: list[Record]) -> None:
+        pipe = self._redis.pipeline(transaction=False)
+        for record in records:
+            key = self._prefix + record.entry.task_key
+            pipe.set(key, pack_records([record]), ex=REDIS_TTL_SECONDS)
+        pipe.execute()
+
+
+REMOTE_STORES: dict[str, typ.Callable[[str, str], RemoteStore]] = {
+    'http' : HTTPRemoteStore,
+    'https': HTTPRemoteStore,
+    'redis': RedisRemoteStore,
+}
+
+
+def open_remote_store(url: str, cache_id: str) -> RemoteStore:
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme not in REMOTE_STORES:
+        raise ValueError(f"Invalid remote cache url '{url}', expected one of {sorted(REMOTE_STORES)}")
+    return REMOTE_STORES[scheme](url, cache_id)
+
+
+class RemoteResultCache(capture_cache.SQLiteResultCache):
+    """Local SQLiteResultCache with read through and write back to a RemoteStore.
+
+    Captures read from the remote are also written to the local cache,
+    so that subsequent builds don't have to fetch them again.
+    """
+
+    _store           : RemoteStore
+    _remote_entries  : dict[str, Record]
+    _pending_uploads : list[Record]
+    _is_remote_broken: bool
+
+    def __init__(self, orig_files: Chapters, url: str) -> None:
+        orig_files = list(orig_files)
+        super().__init__(orig_files)
+
+        self._remote_entries   = {}
+        self._pending_uploads  = []
+        self._is_remote_broken = False
+
+        try:
+            self._store = open_remote_store(url, capture_cache.parse_cache_id(orig_files))
+        except ImportError as err:
+            self._store = RemoteStore()
+            self._on_remote_error(err)
+
+    def _on_remote_error(self, err: Exception) -> None:
+        # NOTE: The build continues with only the
+        #   local cache, rather than retrying and timing out again
+        #   for every task.
+        logger.warning(f"Remote cache disabled: {err}")
+        self._is_remote_broken = True
+
+    def _fetch(self, task_keys: list[str]) -> None:
+        if self._is_remote_broken or not task_keys:
+            return
+
+        try:
+            records = self._store.lookup(task_keys)
+        except self._store.errors as err:
+            self._on_remote_error(err)
+            return
+
+        with self._lock:
+            for record in records:
+                self._remote_entries[record.entry.task_key] = record
+
+    def prefetch(self, tasks: typ.Sequence[ct.BlockTask]) -> None:
+        # NOTE: The task_key of a task with requires
+        #   depends on the capture of the providers, so those can only
+        #   be looked up after the providers are done (see get_entry).
+        task_keys = [
+            task_key
+            for task in tasks
+            if not task.opts.requires_ids
+            for task_key in [self.task_key(task)]
+            if task_key not in self._entries_by_task_key
+        ]
+        self._fetch(task_keys)
+        logger.info(f"Remote cache: {len(self._remote_entries)} of {len(task_keys)} prefetched")
+
+    def get_entry(self, task: ct.BlockTask) -> typ.Optional[capture_cache.ManifestEntry]:
+        entry = super().get_entry(task)
+        if entry is not None:
+            return entry
+
+        task_key = self.task_key(task)
+        if task_key not in self._remote_entries and task.opts.requires_ids:
+            self._fetch([task_key])
+
+        record = self._remote_entries.get(task_key)
+        return record and record.entry
+
+    def read_capture(self, entry: capture_cache.ManifestEntry) -> typ.Optional[capture_cache.CaptureData]:
+        capture_data = super().read_capture(entry)
+        if capture_data is not None:
+            return capture_data
+
+        record = self._remote_entries.get(entry.task_key)
+        if record is None or record.entry != entry:
+            return None
+
+        with self._lock:
+            # read through to the local cache
+            super().write_capture(record.entry, record.capture_data)
+            self._add_entry(record.entry)
+        return record.capture_data
+
+    def write_capture(
+        self,
+        entry       : capture_cache.ManifestEntry,
+        capture_data: capture_cache.CaptureData,
+    ) -> None:
+        super().write_capture(entry, capture_data)
+        with self._lock:
+            self._pending_uploads.append(Record(entry, capture_data))
+
+    def flush(self) -> None:
+        if self._pending_uploads and not self._is_remote_broken:
+            try:
+                self._store.store(self._pending_uploads)
+                logger.info(f"Remote cache: {len(self._pending_uploads)} captures uploaded")
+            except self._store.errors as err:
+                self._on_remote_error(err)
+        super().flush()
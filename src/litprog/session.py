@@ -7,13 +7,19 @@
 # pylint: disable=consider-using-with; due to long-lived Popen objects
 
 import os
+import sys
 import json
 import time
+import array
+import queue
 import shlex
+import struct
 import typing as typ
 import logging
 import os.path
 import pathlib as pl
+import itertools
+import selectors
 import threading
 import subprocess as sp
 
@@ -40,13 +46,168 @@ class Capture(typ.NamedTuple):
     command    : str
     exit_status: int
     runtime    : float
-    lines      : list[CapturedLine]
+    lines      : typ.Sequence[CapturedLine]
 
 
 CaptureData = bytes
 
+# Binary capture format (all values little endian)
+#
+#   header      : magic, version, exit_status, runtime, num_lines, len(command)
+#   command     : utf-8
+#   ts_deltas   : int64[num_lines]  microseconds, relative to the previous line
+#   err_bits    : uint8[ceil(num_lines / 8)]  bitset of is_err
+#   line_ends   : uint32[num_lines]  offsets into line_data
+#   line_data   : utf-8 of all lines
+#
+# NOTE: The magic starts with a null byte, so it can
+#   never be confused with the (legacy) json format.
+
+BINARY_MAGIC   = b"\x00LPC"
+BINARY_VERSION = 1
+BINARY_HEADER  = struct.Struct("<4sBidII")
+
+_IS_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _le_array(typecode: str, data: bytes) -> array.array:
+    arr = array.array(typecode)
+    arr.frombytes(data)
+    if not _IS_LITTLE_ENDIAN:
+        arr.byteswap()
+    return arr
+
+
+def _le_bytes(arr: array.array) -> bytes:
+    if not _IS_LITTLE_ENDIAN:
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+class CapturedLines(typ.Sequence[CapturedLine]):
+    """Lines of a binary capture, which are only decoded when accessed."""
+
+    def __init__(
+        self,
+        ts_deltas: array.array,
+        err_bits : bytes,
+        line_ends: array.array,
+        line_data: bytes,
+    ) -> None:
+        self._ts_deltas = ts_deltas
+        self._ts_values: typ.Optional[list[int]] = None
+        self._err_bits  = err_bits
+        self._line_ends = line_ends
+        self._line_data = line_data
+
+    def __len__(self) -> int:
+        return len(self._line_ends)
+
+    def _line(self, idx: int) -> CapturedLine:
+        if self._ts_values is None:
+            self._ts_values = list(itertools.accumulate(self._ts_deltas))
+
+        start  = self._line_ends[idx - 1] if idx > 0 else 0
+        end    = self._line_ends[idx]
+        line   = self._line_data[start:end].decode("utf-8", errors="surrogateescape")
+        is_err = bool(self._err_bits[idx >> 3] & (1 << (idx & 7)))
+        return CapturedLine(self._ts_values[idx] / 1_000_000, line, is_err)
+
+    @typ.overload
+    def __getitem__(self, idx: int) -> CapturedLine:
+        ...
+
+    @typ.overload
+    def __getitem__(self, idx: slice) -> list[CapturedLine]:
+        ...
+
+    def __getitem__(self, idx: typ.Union[int, slice]) -> typ.Union[CapturedLine, list[CapturedLine]]:
+        if isinstance(idx, slice):
+            return [self._line(i) for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("line index out of range")
+        return self._line(idx)
+
+    def __iter__(self) -> typ.Iterator[CapturedLine]:
+        # NOTE: Equivalent to calling self._line for
+        #   each idx, but without the per line overhead.
+        line_data = self._line_data
+        err_bits  = self._err_bits
+        ts_iter   = itertools.accumulate(self._ts_deltas)
+        start     = 0
+        for idx, (ts, end) in enumerate(zip(ts_iter, self._line_ends)):
+            line   = line_data[start:end].decode("utf-8", errors="surrogateescape")
+            is_err = bool(err_bits[idx >> 3] & (1 << (idx & 7)))
+            yield CapturedLine(ts / 1_000_000, line, is_err)
+            start = end
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, typ.Sequence):
+            return list(self) == list(other)
+        else:
+            return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"CapturedLines({list(self)!r})"
+
+
+def _dumps_binary_capture(capture: Capture) -> CaptureData:
+    num_lines = len(capture.lines)
+
+    ts_deltas = array.array('q')
+    err_bits  = bytearray((num_lines + 7) // 8)
+    line_ends = array.array('I')
+    line_data = bytearray()
+
+    prev_ts = 0
+    for idx, line in enumerate(capture.lines):
+        ts = round(line.ts * 1_000_000)
+        ts_deltas.append(ts - prev_ts)
+        prev_ts = ts
+
+        if line.is_err:
+            err_bits[idx >> 3] |= 1 << (idx & 7)
+
+        line_data += line.line.encode("utf-8", errors="surrogateescape")
+        line_ends.append(len(line_data))
+
+    command = capture.command.encode("utf-8")
+    header  = BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_VERSION, capture.exit_status, capture.runtime, num_lines, len(command)
+    )
+    return b"".join([header, command, _le_bytes(ts_deltas), bytes(err_bits), _le_bytes(line_ends), line_data])
+
+
+def _loads_binary_capture(capture_bytes: CaptureData) -> Capture:
+    magic, version, exit_status, runtime, num_lines, command_len = BINARY_HEADER.unpack_from(capture_bytes)
+    assert magic == BINARY_MAGIC
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unknown capture format version: {version}")
+
+    offset  = BINARY_HEADER.size
+    command = capture_bytes[offset : offset + command_len].decode("utf-8")
+    offset += command_len
+
+    ts_deltas = _le_array('q', capture_bytes[offset : offset + num_lines * 8])
+    offset   += num_lines * 8
+    err_bits  = capture_bytes[offset : offset + (num_lines + 7) // 8]
+    offset   += (num_lines + 7) // 8
+    line_ends = _le_array('I', capture_bytes[offset : offset + num_lines * 4])
+    offset   += num_lines * 4
+    line_data = capture_bytes[offset:]
+
+    lines = CapturedLines(ts_deltas, err_bits, line_ends, line_data)
+    return Capture(command, exit_status, runtime, lines)
+
 
 def loads_capture(capture_bytes: CaptureData) -> Capture:
+    if capture_bytes[:4] == BINARY_MAGIC:
+        return _loads_binary_capture(capture_bytes)
+
     capture_json = capture_bytes.decode("utf-8")
     capture_obj  = json.loads(capture_json)
     if isinstance(capture_obj, list):
@@ -64,26 +225,24 @@ def loads_capture(capture_bytes: CaptureData) -> Capture:
 
 
 def dumps_capture(capture: Capture, pretty: bool = False) -> CaptureData:
-    line_args = [[line.ts, line.line, line.is_err] for line in capture.lines]
-    if pretty:
-        capture_obj = {
-            'command'    : capture.command,
-            'exit_status': capture.exit_status,
-            'runtime'    : capture.runtime,
-            'lines_args' : line_args,
-        }
-        capture_json = json.dumps(capture_obj, indent=2)
-    else:
-        capture_list = [
-            capture.command,
-            capture.exit_status,
-            capture.runtime,
-            line_args,
-        ]
-        capture_json = json.dumps(capture_list)
-
-    capture_bytes = capture_json.encode("utf-8")
-    return capture_bytes
+    """Serialize a capture.
+
+    The pretty (json) format is used for capture_file and is meant to
+    be human readable, otherwise the compact binary format is used.
+    The compact json format is only supported by loads_capture.
+    """
+    if not pretty:
+        return _dumps_binary_capture(capture)
+
+    line_args   = [[line.ts, line.line, line.is_err] for line in capture.lines]
+    capture_obj = {
+        'command'    : capture.command,
+        'exit_status': capture.exit_status,
+        'runtime'    : capture.runtime,
+        'lines_args' : line_args,
+    }
+    capture_json = json.dumps(capture_obj, indent=2)
+    return capture_json.encode("utf-8")
 
 
 class SessionException(Exception):
@@ -103,7 +262,9 @@ def _gen_captured_lines(
         #   output was read
         ts = time.time()
 
-        line_value = raw_line.decode(encoding)
+        # NOTE: A block may print anything, invalid data must not
+        #   kill the reader.
+        line_value = raw_line.decode(encoding, errors="replace")
         if debug_log:
             logger.debug(f"read {len(raw_line)} bytes")
         yield RawCapturedLine(ts, line_value)
@@ -146,6 +307,15 @@ def _normalize_command(command: AnyCommand) -> list[str]:
         raise Exception(f"Invalid command: {command}")
 
 
+# A subprocess.Popen or any object with the same interface,
+# (pid, stdin, stdout, stderr, poll, wait, terminate).
+Process = typ.Any
+
+# Alternative to subprocess.Popen to start a process,
+# e.g. litprog.forkserver.ForkServer.spawn
+Spawn = typ.Callable[[list[str], Environ], Process]
+
+
 class InteractiveSession:
 
     encoding: str
@@ -153,7 +323,7 @@ class InteractiveSession:
     end     : float
 
     _retcode: typ.Optional[int]
-    _proc   : sp.Popen
+    _proc   : Process
     _stdin  : typ.Optional[typ.IO[bytes]]
     _stdout : typ.IO[bytes]
     _stderr : typ.IO[bytes]
@@ -169,6 +339,7 @@ class InteractiveSession:
         env      : typ.Optional[Environ] = None,
         encoding : str  = "utf-8",
         debug_log: bool = False,
+        spawn    : typ.Optional[Spawn] = None,
     ) -> None:
         _env: Environ
         if env is None:
@@ -183,9 +354,14 @@ class InteractiveSession:
         self._retcode  = None
 
         cmd_parts = _normalize_command(cmd)
-        if self.debug_log:
-            logger.debug(f"popen {cmd_parts}")
-        self._proc = sp.Popen(cmd_parts, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, env=_env)
+        if spawn is None:
+            if self.debug_log:
+                logger.debug(f"popen {cmd_parts}")
+            self._proc = sp.Popen(cmd_parts, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, env=_env)
+        else:
+            if self.debug_log:
+                logger.debug(f"spawn {cmd_parts}")
+            self._proc = spawn(cmd_parts, _env)
 
         assert self._proc.stdin  is not None
         assert self._proc.stdout is not None
@@ -194,11 +370,16 @@ class InteractiveSession:
         self._stdout = self._proc.stdout
         self._stderr = self._proc.stderr
 
-        _enc = encoding
+        self._in_cl = []
+        self._start_capture()
 
-        self._in_cl  = []
-        self._out_ct = _start_reader(self._stdout, _enc)
-        self._err_ct = _start_reader(self._stderr, _enc)
+    def _start_capture(self) -> None:
+        self._out_ct = _start_reader(self._stdout, self.encoding)
+        self._err_ct = _start_reader(self._stderr, self.encoding)
+
+    def _join_capture(self) -> None:
+        self._out_ct.thread.join()
+        self._err_ct.thread.join()
 
     def send(self, input_str: str, delay: float = 0) -> None:
         self._in_cl.append(RawCapturedLine(time.time(), input_str))
@@ -272,8 +453,7 @@ class InteractiveSession:
                 logger.debug("stdin already closed")
 
         returncode = self._wait(timeout)
-        self._out_ct.thread.join()
-        self._err_ct.thread.join()
+        self._join_capture()
         return returncode
 
     @property
@@ -311,15 +491,15 @@ class InteractiveSession:
         return list(self.iter_lines())
 
     def iter_stdout(self) -> typ.Iterable[str]:
-        for _ts, line in self._out_ct.lines:
+        for _ts, line in self.out_lines:
             yield line
 
     def iter_stderr(self) -> typ.Iterable[str]:
-        for _ts, line in self._err_ct.lines:
+        for _ts, line in self.err_lines:
             yield line
 
     def __iter__(self) -> typ.Iterable[str]:
-        all_lines = self._in_cl + self._out_ct.lines + self._err_ct.lines
+        all_lines = self._in_cl + self.out_lines + self.err_lines
         for captured_line in sorted(all_lines):
             yield captured_line.line
 
@@ -337,6 +517,240 @@ class InteractiveSession:
         return "".join(self.iter_stderr())
 
 
+# NOTE: The SelectorInteractiveSession is an alternative
+#   to the InteractiveSession, which uses two threads per subprocess to
+#   read stdout/stderr and polls for the exit of the subprocess. Instead,
+#   the output pipes of all sessions are read by a single thread, which
+#   waits on a selector. Where available (Linux >= 5.3) the exit of a
+#   subprocess is detected using a pidfd, so no polling is involved.
+
+
+class _PipeCapture:
+
+    pipe     : typ.IO[bytes]
+    lines    : list[RawCapturedLine]
+    encoding : str
+    is_closed: bool
+
+    _buf: bytes
+
+    def __init__(self, pipe: typ.IO[bytes], encoding: str) -> None:
+        self.pipe      = pipe
+        self.lines     = []
+        self.encoding  = encoding
+        self.is_closed = False
+        self._buf      = b""
+
+    def feed(self, data: bytes) -> None:
+        # get timestamp as fast as possible after output was read
+        ts = time.time()
+        if data:
+            # NOTE: Lines are split the same way as by readline,
+            #   which is used by the thread based reader.
+            buf   = self._buf + data
+            start = 0
+            end   = buf.find(b"\n", start)
+            while end >= 0:
+                line = buf[start : end + 1].decode(self.encoding, errors="replace")
+                self.lines.append(RawCapturedLine(ts, line))
+                start = end + 1
+                end   = buf.find(b"\n", start)
+            self._buf = buf[start:]
+        else:
+            if self._buf:
+                self.lines.append(RawCapturedLine(ts, self._buf.decode(self.encoding, errors="replace")))
+                self._buf = b""
+            self.is_closed = True
+
+
+def _open_pidfd(pid: int) -> typ.Optional[int]:
+    pidfd_open = getattr(os, 'pidfd_open', None)
+    if pidfd_open is None:
+        return None
+
+    try:
+        return typ.cast(int, pidfd_open(pid))
+    except OSError:
+        # e.g. kernel < 5.3 or seccomp restrictions
+        return None
+
+
+READ_CHUNK_SIZE = 65536
+
+# Time to wait for the remaining output after a subprocess has exited.
+CAPTURE_JOIN_TIMEOUT = 10.0
+
+
+class _CaptureLoop:
+    """Read output of all subprocesses on a single thread."""
+
+    _selector: selectors.BaseSelector
+    _pending : queue.Queue
+    _wakeup_r: int
+    _wakeup_w: int
+    _thread  : threading.Thread
+
+    def __init__(self) -> None:
+        self._selector = selectors.DefaultSelector()
+        self._pending  = queue.Queue()
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+        self._thread        = threading.Thread(target=self._loop, name="litprog-capture-loop")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, isession: 'SelectorInteractiveSession') -> None:
+        # NOTE: Registration happens on the loop thread, so that the
+        #   selector is never modified concurrently.
+        self._pending.put(isession)
+        os.write(self._wakeup_w, b"x")
+
+    def _register_pending(self) -> None:
+        os.read(self._wakeup_r, READ_CHUNK_SIZE)
+        while True:
+            try:
+                isession = self._pending.get_nowait()
+            except queue.Empty:
+                break
+
+            for capture in (isession._out_cap, isession._err_cap):
+                self._selector.register(capture.pipe.fileno(), selectors.EVENT_READ, (isession, capture))
+            if isession._pidfd is not None:
+                self._selector.register(isession._pidfd, selectors.EVENT_READ, (isession, None))
+
+    def _loop(self) -> None:
+        while True:
+            for key, _events in self._selector.select():
+                if key.data is None:
+                    self._register_pending()
+                    continue
+
+                isession, capture = key.data
+                try:
+                    self._on_ready(key.fd, isession, capture)
+                except Exception:
+                    # NOTE: The loop is shared by all sessions, an error
+                    #   must only affect the session that caused it.
+                    logger.error("Error reading output of subprocess", exc_info=True)
+                    self._abort(isession)
+
+    def _on_ready(
+        self,
+        fd      : int,
+        isession: 'SelectorInteractiveSession',
+        capture : typ.Optional[_PipeCapture],
+    ) -> None:
+        if capture is None:
+            # pidfd is readable -> process has exited
+            self._selector.unregister(fd)
+            isession._on_exit()
+            return
+
+        data = os.read(fd, READ_CHUNK_SIZE)
+        capture.feed(data)
+        if not data:
+            self._selector.unregister(fd)
+            isession._on_output_closed()
+
+    def _abort(self, isession: 'SelectorInteractiveSession') -> None:
+        # NOTE: Only keys of this session are unregistered. The fd of a
+        #   pipe or pidfd that was already closed may have been reused
+        #   by another session.
+        session_keys = [
+            key for key in self._selector.get_map().values() if key.data and key.data[0] is isession
+        ]
+        for key in session_keys:
+            self._selector.unregister(key.fd)
+        isession._close_pidfd()
+        isession._done.set()
+
+
+_capture_loop      : typ.Optional[_CaptureLoop] = None
+_capture_loop_lock = threading.Lock()
+
+
+def _get_capture_loop() -> _CaptureLoop:
+    # pylint: disable=global-statement
+    global _capture_loop
+
+    with _capture_loop_lock:
+        if _capture_loop is None:
+            _capture_loop = _CaptureLoop()
+        return _capture_loop
+
+
+class SelectorInteractiveSession(InteractiveSession):
+
+    _out_cap: _PipeCapture
+    _err_cap: _PipeCapture
+    _pidfd  : typ.Optional[int]
+
+    _is_exited: bool
+    _done     : threading.Event
+
+    def _start_capture(self) -> None:
+        self._out_cap   = _PipeCapture(self._stdout, self.encoding)
+        self._err_cap   = _PipeCapture(self._stderr, self.encoding)
+        self._pidfd     = _open_pidfd(self._proc.pid)
+        self._is_exited = self._pidfd is None
+        self._done      = threading.Event()
+        _get_capture_loop().add(self)
+
+    def _on_output_closed(self) -> None:
+        if self._out_cap.is_closed and self._err_cap.is_closed and self._is_exited:
+            self._done.set()
+
+    def _close_pidfd(self) -> None:
+        pidfd = self._pidfd
+        if pidfd is not None:
+            self._pidfd = None
+            os.close(pidfd)
+
+    def _on_exit(self) -> None:
+        self._close_pidfd()
+        self._is_exited = True
+        self._on_output_closed()
+
+    def _join_capture(self) -> None:
+        if not self._done.wait(CAPTURE_JOIN_TIMEOUT):
+            logger.warning(f"Output of subprocess was not closed after {CAPTURE_JOIN_TIMEOUT}sec")
+
+    def _wait(self, timeout) -> int:
+        returncode: typ.Optional[int] = None
+        try:
+            time_left = self.start + timeout - time.time()
+            if self._done.wait(max(0, time_left)):
+                # NOTE: Without a pidfd, the output may be closed before
+                #   the process has exited.
+                time_left  = self.start + timeout - time.time()
+                returncode = self._proc.wait(timeout=max(0, time_left))
+            elif self.debug_log:
+                logger.debug("timeout")
+        except sp.TimeoutExpired:
+            if self.debug_log:
+                logger.debug("timeout")
+        finally:
+            if returncode is None:
+                if self.debug_log:
+                    logger.debug("sending SIGTERM")
+                self._proc.terminate()
+                returncode = self._proc.wait()
+
+        self._retcode = returncode
+        self.end      = time.time()
+        return returncode
+
+    @property
+    def out_lines(self) -> list[RawCapturedLine]:
+        return self._out_cap.lines
+
+    @property
+    def err_lines(self) -> list[RawCapturedLine]:
+        return self._err_cap.lines
+
+
 class DebugInteractiveSession(InteractiveSession):
 
     start: float
@@ -385,3 +799,11 @@ class DebugInteractiveSession(InteractiveSession):
 
     def output_lines(self) -> list[CapturedLine]:
         return []
+
+
+SESSION_ENGINES: dict[str, typ.Type[InteractiveSession]] = {
+    'thread'  : InteractiveSession,
+    'selector': SelectorInteractiveSession,
+}
+
+DEFAULT_SESSION_ENGINE = 'thread'
@@ -0,0 +1,17 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+
+import pytest
+
+import litprog.config
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Isolate all caches (parse cache, build cache) of a test."""
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', cache_dir)
+    return cache_dir
@@ -0,0 +1,334 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2019-2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=protected-access
+
+import fnmatch
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import litprog.parse
+import litprog.session
+import litprog.build as sut
+
+TASKS_MD = """
+# Tasks
+
+```python
+# exec
+# def: a
+print("a")
+```
+
+```python
+# exec
+# def: b
+# requires: a
+print("b")
+```
+
+```python
+# exec
+# requires: b
+print("c")
+```
+
+```python
+# exec
+print("d")
+```
+"""
+
+
+def _parse_tasks(tmp_path, md_text):
+    md_path = tmp_path / "01_tasks.md"
+    md_path.write_text(md_text)
+    ctx = litprog.parse.parse_context([md_path])
+    return [task for chapter in ctx.chapters for task in sut._iter_block_tasks(chapter)]
+
+
+def test_task_graph(tmp_path):
+    tasks = _parse_tasks(tmp_path, TASKS_MD)
+    graph = sut._build_task_graph(tasks)
+
+    assert graph.dependents   == [[1], [2], [], []]
+    assert graph.num_requires == [0, 1, 1, 0]
+
+
+def test_critical_path_ranks(tmp_path):
+    tasks = _parse_tasks(tmp_path, TASKS_MD)
+    graph = sut._build_task_graph(tasks)
+    ranks = sut._critical_path_ranks(graph, [1.0, 1.0, 1.0, 1.0])
+
+    assert ranks == [3.0, 2.0, 1.0, 1.0]
+
+
+def test_unsatisfied_requires(tmp_path):
+    tasks = _parse_tasks(tmp_path, TASKS_MD.replace("requires: a", "requires: x"))
+    graph = sut._build_task_graph(tasks)
+
+    assert graph.num_requires == [0, 1, 1, 0]
+    assert graph.dependents   == [[], [2], [], []]
+
+
+def test_critical_path_ranks_with_costs(tmp_path):
+    tasks = _parse_tasks(tmp_path, TASKS_MD)
+    graph = sut._build_task_graph(tasks)
+    ranks = sut._critical_path_ranks(graph, [10.0, 20.0, 5.0, 50.0])
+
+    # the long running independent task 'd' is started first
+    assert ranks == [35.0, 25.0, 5.0, 50.0]
+
+
+def test_estimate_costs(tmp_path):
+    md_path = tmp_path / "01_tasks.md"
+    md_path.write_text(TASKS_MD)
+    ctx  = litprog.parse.parse_context([md_path])
+    opts = sut.BuildOptions(exitfirst=False, in_place_update=False, cache_enabled=False, concurrency=1)
+
+    runner = sut.Runner(ctx.chapters, ctx.chapters, opts)
+    assert runner._estimate_costs() == [sut.DEFAULT_TASK_COST] * 4
+
+    task_a, _, _, task_d = runner._all_tasks
+    runner._cache.update(task_a, litprog.session.Capture("python3", 0, 0.02, []))
+    runner._cache.update(task_d, litprog.session.Capture("python3", 0, 0.3 , []))
+
+    # tasks without an estimate take the median of the known estimates
+    assert runner._estimate_costs() == [20.0, 300.0, 300.0, 300.0]
+
+
+EXPAND_MD = """
+# Expand
+
+```python
+# def: common
+import os
+```
+
+```python
+# def: helper
+# dep: common
+def helper(): return os.sep
+```
+
+```python
+# def: unused
+# dep: helper
+```
+
+```python
+# file: out/main.py
+# dep: helper
+# dep: common
+print(helper())
+```
+
+```python
+# exec
+# dep: helper
+print(helper())
+```
+"""
+
+
+def test_expand_consumed_blocks(tmp_path):
+    md_path = tmp_path / "01_expand.md"
+    md_path.write_text(EXPAND_MD)
+    ctx = litprog.parse.parse_context([md_path])
+
+    blocks_by_sid = sut._get_blocks_by_id(ctx.chapters)
+    cache         = sut.ExpansionCache(sut.BlockIdIndex(blocks_by_sid))
+    chapter       = sut._expand_directives(blocks_by_sid, ctx.chapters[0], cache)
+    blocks        = list(chapter.iter_blocks())
+
+    # blocks that are only used via dep/include are not expanded
+    assert "# dep: helper" in blocks[2].content
+    assert "# dep: common" in blocks[1].content
+
+    file_content = blocks[3].includable_content
+    assert file_content.count("import os") == 1
+    assert file_content.index("import os") < file_content.index("def helper")
+    assert "# dep:" not in file_content
+
+    exec_content = blocks[4].includable_content
+    assert exec_content.count("import os") == 1
+    assert exec_content.count("def helper") == 1
+
+    # helper is expanded once and reused by both consumers
+    helper_key = (md_path, blocks[1].elem_index)
+    assert len(cache.expansions[helper_key]) == 1
+
+
+def test_expand_invalid_id_in_unconsumed_block(tmp_path):
+    md_path = tmp_path / "01_expand.md"
+    md_path.write_text(EXPAND_MD.replace("# dep: helper\n```", "# dep: missing\n```"))
+    ctx = litprog.parse.parse_context([md_path])
+
+    try:
+        list(sut._iter_expanded_chapters(ctx.chapters))
+        assert False, "expected BlockError"
+    except sut.BlockError as err:
+        assert "missing" in str(err)
+
+    # a block without a def is not part of the dependency map
+    md_path.write_text(EXPAND_MD + "\n```python\n# include: missing\n```\n")
+    ctx = litprog.parse.parse_context([md_path])
+    try:
+        list(sut._iter_expanded_chapters(ctx.chapters))
+        assert False, "expected BlockError"
+    except sut.BlockError as err:
+        assert "missing" in str(err)
+
+
+def test_splice_chunks():
+    content = "a\n# dep: x\nb\n# dep: x\n# include: y\nc # include: y\n"
+    chunks  = [(content, False)]
+    chunks  = sut._splice_chunks(chunks, "# dep: x", "X\n", is_dep=True)
+    chunks  = sut._splice_chunks(chunks, "# include: y", "Y", is_dep=False)
+
+    expected = sut._indented_include(content , "# dep: x"    , "X\n", is_dep=True)
+    expected = sut._indented_include(expected, "# include: y", "Y"  , is_dep=False)
+    assert "".join(text for text, _ in chunks) == expected
+    assert [text for text, is_included in chunks if is_included] == ["X\n", "Y", "Y"]
+
+
+CYCLE_MD = """
+# Cycles
+
+```python
+# def: a
+# dep: b
+```
+
+```python
+# def: b
+# dep: c
+```
+
+```python
+# def: c
+# include: a
+```
+
+```python
+# def: d
+# dep: d
+```
+
+```python
+# def: e
+# dep: c
+```
+"""
+
+
+def test_dep_cycles(tmp_path):
+    md_path = tmp_path / "01_cycles.md"
+    md_path.write_text(CYCLE_MD)
+    ctx = litprog.parse.parse_context([md_path])
+
+    blocks_by_sid = sut._get_blocks_by_id(ctx.chapters)
+    dep_map       = sut._build_dep_map(blocks_by_sid)
+
+    cycles = sorted(sorted(scc) for scc in sut._iter_dep_cycles(dep_map))
+    assert cycles == [["cycles.a", "cycles.b", "cycles.c"], ["cycles.d"]]
+
+    cycle_path = sut._get_cycle_path(["cycles.c", "cycles.b", "cycles.a"], dep_map)
+    assert cycle_path == ["cycles.a", "cycles.b", "cycles.c", "cycles.a"]
+
+    try:
+        list(sut._iter_expanded_chapters(ctx.chapters))
+        assert False, "expected BlockError"
+    except sut.BlockError as err:
+        assert "dep/include cycle 'cycles.a' -> 'cycles.b' -> 'cycles.c' -> 'cycles.a'" in str(err)
+
+
+def test_dep_cycles_deep_diamonds():
+    # each layer depends on both blocks of the next layer
+    depth   = 5000
+    dep_map = {f"l{i}.{j}": [f"l{i + 1}.0", f"l{i + 1}.1"] for i in range(depth) for j in range(2)}
+    assert list(sut._iter_dep_cycles(dep_map)) == []
+
+    dep_map[f"l{depth}.0"] = ["l0.0"]
+    cycles = list(sut._iter_dep_cycles(dep_map))
+    assert len(cycles) == 1
+    assert len(sut._get_cycle_path(cycles[0], dep_map)) == depth + 2
+
+
+def test_block_id_index():
+    sids = ["b.util_z", "a.x", "b.util_a", "b.other", "c.util_b", "b.util_a2"]
+    index = sut.BlockIdIndex(sids)
+
+    assert index.resolve("a.x") == ("a.x",)
+    assert index.resolve("a.y") == ()
+    assert index.resolve("b.util_?") == ()
+    # results are in the original order, not in sorted order
+    assert index.resolve("b.util_*") == ("b.util_z", "b.util_a", "b.util_a2")
+    assert index.resolve("b.util_?*") == ("b.util_z", "b.util_a", "b.util_a2")
+    assert index.resolve("*.util_[ab]") == ("b.util_a", "c.util_b")
+    assert index.resolve("*") == tuple(sids)
+    assert index.resolve("d.*") == ()
+
+    for pattern in ["b.*", "*util*", "?.*", "b.util_a*", "[ab].*"]:
+        expected = tuple(sid for sid in sids if fnmatch.fnmatchcase(sid, pattern))
+        assert index.resolve(pattern) == expected
+
+
+def test_wildcard_requires(tmp_path):
+    md_text = TASKS_MD.replace("requires: b", "requires: tasks.*")
+    tasks   = sut._resolve_requires_ids(_parse_tasks(tmp_path, md_text))
+    graph   = sut._build_task_graph(tasks)
+
+    assert tasks[1].opts.requires_ids == {"tasks.a"}
+    assert tasks[2].opts.requires_ids == {"tasks.a", "tasks.b"}
+    assert graph.dependents   == [[1, 2], [2], [], []]
+    assert graph.num_requires == [0, 1, 2, 0]
+
+    md_text = TASKS_MD.replace("requires: b", "requires: x.*")
+    tasks   = sut._resolve_requires_ids(_parse_tasks(tmp_path, md_text))
+    assert tasks[2].opts.requires_ids == {"x.*"}
+
+
+def test_task_timeout(tmp_path, monkeypatch):
+    md_path = tmp_path / "01_tasks.md"
+    md_path.write_text(TASKS_MD.replace("# def: b", "# def: b\n# timeout: 0.1"))
+    ctx  = litprog.parse.parse_context([md_path])
+    opts = sut.BuildOptions(exitfirst=False, in_place_update=False, cache_enabled=False, concurrency=4)
+
+    monkeypatch.setattr(sut, 'TASK_TIMEOUT_GRACE', 0.1)
+    runner = sut.Runner(ctx.chapters, ctx.chapters, opts)
+
+    def submit(task):
+        future = Future()
+        if task.opts.provides_id != "tasks.b":
+            future.set_result(None)
+        # else: task b is stuck and never completes
+        return future
+
+    with pytest.raises(sut.BlockTimeoutError, match="01_tasks.md"):
+        runner._start(submit)
+
+
+def test_write_file_atomic(tmp_path):
+    file_path = tmp_path / "out" / "data.txt"
+    contents  = [f"content {i}\n".encode("utf-8") * 10000 for i in range(8)]
+    threads   = [threading.Thread(target=sut._write_file_atomic, args=(file_path, data)) for data in contents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert file_path.read_bytes() in contents
+    assert file_path.stat().st_mode & 0o777 == sut.NEW_FILE_MODE
+    assert not list(file_path.parent.glob(".*.tmp"))
+
+    # the mode of an existing file is preserved
+    file_path.chmod(0o755)
+    sut._write_file_atomic(file_path, b"new")
+    assert file_path.read_bytes() == b"new"
+    assert file_path.stat().st_mode & 0o777 == 0o755
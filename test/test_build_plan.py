@@ -0,0 +1,189 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=protected-access
+
+import os
+import threading
+
+import litprog.build
+import litprog.index
+import litprog.parse
+import litprog.config
+import litprog.build_plan as sut
+
+PROJECT_MD = """
+# Plan
+
+```python
+# def: greeting
+GREETING = "hello"
+```
+
+```python
+# file: out/greet.py
+# dep: greeting
+print(GREETING)
+```
+
+```python
+# exec
+print(1 + 1)
+```
+
+```shell
+# out
+```
+"""
+
+BUILD_OPTS = litprog.build.BuildOptions(
+    exitfirst=False,
+    in_place_update=True,
+    cache_enabled=True,
+    concurrency=1,
+)
+
+
+def _is_noop(md_path, in_place_update=True):
+    return sut.is_noop_build([md_path], sut.plan_options(in_place_update=in_place_update))
+
+
+def _build(md_path):
+    parse_ctx = litprog.parse.parse_context([md_path])
+    litprog.build.build(parse_ctx, BUILD_OPTS)
+
+
+def test_noop_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+
+    md_path = tmp_path / "01_plan.md"
+    md_path.write_text(PROJECT_MD)
+    assert not _is_noop(md_path)
+
+    _build(md_path)
+    assert (tmp_path / "out" / "greet.py").read_text() == 'GREETING = "hello"\nprint(GREETING)'
+    assert "2" in md_path.read_text()
+    assert _is_noop(md_path)
+    assert not _is_noop(md_path, in_place_update=False)
+
+    # touching a file without changing its content is not a change
+    os.utime(md_path, (0, 0))
+    assert _is_noop(md_path)
+
+    # modified output
+    (tmp_path / "out" / "greet.py").write_text("print('modified')\n")
+    assert not _is_noop(md_path)
+    _build(md_path)
+    assert _is_noop(md_path)
+
+    # modified input
+    md_path.write_text(md_path.read_text().replace("hello", "hi"))
+    plan = sut.load_plan([md_path])
+    assert sut.changed_md_paths(plan, [md_path]) == {md_path}
+    assert not _is_noop(md_path)
+    _build(md_path)
+    assert (tmp_path / "out" / "greet.py").read_text() == 'GREETING = "hi"\nprint(GREETING)'
+    assert _is_noop(md_path)
+
+    # evicted capture
+    plan = sut.load_plan([md_path])
+    os.remove(plan.cache_db)
+    assert not _is_noop(md_path)
+
+
+def test_changed_outputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+
+    md_path_1 = tmp_path / "01_plan.md"
+    md_path_2 = tmp_path / "02_other.md"
+    md_path_1.write_text(PROJECT_MD)
+    md_path_2.write_text("# Other\n\n```python\n# file: out/other.py\nprint('other')\n```\n")
+
+    parse_ctx = litprog.parse.parse_context([md_path_1, md_path_2])
+    litprog.build.build(parse_ctx, BUILD_OPTS)
+
+    plan = sut.load_plan([md_path_1, md_path_2])
+    assert sut.changed_outputs(plan) == set()
+
+    (tmp_path / "out" / "other.py").write_text("print('modified')")
+    assert sut.changed_outputs(plan) == {tmp_path / "out" / "other.py"}
+    (tmp_path / "out" / "greet.py").unlink()
+    assert sut.changed_outputs(plan) == {tmp_path / "out" / "other.py", tmp_path / "out" / "greet.py"}
+
+
+def test_noop_build_inputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "a.txt").write_text("a")
+
+    md_path = tmp_path / "01_plan.md"
+    md_path.write_text("# Inputs\n\n```bash\n# run: cat data/a.txt\n# inputs: data/*.txt\n```\n")
+    _build(md_path)
+    assert _is_noop(md_path)
+
+    # touching an input without changing its content is not a change
+    input_path = tmp_path / "data" / "a.txt"
+    os.utime(input_path, (0, 0))
+    assert _is_noop(md_path)
+
+    # a modification which doesn't change the mtime or size of an input
+    plan = sut.load_plan([md_path])
+    (input_state,) = plan.tasks[0].input_states.values()
+    assert input_state.digest == litprog.index.content_digest(b"a")
+    input_path.write_text("x")
+    os.utime(input_path, ns=(input_state.mtime_ns, input_state.mtime_ns))
+    assert not _is_noop(md_path)
+    input_path.write_text("a")
+
+    # a new file that matches a glob of the inputs directive
+    (tmp_path / "data" / "b.txt").write_text("b")
+    assert not _is_noop(md_path)
+    _build(md_path)
+    assert _is_noop(md_path)
+
+
+def test_modified_during_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+
+    md_path = tmp_path / "01_plan.md"
+    # simulate an editor that saves the file while the build is running
+    (tmp_path / "edit.py").write_text(
+        "import pathlib\n"
+        + "md_path = pathlib.Path('01_plan.md')\n"
+        + "md_path.write_text(md_path.read_text().replace('A = 1', 'A = 2'))\n"
+    )
+    md_path.write_text(
+        "# Edit\n\n```python\n# file: out/a.py\nA = 1\n```\n\n```bash\n# run: python3 edit.py\n```\n"
+    )
+    parse_ctx = litprog.parse.parse_context([md_path])
+    litprog.build.build(parse_ctx, BUILD_OPTS._replace(in_place_update=False))
+    assert (tmp_path / "out" / "a.py").read_text() == "A = 1"
+    assert "A = 2" in md_path.read_text()
+    assert not _is_noop(md_path, in_place_update=False)
+
+
+def test_concurrent_dump(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+
+    md_path = tmp_path / "01_plan.md"
+    md_path.write_text(PROJECT_MD)
+    _build(md_path)
+    plan = sut.load_plan([md_path])
+
+    threads = [threading.Thread(target=sut.dump_plan, args=([md_path], plan)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sut.load_plan([md_path]) == plan
+    assert not list((tmp_path / "cache" / sut.PLAN_DIR_NAME).glob("*.tmp"))
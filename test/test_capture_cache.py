@@ -0,0 +1,257 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=protected-access
+
+import os
+import shelve
+
+import pytest
+
+import litprog.build
+import litprog.index
+import litprog.config
+import litprog.parse
+import litprog.session
+import litprog.capture_cache as sut
+
+
+def _entry(created: str, task_key: str, capture_digest: str) -> sut.ManifestEntry:
+    return sut.ManifestEntry(created, 10, 100, capture_digest, task_key, "01_test.md", "@ 1 - python")
+
+
+MANIFEST = [
+    _entry("2021-03-01T00:00:00", "key_a", "digest_1"),
+    _entry("2021-03-02T00:00:00", "key_b", "digest_2"),
+    _entry("2021-03-03T00:00:00", "key_a", "digest_3"),
+]
+
+
+def test_manifest_index():
+    cache = sut.ResultCache(sut.dumps_manifest(list(MANIFEST)))
+    assert len(cache.manifest) == 3
+    assert cache._entries_by_task_key['key_a'].capture_digest == "digest_3"
+    assert cache._entries_by_task_key['key_b'].capture_digest == "digest_2"
+
+
+def test_compact():
+    cache   = sut.ResultCache(sut.dumps_manifest(list(MANIFEST)))
+    dropped = cache.compact()
+    assert [entry.capture_digest for entry in dropped       ] == ["digest_1"]
+    assert [entry.capture_digest for entry in cache.manifest] == ["digest_2", "digest_3"]
+    assert cache.compact() == []
+
+
+def test_get_entry(tmp_path):
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    ctx  = litprog.parse.parse_context([md_path])
+    task = next(litprog.build._iter_block_tasks(ctx.chapters[0]))
+
+    cache = sut.DummyCache()
+    assert cache.get_entry(task) is None
+
+    capture = litprog.session.Capture("python3", 0, 0.1, [])
+    cache.update(task, capture)
+    cache.update(task, capture._replace(runtime=0.2))
+
+    entry = cache.get_entry(task)
+    assert entry is not None
+    assert entry.runtime_ms == 200
+    assert len(cache.manifest) == 2
+    assert len(cache.compact()) == 1
+
+
+def test_estimate_runtime_ms(tmp_path):
+    md_path = tmp_path / "01_test.md"
+
+    def _task(md_text):
+        md_path.write_text(md_text)
+        ctx = litprog.parse.parse_context([md_path])
+        return next(litprog.build._iter_block_tasks(ctx.chapters[0]))
+
+    task = _task("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    cache = sut.DummyCache()
+    assert cache.estimate_runtime_ms(task) is None
+
+    capture = litprog.session.Capture("python3", 0, 0.1, [])
+    cache.update(task, capture)
+
+    # later entries of other tasks with the same info and summary
+    task_info  = sut._task_info(task.block)
+    moved_info = task_info.replace(f"@{task.block.first_line:>6}", f"@{99:>6}", 1)
+    assert moved_info != task_info
+    md_filename = str(md_path)
+    cache._add_entry(sut.ManifestEntry("9999-01-01T00:00:00", 300, 0, "d1", "key_1", md_filename, task_info))
+    cache._add_entry(sut.ManifestEntry("9999-01-02T00:00:00", 500, 0, "d2", "key_2", md_filename, moved_info))
+
+    # 1. the same task
+    assert cache.estimate_runtime_ms(task) == 100
+    # 2. a changed block at the same line
+    changed_md = "# Test\n\n```python\n# exec\nprint('a')\nprint('b')\n```\n"
+    assert cache.estimate_runtime_ms(_task(changed_md)) == 300
+    # 3. a changed block that was moved, with the same first line of code
+    moved_md = "# Test\n\nText\n\n```python\n# exec\nprint('a')\nprint('b')\n```\n"
+    assert cache.estimate_runtime_ms(_task(moved_md)) == 500
+    # 4. no estimate for an unknown block (see Runner._estimate_costs)
+    assert cache.estimate_runtime_ms(_task("# Test\n\n```bash\n# exec\necho c\n```\n")) is None
+
+
+def test_sqlite_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    ctx  = litprog.parse.parse_context([md_path])
+    task = next(litprog.build._iter_block_tasks(ctx.chapters[0]))
+
+    capture = litprog.session.Capture("python3", 0, 0.1, [litprog.session.CapturedLine(0.01, "a\n", False)])
+
+    cache = sut.SQLiteResultCache(ctx.chapters)
+    assert cache.get_capture(task) is None
+    cache.update(task, capture)
+    cache.update(task, capture._replace(runtime=0.2))
+    assert cache.get_capture(task) == capture._replace(runtime=0.2)
+    cache.flush()
+
+    cache = sut.SQLiteResultCache(ctx.chapters)
+    assert len(cache.manifest) == 1
+    assert cache.get_capture(task) == capture._replace(runtime=0.2)
+    cache.flush()
+
+
+def test_sqlite_cache_migration(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    ctx  = litprog.parse.parse_context([md_path])
+    task = next(litprog.build._iter_block_tasks(ctx.chapters[0]))
+
+    capture     = litprog.session.Capture("python3", 0, 0.1, [])
+    task_key    = sut.DummyCache().task_key(task)
+    entry, data = sut.init_manifest_entry(task, task_key, capture)
+    cache_dir   = sut._cache_dir(ctx.chapters)
+    (cache_dir / "build_cache.manifest_v1").write_text(sut.dumps_manifest([entry]))
+    with shelve.open(str(cache_dir / "build_cache.db")) as legacy_db:
+        legacy_db[entry.capture_digest] = data
+
+    cache = sut.SQLiteResultCache(ctx.chapters)
+    assert cache.manifest == [entry]
+    assert cache.get_capture(task) == capture
+    cache.flush()
+
+
+def test_evict(tmp_path):
+    conn = sut._connect(tmp_path / sut.DB_FILENAME)
+    for i, (created, task_key) in enumerate(
+        [
+            ("2021-01-01T00:00:00", "key_old"),
+            ("2021-03-01T00:00:00", "key_a"),
+            ("2021-03-02T00:00:00", "key_b"),
+            ("2021-03-03T00:00:00", "key_c"),
+        ]
+    ):
+        entry = _entry(created, task_key, f"digest_{i}")
+        conn.execute("INSERT INTO captures VALUES (?, ?, 'raw', NULL)", (entry.capture_digest, b"x" * 100))
+        conn.execute("INSERT INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?)", entry)
+
+    # key_a was hit recently, so key_b is the least recently used
+    conn.execute("INSERT INTO usage VALUES ('key_a', '2021-03-04T00:00:00', 1)")
+    conn.commit()
+
+    now     = sut.dt.datetime(2021, 3, 5)
+    evicted = sut.evict(conn, max_bytes=200, max_age=sut.dt.timedelta(days=30), now=now)
+    assert evicted == sut.EvictionResult(2, 200)
+
+    task_keys = {task_key for (task_key,) in conn.execute("SELECT task_key FROM manifest")}
+    assert task_keys == {"key_a", "key_c"}
+    assert conn.execute("SELECT count(*) FROM captures").fetchone() == (2,)
+
+
+def _sample_captures(num_captures: int) -> list[bytes]:
+    captures = []
+    for i in range(num_captures):
+        lines = [
+            litprog.session.CapturedLine(0.001 * j, f"Traceback (most recent call last): line {j}\n", True)
+            for j in range(i % 7)
+        ]
+        lines.append(litprog.session.CapturedLine(0.01, f"result {i}\n", False))
+        captures.append(litprog.session.dumps_capture(litprog.session.Capture("python3", 0, 0.1, lines)))
+    return captures
+
+
+@pytest.mark.parametrize("codec", [sut.CODEC_RAW, sut.CODEC_ZLIB, sut.CODEC_ZSTD])
+def test_compress_round_trip(codec):
+    if codec == sut.CODEC_ZSTD and sut.zstandard is None:
+        pytest.skip("zstandard not installed")
+
+    captures = _sample_captures(20)
+    for capture_data in captures:
+        assert sut._decompress(sut._compress(capture_data, codec), codec) == capture_data
+
+    if codec != sut.CODEC_RAW:
+        zdict = sut.CompressionDict(1, codec, sut.train_dict(captures, codec, dict_size=1024))
+        for capture_data in captures:
+            compressed = sut._compress(capture_data, codec, zdict)
+            assert sut._decompress(compressed, codec, zdict) == capture_data
+            assert len(compressed) < len(sut._compress(capture_data, codec))
+
+
+def test_train(tmp_path):
+    conn     = sut._connect(tmp_path / sut.DB_FILENAME)
+    captures = _sample_captures(50)
+    for i, capture_data in enumerate(captures):
+        conn.execute("INSERT INTO captures VALUES (?, ?, 'raw', NULL)", (f"digest_{i}", capture_data))
+    conn.commit()
+
+    result = sut.train(conn, dict_size=2048)
+    assert result.num_captures == 50
+    assert result.bytes_after < result.bytes_before / 2
+    assert sorted(data for _, data in sut._iter_captures(conn)) == sorted(captures)
+
+
+def test_task_key_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "a.csv").write_text("1,2")
+    (tmp_path / "script.py").write_text("print(1)")
+
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text(
+        "# Test\n\n```bash\n# run: python3 script.py\n# inputs: data/*.csv, lib/**/*.py\n```\n\n"
+        + "```bash\n# run: python3 script.py\n```\n"
+    )
+    ctx = litprog.parse.parse_context([md_path])
+    task, fallback_task = litprog.build._iter_block_tasks(ctx.chapters[0])
+    assert task.opts.input_globs == ["data/*.csv", "lib/**/*.py"]
+    assert sut.task_input_globs(task) == {"data/*.csv": ["data/a.csv"], "lib/**/*.py": []}
+
+    def _task_keys():
+        # a new index for every check, as for a new build
+        cache            = sut.DummyCache()
+        cache.file_index = litprog.index.Index(tmp_path / "file_index.json")
+        return (cache.task_key(task), cache.task_key(fallback_task))
+
+    task_key, fallback_key = _task_keys()
+
+    # touching a file without changing its content is not a change
+    os.utime(tmp_path / "data" / "a.csv", (0, 0))
+    assert _task_keys() == (task_key, fallback_key)
+
+    # the declared inputs replace the heuristic of parsing the command
+    (tmp_path / "script.py").write_text("print(2)")
+    assert _task_keys()[0] == task_key
+    assert _task_keys()[1] != fallback_key
+
+    (tmp_path / "data" / "a.csv").write_text("3,4")
+    assert _task_keys()[0] != task_key
+    task_key = _task_keys()[0]
+
+    # a new file that matches a glob is a change
+    (tmp_path / "lib" / "sub").mkdir(parents=True)
+    (tmp_path / "lib" / "sub" / "mod.py").write_text("X = 1")
+    assert _task_keys()[0] != task_key
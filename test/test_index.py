@@ -0,0 +1,154 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=protected-access
+
+import os
+import pathlib as pl
+
+import litprog.build
+import litprog.parse
+import litprog.config
+import litprog.capture_cache
+import litprog.index as sut
+
+
+def test_blake2_available():
+    assert sut.IS_BLAKE2_AVAILABLE
+    assert len(sut._file_digest(pl.Path(__file__))) == 128
+
+
+def test_target_done(tmp_path):
+    dep_a = tmp_path / "a.txt"
+    dep_b = tmp_path / "b.txt"
+    dep_a.write_text("a")
+    dep_b.write_text("b")
+
+    idx = sut.Index(tmp_path / "index.json")
+    assert not idx.is_target_done('target', {dep_a, dep_b})
+    idx.mark_target_done('target', {dep_a, dep_b})
+    assert idx.is_target_done('target', {dep_a, dep_b})
+    assert not idx.is_target_done('target', {dep_a})
+    idx.dump_index()
+
+    # touching a file without changing its content is not a change
+    os.utime(dep_a, (0, 0))
+    idx = sut.Index(tmp_path / "index.json")
+    assert idx.is_target_done('target', {dep_a, dep_b})
+
+    dep_b.write_text("changed")
+    assert not idx.is_target_done('target', {dep_a, dep_b})
+    idx.mark_target_done('target', {dep_a, dep_b})
+    assert idx.is_target_done('target', {dep_a, dep_b})
+
+    dep_b.unlink()
+    assert not idx.is_target_done('target', {dep_a, dep_b})
+
+
+def test_check_paths(tmp_path):
+    paths = [tmp_path / f"file_{i}.txt" for i in range(20)]
+    for i, path in enumerate(paths):
+        path.write_text(str(i))
+
+    idx = sut.Index(tmp_path / "index.json")
+    idx.check_paths(paths + [tmp_path / "missing.txt"])
+    assert set(idx._checks) == {sut.entry_key(path) for path in paths + [tmp_path / "missing.txt"]}
+    assert idx.digest(paths[0]) == sut._file_digest(paths[0])
+    assert idx.digest(tmp_path / "missing.txt") is None
+
+    # a file that is modified during a build is checked again
+    paths[0].write_text("modified")
+    assert idx.digest(paths[0]) == sut._file_digest(paths[0])
+
+
+def test_concurrent_update(tmp_path):
+    idx_1 = sut.Index(tmp_path / "index.json")
+    idx_2 = sut.Index(tmp_path / "index.json")
+    idx_2.dump_index()
+    try:
+        idx_1.dump_index()
+        assert False, "expected IndexConflictError"
+    except sut.IndexConflictError:
+        pass
+
+
+BUILD_OPTS = litprog.build.BuildOptions(
+    exitfirst=False,
+    in_place_update=False,
+    cache_enabled=True,
+    concurrency=1,
+)
+
+
+def test_build_file_outputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+
+    md_path_1 = tmp_path / "01_files.md"
+    md_path_2 = tmp_path / "02_files.md"
+    md_path_1.write_text(
+        "# One\n\n```python\n# file: out/one.py\nprint('one')\n```\n\n"
+        + "```python\n# file: out/other.py\nprint('other')\n```\n"
+    )
+    md_path_2.write_text("# Two\n\n```python\n# file: out/two.py\nprint('two')\n```\n")
+    out_one   = tmp_path / "out" / "one.py"
+    out_two   = tmp_path / "out" / "two.py"
+    out_other = tmp_path / "out" / "other.py"
+
+    def _build(concurrency=1):
+        parse_ctx = litprog.parse.parse_context([md_path_1, md_path_2])
+        litprog.build.build(parse_ctx, BUILD_OPTS._replace(concurrency=concurrency))
+        return litprog.capture_cache.open_file_index(parse_ctx.chapters)
+
+    idx = _build()
+    assert out_one.read_text() == "print('one')"
+    assert idx.digest(out_one) == sut.content_digest(b"print('one')")
+    assert not list((tmp_path / "out").glob(".*.tmp"))
+
+    # an output that was modified by anything other than litprog is restored
+    out_one.write_text("modified")
+    os.chmod(out_one, 0o755)
+    os.utime(out_two, (0, 0))
+    _build(concurrency=4)
+    assert out_one.read_text() == "print('one')"
+    assert out_one.stat().st_mode & 0o777 == 0o755
+    assert out_two.stat().st_mtime == 0
+
+    # a change to one block doesn't affect the outputs of other blocks,
+    # even if they are in the same md file.
+    os.utime(out_one, (0, 0))
+    md_path_1.write_text(md_path_1.read_text().replace("'other'", "'changed'"))
+    _build(concurrency=4)
+    assert out_one.stat().st_mtime == 0
+    assert out_other.read_text() == "print('changed')"
+
+
+def test_docs_targets(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+
+    md_path = tmp_path / "01_docs.md"
+    md_path.write_text("# Docs\n\nText\n")
+    doc_ctx  = litprog.parse.parse_context([md_path])
+    html_dir = tmp_path / "html"
+
+    idx = litprog.capture_cache.open_file_index(doc_ctx.chapters)
+    assert not litprog.build.is_docs_target_done(idx, 'html', html_dir, doc_ctx)
+
+    html_dir.mkdir()
+    (html_dir / "index.html").write_text("<p>Text</p>")
+    litprog.build.mark_docs_target_done(idx, 'html', html_dir, doc_ctx)
+    assert litprog.build.is_docs_target_done(idx, 'html', html_dir, doc_ctx)
+
+    # a modified document invalidates the previous target
+    md_path.write_text("# Docs\n\nChanged\n")
+    new_doc_ctx = litprog.parse.parse_context([md_path])
+    assert not litprog.build.is_docs_target_done(idx, 'html', html_dir, new_doc_ctx)
+    litprog.build.mark_docs_target_done(idx, 'html', html_dir, new_doc_ctx)
+    assert len(idx.targets) == 1
+
+    # a deleted output invalidates the target
+    (html_dir / "index.html").unlink()
+    assert not litprog.build.is_docs_target_done(idx, 'html', html_dir, new_doc_ctx)
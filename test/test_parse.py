@@ -6,9 +6,15 @@
 
 # pylint: disable=protected-access
 
+import os
+import threading
 import pathlib as pl
+import datetime as dt
 
 import litprog.cli
+import litprog.parse
+import litprog.config
+import litprog.common_types
 
 
 def test_fs_scanning():
@@ -17,3 +23,244 @@ def test_fs_scanning():
     assert len(lit_paths) > 0
     assert all(isinstance(p, pl.Path) for p in lit_paths)
     assert all(p.suffix == ".md" for p in lit_paths)
+
+
+def test_parse_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+
+    md_path = tmp_path / "01_test.md"
+    md_path.write_bytes(b"# Test\r\n\r\nText\r\n\r\n```python\r\n# exec\r\nprint('a')\r\n```\r\n")
+
+    elements = litprog.parse._parse_md_elements(md_path)
+    cache_files = list((tmp_path / "cache" / litprog.parse.PARSE_CACHE_DIR_NAME).glob("*.json"))
+    assert len(cache_files) == 1
+
+    cached_elements = litprog.parse._parse_md_elements(md_path)
+    assert [(e.md_type, e.first_line, e.content) for e in cached_elements] == [
+        (e.md_type, e.first_line, e.content) for e in elements
+    ]
+    assert [e.md_type for e in elements] == ['headline', 'paragraph', 'block', 'paragraph']
+
+    # a corrupt entry is ignored
+    cache_files[0].write_text("[[\"paragraph\", 1, 3]]")
+    assert len(litprog.parse._parse_md_elements(md_path)) == len(elements)
+
+    # a changed file gets a new entry
+    md_path.write_text("# Changed\n")
+    assert [e.content for e in litprog.parse._parse_md_elements(md_path)] == ["# Changed", "\n"]
+    assert len(list(cache_files[0].parent.glob("*.json"))) == 2
+
+
+def test_concurrent_parse_cache_dump(cache_dir):
+    cache_path = litprog.parse._parse_cache_path("0" * 40)
+    spans      = [('paragraph', i, 10) for i in range(1000)]
+    threads    = [
+        threading.Thread(target=litprog.parse._dump_cached_spans, args=(cache_path, spans)) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert litprog.parse._load_cached_spans(cache_path) == spans
+    assert not list(cache_path.parent.glob("*.tmp"))
+
+
+def test_iter_raw_md_elements():
+    content = "---\ntitle: x\n---\n# Title\n---\nText\n\n```python\nprint(1)\n```\nrest"
+    elements = list(litprog.parse._iter_raw_md_elements(content))
+    assert "".join(elem.content for elem in elements) == content
+    assert [(elem.md_type, elem.first_line) for elem in elements] == [
+        ('front_matter', 1),
+        ('paragraph'   , 3),
+        ('headline'    , 4),
+        # matched at the end of the previous headline (not at a line start)
+        ('headline'    , 4),
+        ('paragraph'   , 5),
+        ('block'       , 8),
+        ('paragraph'   , 10),
+    ]
+    assert elements[3].content == "\n---"
+
+
+def test_block_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# def: a\nprint('a')\n```\n\n```python\nprint('b')\n```\n")
+    chapter = litprog.parse.Context(md_paths=[md_path]).chapters[0]
+
+    index = chapter.block_index()
+    assert chapter.block_index() is index
+    chapter_copy = chapter.copy()
+    assert chapter_copy.block_index() is index
+    assert len(index.blocks) == 2
+    assert index.blocks_by_def_id['a'] == [index.blocks[0]]
+    assert chapter.get_block(md_path, index.blocks[1].elem_index) is index.blocks[1]
+
+    # replacing an element invalidates the index
+    elem        = chapter.elements[md_path][2]
+    new_content = "```python\n# def: c\n```"
+    chapter.replace_element(
+        litprog.parse.MarkdownElement(
+            md_path, elem.first_line, elem.elem_index, elem.md_type, new_content, None, {md_path}
+        )
+    )
+    new_index = chapter.block_index()
+    assert new_index is not index
+    assert set(new_index.blocks_by_def_id) == {'c'}
+    assert chapter.block_index() is new_index
+    # the copy has its own elements, so its index is still valid
+    assert chapter_copy.block_index() is index
+
+
+def test_add_span():
+    spans = []
+    litprog.parse._add_span(spans, 0, 0)
+    assert spans == []
+    litprog.parse._add_span(spans, 0, 3)
+    litprog.parse._add_span(spans, 3, 5)
+    assert spans == [(0, 5)]
+    litprog.parse._add_span(spans, 7, 9)
+    assert spans == [(0, 5), (7, 9)]
+
+
+TRIM_LAST_LINE_CASES = [
+    ("abc\ndef\n```", [(0, 12)]),
+    ("abc\r\ndef\r\n```", [(0, 14)]),
+    ("abc\ndef\n```\n", [(0, 13)]),
+    ("abc", [(0, 3)]),
+    ("abc\ndef", [(0, 3), (3, 8)]),
+    ("abc\ndef", [(0, 4), (4, 8)]),
+    ("# dir\nabc\ndef\n```", [(6, 10), (10, 18)]),
+    ("abc\n# dir\n```", [(0, 4), (10, 14)]),
+    ("", []),
+]
+
+
+def test_trim_last_line():
+    for content, spans in TRIM_LAST_LINE_CASES:
+        flat_spans = litprog.parse._trim_last_line(content, list(spans))
+        result     = litprog.common_types._join_spans(content, flat_spans)
+        expected   = "".join(content[start:end] for start, end in spans).rsplit("\n", 1)[0]
+        assert result == expected, (content, spans)
+
+
+def test_block_content_spans(tmp_path):
+    # expected values are those of the previous string based implementation
+    block_lines = ["```python", "# def: a", "# exec", "print('a')  # comment", "# include: b", "x = 1", "```"]
+    inner_content      = "# def: a\n# exec\nprint('a')  # comment\n# include: b\nx = 1"
+    includable_content = "print('a')  # comment\n# include: b\nx = 1"
+
+    md_contents = {
+        "01_lf.md"     : "\n".join(["# LF", ""] + block_lines) + "\n",
+        "02_crlf.md"   : "\r\n".join(["# CRLF", ""] + block_lines) + "\r\n",
+        "03_nofinal.md": "\n".join(["# No final newline", ""] + block_lines),
+    }
+    for filename, md_content in md_contents.items():
+        md_path = tmp_path / filename
+        md_path.write_bytes(md_content.encode("utf-8"))
+        chapter = litprog.parse.Context(md_paths=[md_path]).chapters[0]
+        (block,) = chapter.iter_blocks()
+        assert block.inner_content      == inner_content, filename
+        assert block.includable_content == includable_content, filename
+        assert [d.name for d in block.directives] == ['language', 'def', 'exec', 'include']
+
+    md_path = tmp_path / "04_plain.md"
+    md_path.write_text("# Plain\n\n```\n  plain text\n```")
+    (block,) = litprog.parse.Context(md_paths=[md_path]).chapters[0].iter_blocks()
+    assert block.inner_content      == "plain text"
+    assert block.includable_content == "plain text"
+
+
+def test_parse_directive():
+    parse_directive = litprog.parse.parse_directive
+    assert parse_directive(" exec\n", "#exec", is_prelude=True) == ('exec', "", "#exec")
+    assert parse_directive(" dep : a, b\n", "", is_prelude=True) == ('dep', "a, b", "")
+    assert parse_directive(" dep: a", "", is_prelude=False) == ('dep', "a", "")
+    assert parse_directive(" def: a: b", "", is_prelude=True) == ('def', "a: b", "")
+    assert parse_directive(" def: a", "", is_prelude=False) is None
+    assert parse_directive(" exec", "", is_prelude=False) is None
+    assert parse_directive(" execute: a", "", is_prelude=True) is None
+    assert parse_directive(" just a comment", "", is_prelude=True) is None
+
+    assert litprog.parse.has_directive("# exec", is_prelude=True, language="shell")
+    assert not litprog.parse.has_directive("exec", is_prelude=True, language="shell")
+
+
+def test_parallel_parse(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+    monkeypatch.setattr(litprog.parse, 'PARALLEL_PARSE_MIN_CHARS', 0)
+    monkeypatch.setattr(litprog.parse, 'PARALLEL_PARSE_MAX_WORKERS', 4)
+
+    md_paths = []
+    for i in range(6):
+        md_path = tmp_path / f"{i:02}_chapter.md"
+        md_path.write_text(
+            f"# Chapter {i}\n\nText {i}\n\n"
+            + f"```python\n# def: block_{i}\nprint({i})\n```\n\n"
+            + "- item\n- item\n\n"
+            + "```\nplain\n```"
+        )
+        md_paths.append(md_path)
+
+    parallel = litprog.parse.parse_context(md_paths, workers=4)
+    # the sequential parse must not use the entries written by the workers
+    assert litprog.parse.clear_parse_cache() == len(md_paths)
+    sequential = litprog.parse.Context(md_paths=md_paths)
+
+    assert [chapter.chapnum for chapter in parallel.chapters] == [
+        chapter.chapnum for chapter in sequential.chapters
+    ]
+    for par_chapter, seq_chapter in zip(parallel.chapters, sequential.chapters):
+        for md_path in seq_chapter.md_paths:
+            par_elems = [(e.md_type, e.first_line, e.content) for e in par_chapter.elements[md_path]]
+            seq_elems = [(e.md_type, e.first_line, e.content) for e in seq_chapter.elements[md_path]]
+            assert par_elems == seq_elems
+
+
+def test_chapter_copy_on_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\nText\n")
+    chapter = litprog.parse.Context(md_paths=[md_path]).chapters[0]
+    copied  = chapter.copy()
+    assert copied.elements[md_path] is chapter.elements[md_path]
+
+    elem = chapter.elements[md_path][1]
+    copied.replace_element(
+        litprog.parse.MarkdownElement(md_path, elem.first_line, 1, elem.md_type, "\n\nNew\n", None, {md_path})
+    )
+    assert copied.elements[md_path] is not chapter.elements[md_path]
+    assert copied.md_content(md_path) == "# Test\n\nNew\n"
+    assert chapter.md_content(md_path) == "# Test\n\nText\n"
+    assert copied.modified == {md_path: {1}}
+    assert chapter.modified == {}
+
+
+def test_evict_parse_cache(tmp_path, cache_dir):
+    md_path_1 = tmp_path / "01_test.md"
+    md_path_2 = tmp_path / "02_test.md"
+    md_path_1.write_text("# One\n")
+    md_path_2.write_text("# Two\n")
+    litprog.parse.parse_context([md_path_1, md_path_2])
+
+    parse_cache_dir = cache_dir / litprog.parse.PARSE_CACHE_DIR_NAME
+    cache_paths     = sorted(parse_cache_dir.glob("*.json"))
+    assert len(cache_paths) == 2
+
+    # an entry of an old version and an entry that was not used for a long time
+    (parse_cache_dir / "v0_1234.json").write_text("[]")
+    os.utime(cache_paths[0], (0, 0))
+    assert litprog.parse.evict_parse_cache(dt.timedelta(days=90)) == 2
+    assert list(parse_cache_dir.glob("*.json")) == [cache_paths[1]]
+
+    # a lookup counts as a use
+    os.utime(cache_paths[1], (0, 0))
+    litprog.parse.parse_context([md_path_1, md_path_2])
+    assert litprog.parse.evict_parse_cache(dt.timedelta(days=90)) == 0
+
+    assert litprog.parse.clear_parse_cache([md_path_1]) == 1
+    assert litprog.parse.clear_parse_cache() == 1
+    assert list(parse_cache_dir.glob("*.json")) == []
@@ -0,0 +1,165 @@
+# This file is part of the litprog project
+# https://github.com/litprog/litprog
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+
+# pylint: disable=protected-access
+
+import sys
+import threading
+import http.client
+
+import pytest
+
+import litprog.build
+import litprog.config
+import litprog.parse
+import litprog.session
+import litprog.cache_server
+import litprog.capture_cache
+import litprog.remote_cache as sut
+
+
+def _record(task_key: str) -> sut.Record:
+    entry = litprog.capture_cache.ManifestEntry(
+        "2021-03-01T00:00:00", 10, 3, "digest", task_key, "01_test.md", "@ 1 - python"
+    )
+    return sut.Record(entry, b"abc")
+
+
+def test_pack_records():
+    records = [_record("key_a"), _record("key_b")]
+    assert list(sut.unpack_records(sut.pack_records(records))) == records
+    assert list(sut.unpack_records(b"")) == []
+
+
+def test_concurrent_store(tmp_path):
+    record_store = litprog.cache_server.RecordStore(tmp_path / "server")
+    task_key     = "0" * 40
+    threads      = [
+        threading.Thread(target=record_store.store, args=("cache_id", [_record(task_key)] * 20))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records = list(sut.unpack_records(record_store.lookup("cache_id", [task_key])))
+    assert records == [_record(task_key)]
+    assert not list((tmp_path / "server").glob("**/*.tmp"))
+
+
+@pytest.fixture
+def server_url(tmp_path):
+    server = litprog.cache_server.init_server(port=0, data_dir=tmp_path / "server")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        host, port = server.server_address
+        yield f"http://{host}:{port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_cache(tmp_path, monkeypatch, server_url):
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    ctx  = litprog.parse.parse_context([md_path])
+    task = next(litprog.build._iter_block_tasks(ctx.chapters[0]))
+
+    capture = litprog.session.Capture("python3", 0, 0.1, [litprog.session.CapturedLine(0.01, "a\n", False)])
+
+    # first machine
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache_1")
+    cache = sut.RemoteResultCache(ctx.chapters, server_url)
+    cache.prefetch([task])
+    assert cache.get_capture(task) is None
+    cache.update(task, capture)
+    cache.flush()
+
+    # second machine, with an empty local cache
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache_2")
+    cache = sut.RemoteResultCache(ctx.chapters, server_url)
+    cache.prefetch([task])
+    assert cache.get_capture(task) == capture
+    cache.flush()
+
+    # read through to the local cache
+    local_cache = litprog.capture_cache.SQLiteResultCache(ctx.chapters)
+    assert local_cache.get_capture(task) == capture
+    local_cache.flush()
+
+
+def test_max_body_size(tmp_path, server_url):
+    host, port = server_url[len("http://") :].split(":")
+    conn = http.client.HTTPConnection(host, int(port), timeout=5)
+    try:
+        # the body is rejected based on its Content-Length, without it being sent
+        conn.putrequest("POST", "/v1/cache_id/store")
+        conn.putheader("Content-Length", str(litprog.cache_server.DEFAULT_MAX_BODY_SIZE + 1))
+        conn.endheaders()
+        assert conn.getresponse().status == 413
+    finally:
+        conn.close()
+
+    store = sut.HTTPRemoteStore(server_url, "cache_id")
+    store.store([_record("a" * 40)])
+    assert store.lookup(["a" * 40]) == [_record("a" * 40)]
+
+
+def test_remote_cache_unavailable(tmp_path, monkeypatch):
+    monkeypatch.setattr(litprog.config, 'CACHE_DIR', tmp_path / "cache")
+
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    ctx  = litprog.parse.parse_context([md_path])
+    task = next(litprog.build._iter_block_tasks(ctx.chapters[0]))
+
+    # nothing is listening on port 1
+    cache = sut.RemoteResultCache(ctx.chapters, "http://127.0.0.1:1")
+    cache.prefetch([task])
+    assert cache._is_remote_broken
+    assert cache.get_capture(task) is None
+    cache.update(task, litprog.session.Capture("python3", 0, 0.1, []))
+    cache.flush()
+
+
+class _CorruptStore(sut.RemoteStore):
+    def lookup(self, task_keys):
+        # truncated response
+        return list(sut.unpack_records(sut.pack_records([_record(task_keys[0])])[:6]))
+
+    def store(self, records):
+        raise http.client.RemoteDisconnected("closed")
+
+
+def test_remote_cache_corrupt(tmp_path, monkeypatch):
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    ctx  = litprog.parse.parse_context([md_path])
+    task = next(litprog.build._iter_block_tasks(ctx.chapters[0]))
+
+    monkeypatch.setitem(sut.REMOTE_STORES, 'corrupt', lambda url, cache_id: _CorruptStore())
+    cache = sut.RemoteResultCache(ctx.chapters, "corrupt://host")
+    cache.prefetch([task])
+    assert cache._is_remote_broken
+
+    cache._is_remote_broken = False
+    cache.update(task, litprog.session.Capture("python3", 0, 0.1, []))
+    cache.flush()
+    assert cache._is_remote_broken
+
+
+def test_remote_cache_redis_missing(tmp_path, monkeypatch):
+    md_path = tmp_path / "01_test.md"
+    md_path.write_text("# Test\n\n```python\n# exec\nprint('a')\n```\n")
+    ctx = litprog.parse.parse_context([md_path])
+
+    # simulate a missing redis package
+    monkeypatch.setitem(sys.modules, 'redis', None)
+    cache = sut.RemoteResultCache(ctx.chapters, "redis://127.0.0.1:1/0")
+    assert cache._is_remote_broken
+    cache.flush()
@@ -7,6 +7,10 @@
 # pylint: disable=protected-access
 
 import io
+import os
+import json
+
+import pytest
 
 import litprog.session as sut
 
@@ -72,3 +76,138 @@ def test_integration():
     assert session.stderr == "moep\n"
     assert retcode        == 0
     assert session.runtime < 0.5
+
+
+def test_selector_integration():
+    session = sut.SelectorInteractiveSession(cmd=['python3'])
+    for block in [BLOCK_0, BLOCK_1, BLOCK_2]:
+        session.send(block)
+    retcode = session.wait()
+    assert session.stdout == "ok1\nok2ok3"
+    assert session.stderr == "moep\n"
+    assert retcode        == 0
+    assert session.runtime < 0.5
+
+    lines = session.output_lines()
+    assert [line.line for line in lines] == ["ok1\n", "moep\n", "ok2ok3"]
+    assert [line.is_err for line in lines] == [False, True, False]
+
+
+@pytest.mark.parametrize("session_type", [sut.InteractiveSession, sut.SelectorInteractiveSession])
+def test_binary_output(session_type):
+    sessions = [session_type(cmd=['bash']) for _ in range(2)]
+    sessions[0].send("printf '\\xff\\xfe bad\\n'\nprintf 'ok\\n'\n")
+    sessions[1].send("printf 'other\\n'\n")
+
+    assert [session.wait(timeout=5) for session in sessions] == [0, 0]
+    assert sessions[0].stdout == "\ufffd\ufffd bad\nok\n"
+    assert sessions[1].stdout == "other\n"
+
+
+def test_selector_abort():
+    pidfd = sut._open_pidfd(os.getpid())
+    if pidfd is None:
+        pytest.skip("pidfd not available")
+    os.close(pidfd)
+
+    def _raise(data):
+        raise ValueError("moep")
+
+    failing = sut.SelectorInteractiveSession(cmd=['python3'])
+    other   = sut.SelectorInteractiveSession(cmd=['python3'])
+    failing._out_cap.feed = _raise
+    failing.send("print('fail')\nimport time\ntime.sleep(0.5)\n")
+    other.send("import time\ntime.sleep(0.2)\nprint('other')\n")
+
+    failing.wait(timeout=5)
+    # the pidfd of the aborted session is closed
+    assert failing._pidfd is None
+
+    assert other.wait(timeout=5) == 0
+    assert other.stdout == "other\n"
+
+
+def test_selector_timeout():
+    session = sut.SelectorInteractiveSession(cmd=['python3'])
+    session.send("import time\ntime.sleep(2)\n")
+    retcode = session.wait(timeout=0.2)
+    assert retcode == -15
+    assert session.runtime < 1
+
+
+def test_forkserver_integration():
+    import litprog.forkserver
+
+    server = litprog.forkserver.ForkServer("python3")
+    try:
+        session = sut.InteractiveSession(cmd=['python3'], spawn=server.spawn)
+        for block in [BLOCK_0, BLOCK_1, BLOCK_2]:
+            session.send(block)
+        retcode = session.wait()
+        assert session.stdout == "ok1\nok2ok3"
+        assert session.stderr == "moep\n"
+        assert retcode        == 0
+
+        session = sut.InteractiveSession(cmd=['python3'], spawn=server.spawn)
+        session.send("import sys\nsys.exit(3)\n")
+        assert session.wait() == 3
+
+        session = sut.InteractiveSession(cmd=['python3'], spawn=server.spawn)
+        session.send("raise ValueError('moep')\n")
+        assert session.wait() == 1
+        assert session.stderr.startswith("Traceback")
+        assert session.stderr.strip().endswith("ValueError: moep")
+
+        env     = {'PATH': os.environ['PATH'], 'LITPROG_TEST_VAR': "moep"}
+        session = sut.InteractiveSession(cmd=['python3'], env=env, spawn=server.spawn)
+        session.send("import os\nprint(sorted(os.environ))\n")
+        assert session.wait() == 0
+        assert session.stdout == f"{sorted(env)}\n"
+
+        # non-daemon threads are joined before the child exits
+        session = sut.InteractiveSession(cmd=['python3'], spawn=server.spawn)
+        session.send(
+            "import time, atexit, threading\n"
+            + "atexit.register(lambda: print('atexit'))\n"
+            + "threading.Thread(target=lambda: (time.sleep(0.2), print('thread'))).start()\n"
+        )
+        assert session.wait() == 0
+        assert session.stdout == "thread\natexit\n"
+        assert not server.is_broken
+    finally:
+        server.close()
+
+
+def _capture(num_lines: int) -> sut.Capture:
+    lines = [
+        sut.CapturedLine(1614902400.0 + i * 0.001, f"line {i} ünïcode\n", i % 3 == 0)
+        for i in range(num_lines)
+    ]
+    return sut.Capture("python3 -c 'moep'", 1, 0.5, lines)
+
+
+def test_binary_capture_round_trip():
+    capture = _capture(20)
+    data    = sut.dumps_capture(capture)
+    assert data.startswith(sut.BINARY_MAGIC)
+
+    loaded = sut.loads_capture(data)
+    assert isinstance(loaded.lines, sut.CapturedLines)
+    assert loaded == capture
+    assert loaded.lines[-1] == capture.lines[-1]
+    assert loaded.lines[3:5] == capture.lines[3:5]
+    assert [line.is_err for line in loaded.lines] == [line.is_err for line in capture.lines]
+
+    empty = sut.Capture("bash", 0, 0.0, [])
+    assert sut.loads_capture(sut.dumps_capture(empty)) == empty
+
+
+def test_legacy_capture_formats():
+    capture = _capture(5)
+
+    pretty_data = sut.dumps_capture(capture, pretty=True)
+    assert sut.loads_capture(pretty_data) == capture
+
+    line_args   = [[line.ts, line.line, line.is_err] for line in capture.lines]
+    legacy_data = json.dumps([capture.command, capture.exit_status, capture.runtime, line_args])
+    assert sut.loads_capture(legacy_data.encode("utf-8")) == capture